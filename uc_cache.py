@@ -0,0 +1,54 @@
+import argparse
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows the contents of a prediction cache (see uc_predict.py "
+                                                 "--cache_dir) or removes the cached predictions of a model.")
+    parser.add_argument('cache_dir', help="folder of the prediction cache")
+    parser.add_argument('-t', '--task_name', required=False, default=None,
+                        help='task name or task ID. If given, remove all cached predictions of this model '
+                             '(all folds, checkpoints and options)')
+    parser.add_argument('-tr', '--trainer_class_name',
+                        help='Name of the trainer. The default is %s.' % default_trainer,
+                        required=False,
+                        default=default_trainer)
+    parser.add_argument('-m', '--model', help="Only 3d_fullres is currently supported. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='do not touch this unless you know what you are doing',
+                        default=default_plans_identifier, required=False)
+    parser.add_argument('--model_folder', required=False, default=None,
+                        help="remove all cached predictions of this model folder, instead of --task_name")
+    parser.add_argument('--max_size_gb', required=False, default=None, type=float,
+                        help="remove the least recently used predictions (of all models) until the cache is at most "
+                             "this size")
+    args = parser.parse_args()
+
+    from universalclassifier.inference.prediction_cache import PredictionCache, get_cache_summary, \
+        invalidate_model_folder
+
+    model_folder = args.model_folder
+    if args.task_name is not None:
+        from universalclassifier.inference.predict_simple import get_model_folder
+        model_folder = get_model_folder(args.task_name, args.model, args.trainer_class_name, args.plans_identifier)
+    if model_folder is not None:
+        removed = invalidate_model_folder(args.cache_dir, model_folder)
+        print(f"removed the cached predictions of {removed} fingerprint(s) of {model_folder}")
+
+    summary = get_cache_summary(args.cache_dir)
+    if args.max_size_gb is not None and len(summary) > 0:
+        max_size = args.max_size_gb * 1024 ** 3
+        cache = PredictionCache(args.cache_dir, summary[0]["fingerprint"], max_size)
+        cache.evict(max_size)
+        summary = get_cache_summary(args.cache_dir)
+
+    for s in summary:
+        info = s["model_info"] or {}
+        print(f"{s['fingerprint']}  {s['num_entries']:8d} cases  {s['size'] / 1024 ** 2:10.1f} MB  "
+              f"{info.get('model_folder')} folds={info.get('folds')} backend={info.get('backend')}")
+    print(f"total: {sum(s['num_entries'] for s in summary)} cases, "
+          f"{sum(s['size'] for s in summary) / 1024 ** 2:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
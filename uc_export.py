@@ -0,0 +1,39 @@
+import argparse
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the trained I3D of every fold as a TorchScript or ONNX graph "
+                                                 "for the planned image size, saved next to the fold checkpoints as "
+                                                 "fold_X/<checkpoint>.pt or .onnx. Use them with uc_predict.py "
+                                                 "--backend torchscript or --backend onnx.")
+    parser.add_argument('-t', '--task_name', help='task name or task ID, required.', required=True)
+    parser.add_argument('-tr', '--trainer_class_name',
+                        help='Name of the trainer. The default is %s.' % default_trainer,
+                        required=False,
+                        default=default_trainer)
+    parser.add_argument('-m', '--model', help="Only 3d_fullres is currently supported. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='do not touch this unless you know what you are doing',
+                        default=default_plans_identifier, required=False)
+    parser.add_argument('-f', '--folds', nargs='+', default='None',
+                        help="folds to export. Default is None which means that folds will be detected "
+                             "automatically in the model output folder")
+    parser.add_argument('-chk',
+                        help='checkpoint name, default: model_final_checkpoint',
+                        required=False,
+                        default='model_final_checkpoint')
+    parser.add_argument('--backend', required=False, default="torchscript", choices=["torchscript", "onnx"],
+                        help="graph format. onnx needs the onnx package. Default: torchscript")
+    args = parser.parse_args()
+
+    from universalclassifier.inference.graph_export import export_model_folder
+    from universalclassifier.inference.predict_grand_challenge import parse_folds
+    from universalclassifier.inference.predict_simple import get_model_folder
+
+    model_folder_name = get_model_folder(args.task_name, args.model, args.trainer_class_name, args.plans_identifier)
+    export_model_folder(model_folder_name, parse_folds(args.folds), args.chk, args.backend)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,3 @@
-from universalclassifier.experiment_planning import plan_and_preprocess
-
-
 def parse_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -24,6 +21,11 @@ def parse_args():
     parser.add_argument("--verify_dataset_integrity", required=False, default=False, action="store_true",
                         help="Not implmented yet for universal classifier. Set this flag to check the dataset "
                              "integrity. This is useful and should be done once for each dataset!")
+    parser.add_argument("--restrict_resampling_to_fov", required=False, default=False, action="store_true",
+                        help="Only resample the part of every image that is kept by the crop to the planned image "
+                             "size. Faster for large images with CT or noNorm normalization, the preprocessed data "
+                             "are the same: modalities with per case normalization statistics (nonCT, CT2) still need "
+                             "the whole resampled image")
 
 
     args = parser.parse_args()
@@ -32,5 +34,9 @@ def parse_args():
 
 
 if __name__ == "__main__":
-    plan_and_preprocess.main(parse_args())
+    args = parse_args()
+
+    # imported here so that --help and argument errors do not wait for nnU-Net
+    from universalclassifier.experiment_planning import plan_and_preprocess
+    plan_and_preprocess.main(args)
     print("Completed planning and preprocessing.")
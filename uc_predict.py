@@ -1,6 +1,5 @@
 import argparse
 from universalclassifier.paths import default_plans_identifier, default_trainer
-from universalclassifier.inference.predict_simple import predict
 
 
 def main():
@@ -29,7 +28,8 @@ def main():
                         default=default_plans_identifier, required=False)
     parser.add_argument('-f', '--folds', nargs='+', default='None',
                         help="folds to use for prediction. Default is None which means that folds will be detected "
-                             "automatically in the model output folder")
+                             "automatically in the model output folder. Use 'soup' for the weight averaged model "
+                             "created with uc_soup.py")
     parser.add_argument(
         '--folders_format',
         required=False,
@@ -40,21 +40,100 @@ def main():
              "if the task name contains 'T2W'. If set to False, the data folder should directly contain the .nii.gz files "
              "for each sequence, pre-prepared for inference without additional folder organization."
     )
-    parser.add_argument("--disable_tta", required=False, default=False, action="store_true",
-                        help="set this flag to disable test time data augmentation via mirroring. Speeds up inference "
-                             "by roughly factor 4 (2D) or 8 (3D)")
+    parser.add_argument("--tta", required=False, default=False, action="store_true",
+                        help="set this flag to enable test time data augmentation via mirroring along the mirror "
+                             "axes used in training (or --mirror_axes). The mirrored variants (up to 8 in 3D) are "
+                             "predicted in a single batched forward pass per fold, so it multiplies the compute and "
+                             "(v)ram of the forward pass by the number of variants. Default: off")
+    parser.add_argument("--mirror_axes", required=False, default=None, type=int, nargs="+",
+                        help="with --tta, only mirror along these spatial axes, e.g. --mirror_axes 1 2 for 4 "
+                             "variants. Default: the axes used in training")
+    # deprecated, test time augmentation is off unless --tta is set. Still accepted so that existing scripts work
+    parser.add_argument("--disable_tta", required=False, default=False, action="store_true", help=argparse.SUPPRESS)
     parser.add_argument("--overwrite_existing", required=False, default=False, action="store_true",
-                        help="Set this flag if the target folder contains predictions that you would like to overwrite")
+                        help="Set this flag if the target folder contains predictions that you would like to "
+                             "overwrite. Otherwise, an interrupted run is resumed: cases that are recorded as finished "
+                             "in the run manifest of the output folder are skipped")
     parser.add_argument('-chk',
                         help='checkpoint name, default: model_final_checkpoint',
                         required=False,
                         default='model_final_checkpoint')
+    parser.add_argument('--batch_size', type=int, required=False, default=1,
+                        help='Number of cases that are preprocessed and stacked into a single forward pass per fold. '
+                             'All cases are padded to the planned image size, so any batch size works as long as it '
+                             'fits in memory. Default: 1')
+    parser.add_argument("--num_threads_preprocessing", required=False, default=6, type=int,
+                        help="Number of processes that preprocess upcoming cases while the network predicts the "
+                             "current ones. Default: 6")
+    parser.add_argument("--num_threads_export", required=False, default=1, type=int,
+                        help="Number of threads used for writing the predictions to disk. Default: 1")
+    parser.add_argument("--explain", required=False, default="none", choices=["none", "positives", "all"],
+                        help="For which cases Grad-CAM heatmaps and image grids are saved next to the predictions: "
+                             "'none', 'positives' (cases where any classification head predicts a class other than "
+                             "0) or 'all'. Heatmaps need an extra forward and backward pass. Default: none")
+    parser.add_argument("--explain_method", required=False, default="gradcam", choices=["gradcam", "cam"],
+                        help="How the heatmaps of --explain are computed. 'gradcam' uses the gradients at mixed_3b and "
+                             "needs an extra forward and backward pass. 'cam' weights the mixed_5c features of the "
+                             "prediction forward pass with the classification head and needs no extra pass, at a "
+                             "coarser resolution. Default: gradcam")
+    parser.add_argument("--render_backend", required=False, default="mosaic", choices=["mosaic", "matplotlib"],
+                        help="How the slice grids of --explain are written. 'mosaic' tiles the slices into a single "
+                             "image that is encoded directly with OpenCV, 'matplotlib' draws a subplot grid. "
+                             "Default: mosaic")
+    parser.add_argument("--heatmap_downsample", required=False, default=1, type=int,
+                        help="Downsampling factor of the slices in the 'mosaic' grids, e.g. 2 or 4 for thumbnails. "
+                             "Default: 1")
+    parser.add_argument("--backend", required=False, default="pytorch",
+                        choices=["pytorch", "torchscript", "onnx", "int8"],
+                        help="'pytorch' runs the fold checkpoints with the I3D definition. 'torchscript' and 'onnx' "
+                             "run the graphs exported with uc_export.py (fp32, no --explain). The onnx backend needs "
+                             "onnxruntime. 'int8' runs the quantized graphs created with uc_quantize.py on the cpu. "
+                             "Default: pytorch")
+    parser.add_argument("--num_parts", required=False, default=1, type=int,
+                        help="Split the cases into this many parts, e.g. to predict on several nodes at once. Run one "
+                             "process per part with the same input and output folder and a different --part_id. "
+                             "Default: 1")
+    parser.add_argument("--part_id", required=False, default=0, type=int,
+                        help="Part predicted by this process, in [0, num_parts). Default: 0")
+    parser.add_argument("--result_store", required=False, default=None,
+                        help="Append all predictions to this SQLite file (one row per case with the outputs, argmax "
+                             "and properties) instead of writing an .npz and .pkl per case to the output folder. Read "
+                             "it with universalclassifier.inference.result_store.load_results")
+    parser.add_argument("--cache_dir", required=False, default=None,
+                        help="Folder of a prediction cache that can be shared between runs. Cases whose image files "
+                             "and segmentation have exactly the same bytes as a case that was predicted before with "
+                             "the same plans, checkpoints and options are taken from the cache (whatever their case "
+                             "id), without preprocessing or prediction. Manage it with uc_cache.py")
+    parser.add_argument("--cache_max_size_gb", required=False, default=10., type=float,
+                        help="Size of the prediction cache above which the least recently used entries are removed. "
+                             "Default: 10")
+    parser.add_argument("--early_exit_margin", required=False, default=None, type=float,
+                        help="Evaluate the folds in order and stop for a case once the averaged softmax of every "
+                             "classification head is at least this far from the decision threshold (0.5 for binary "
+                             "heads, for more classes the top class must lead the runner-up by twice this). The "
+                             "number of folds used is saved as 'num_folds_used' in the .pkl of every case. Only for "
+                             "the pytorch backend. Default: off, all folds are used")
+    parser.add_argument("--profile", required=False, default=None,
+                        help="Record the wall time and peak memory of every stage (read, crop, resample, forward "
+                             "pass per fold, export, ...) of every case in this json lines file and print a summary "
+                             "table at the end")
+    parser.add_argument("--restrict_resampling_to_fov", required=False, default=False, action="store_true",
+                        help="Only resample the part of every image that is kept by the crop to the planned image "
+                             "size, instead of resampling the whole image and cropping afterwards. Faster for large "
+                             "images with CT or noNorm normalization. The predictions are the same: modalities with "
+                             "per case normalization statistics (nonCT, CT2) still need the whole resampled image")
     parser.add_argument('--disable_mixed_precision', default=False, action='store_true', required=False,
                         help='Predictions are done with mixed precision by default. This improves speed and reduces '
                              'the required vram. If you want to disable mixed precision you can set this flag. Note '
                              'that this is not recommended (mixed precision is ~2x faster!)')
 
     args = parser.parse_args()
+    if args.disable_tta:
+        print("WARNING: --disable_tta is deprecated and has no effect, test time augmentation is off unless --tta is "
+              "set")
+
+    # imported here so that --help and argument errors do not wait for torch and nnU-Net
+    from universalclassifier.inference.predict_simple import predict
     predict(args)
 
 
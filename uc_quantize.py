@@ -0,0 +1,44 @@
+import argparse
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-training int8 quantization for cpu inference. The network of "
+                                                 "every fold is calibrated on a sample of its preprocessed training "
+                                                 "cases and saved as fold_X/<checkpoint>_int8.pt. The accuracy and "
+                                                 "AUC of fp32 and int8 on the validation split of the fold are "
+                                                 "printed and saved as fold_X/<checkpoint>_int8.json. Use the result "
+                                                 "with uc_predict.py --backend int8.")
+    parser.add_argument('-t', '--task_name', help='task name or task ID, required.', required=True)
+    parser.add_argument('-tr', '--trainer_class_name',
+                        help='Name of the trainer. The default is %s.' % default_trainer,
+                        required=False,
+                        default=default_trainer)
+    parser.add_argument('-m', '--model', help="Only 3d_fullres is currently supported. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='do not touch this unless you know what you are doing',
+                        default=default_plans_identifier, required=False)
+    parser.add_argument('-f', '--folds', nargs='+', default='None',
+                        help="folds to quantize. Default is None which means that folds will be detected "
+                             "automatically in the model output folder")
+    parser.add_argument('-chk',
+                        help='checkpoint name, default: model_final_checkpoint',
+                        required=False,
+                        default='model_final_checkpoint')
+    parser.add_argument('--num_calibration_cases', required=False, default=32, type=int,
+                        help="Number of training cases per fold used to calibrate the activation ranges. Default: 32")
+    parser.add_argument('--engine', required=False, default="fbgemm", choices=["fbgemm", "qnnpack"],
+                        help="Quantization engine: fbgemm for x86, qnnpack for arm. Default: fbgemm")
+    args = parser.parse_args()
+
+    from universalclassifier.inference.predict_grand_challenge import parse_folds
+    from universalclassifier.inference.predict_simple import get_model_folder
+    from universalclassifier.inference.quantization import quantize_model_folder
+
+    model_folder_name = get_model_folder(args.task_name, args.model, args.trainer_class_name, args.plans_identifier)
+    quantize_model_folder(model_folder_name, parse_folds(args.folds), args.chk, args.num_calibration_cases,
+                          args.engine)
+
+
+if __name__ == "__main__":
+    main()
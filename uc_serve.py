@@ -0,0 +1,69 @@
+import argparse
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keeps the trainer and all fold weights in memory and serves "
+                                                 "predictions over http or a unix socket. POST /predict accepts a "
+                                                 "json body {\"image_files\": [...], \"roi_segmentation_file\": ...} "
+                                                 "or an npz body with the arrays 'data', 'spacing' and optionally "
+                                                 "'seg', and returns the same json as predict_grand_challenge.")
+    parser.add_argument('-t', '--task_name', help='task name or task ID. Either this or --artifact_path is required',
+                        required=False, default=None)
+    parser.add_argument('--artifact_path', required=False, default=None,
+                        help='artifact folder as used by predict_grand_challenge, containing nnUNet/3d_fullres/TaskXXX')
+    parser.add_argument('-tr', '--trainer_class_name',
+                        help='Name of the trainer. The default is %s.' % default_trainer,
+                        required=False,
+                        default=default_trainer)
+    parser.add_argument('-m', '--model', help="Only 3d_fullres is currently supported. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='do not touch this unless you know what you are doing',
+                        default=default_plans_identifier, required=False)
+    parser.add_argument('-f', '--folds', nargs='+', default='None',
+                        help="folds to use for prediction. Default is None which means that folds will be detected "
+                             "automatically in the model output folder")
+    parser.add_argument('-chk',
+                        help='checkpoint name, default: model_final_checkpoint',
+                        required=False,
+                        default='model_final_checkpoint')
+    parser.add_argument('--host', required=False, default="127.0.0.1", help="Default: 127.0.0.1")
+    parser.add_argument('--port', required=False, default=8000, type=int, help="Default: 8000")
+    parser.add_argument('--unix_socket', required=False, default=None,
+                        help="Listen on this unix socket instead of --host and --port")
+    parser.add_argument('--max_batch_size', required=False, default=8, type=int,
+                        help="Maximum number of concurrent requests that are predicted in a single forward pass per "
+                             "fold. Default: 8")
+    parser.add_argument('--max_latency', required=False, default=0.05, type=float,
+                        help="Maximum time in seconds a request waits for other requests to batch with. Default: 0.05")
+    parser.add_argument('--mixed_precision', default=False, action='store_true', required=False,
+                        help='Predict with mixed precision, which is faster on the gpu. The probabilities then differ '
+                             'slightly from those of predict_grand_challenge, which predicts in fp32 by default')
+    # deprecated, mixed precision is off unless --mixed_precision is set. Still accepted so that existing scripts work
+    parser.add_argument('--disable_mixed_precision', default=False, action='store_true', required=False,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.disable_mixed_precision:
+        print("WARNING: --disable_mixed_precision is deprecated and has no effect, mixed precision is off unless "
+              "--mixed_precision is set")
+
+    from universalclassifier.inference.predict_grand_challenge import get_model_folder_from_artifact, parse_folds
+    from universalclassifier.inference.service import serve
+
+    assert (args.task_name is None) != (args.artifact_path is None), \
+        "provide exactly one of --task_name and --artifact_path"
+    if args.artifact_path is not None:
+        model_folder_name = get_model_folder_from_artifact(args.artifact_path, args.model, args.trainer_class_name,
+                                                           args.plans_identifier)
+    else:
+        from universalclassifier.inference.predict_simple import get_model_folder
+        model_folder_name = get_model_folder(args.task_name, args.model, args.trainer_class_name,
+                                             args.plans_identifier)
+
+    serve(model_folder_name, parse_folds(args.folds), host=args.host, port=args.port, unix_socket=args.unix_socket,
+          mixed_precision=args.mixed_precision, checkpoint_name=args.chk,
+          max_batch_size=args.max_batch_size, max_latency=args.max_latency)
+
+
+if __name__ == "__main__":
+    main()
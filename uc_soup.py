@@ -0,0 +1,43 @@
+import argparse
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Averages the weights of the folds into a single network (a 'model "
+                                                 "soup'), recomputes its batch norm statistics on training cases and "
+                                                 "saves it as <model folder>/soup/. The soup, the fold ensemble and "
+                                                 "the fold's own model are compared on the validation cases of every "
+                                                 "fold. The soup and ensemble metrics are in-sample (the other folds "
+                                                 "and the batch norm statistics have seen these cases), so only the "
+                                                 "fold's own model gives an unbiased reference. Predict with the "
+                                                 "soup with uc_predict.py -f soup.")
+    parser.add_argument('-t', '--task_name', help='task name or task ID, required.', required=True)
+    parser.add_argument('-tr', '--trainer_class_name',
+                        help='Name of the trainer. The default is %s.' % default_trainer,
+                        required=False,
+                        default=default_trainer)
+    parser.add_argument('-m', '--model', help="Only 3d_fullres is currently supported. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='do not touch this unless you know what you are doing',
+                        default=default_plans_identifier, required=False)
+    parser.add_argument('-f', '--folds', nargs='+', default='None',
+                        help="folds to average. Default is None which means that folds will be detected "
+                             "automatically in the model output folder")
+    parser.add_argument('-chk',
+                        help='checkpoint name, default: model_final_checkpoint',
+                        required=False,
+                        default='model_final_checkpoint')
+    parser.add_argument('--num_bn_cases', required=False, default=64, type=int,
+                        help="Number of training cases used to recompute the batch norm statistics. Default: 64")
+    args = parser.parse_args()
+
+    from universalclassifier.inference.predict_grand_challenge import parse_folds
+    from universalclassifier.inference.predict_simple import get_model_folder
+    from universalclassifier.inference.soup import make_soup
+
+    model_folder_name = get_model_folder(args.task_name, args.model, args.trainer_class_name, args.plans_identifier)
+    make_soup(model_folder_name, parse_folds(args.folds), args.chk, args.num_bn_cases)
+
+
+if __name__ == "__main__":
+    main()
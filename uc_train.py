@@ -1,5 +1,4 @@
 
-from universalclassifier.run.run_training import run_training
 import argparse
 from universalclassifier.paths import default_plans_identifier
 
@@ -55,6 +54,9 @@ def main():
                              "you should consider setting this flag.")
     parser.add_argument('--val_disable_overwrite', action='store_false', default=True,
                         help='Validation does not overwrite existing segmentations')
+    parser.add_argument('--val_result_store', action='store_true', default=False,
+                        help='Save the validation predictions in a single predictions.sqlite in the validation folder '
+                             'instead of one .npz per case')
     parser.add_argument('--disable_next_stage_pred', action='store_true', default=False,
                         help='do not predict next stage')
     parser.add_argument('-pretrained_weights', type=str, required=False, default=None,
@@ -63,6 +65,9 @@ def main():
                              'Optional. Beta. Use with caution.')
 
     args = parser.parse_args()
+
+    # imported here so that --help and argument errors do not wait for torch and nnU-Net
+    from universalclassifier.run.run_training import run_training
     run_training(args)
 
 
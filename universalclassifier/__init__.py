@@ -1,4 +1,13 @@
 from __future__ import absolute_import # For returning list of paths for recursive module path finding
-from .inference.predict_grand_challenge import predict_grand_challenge as predict
+
+
+def predict(*args, **kwargs):
+    """
+    predict_grand_challenge, imported on first use so that importing universalclassifier does not pull in torch and
+    nnU-Net
+    """
+    from .inference.predict_grand_challenge import predict_grand_challenge
+    return predict_grand_challenge(*args, **kwargs)
+
 
 from . import *
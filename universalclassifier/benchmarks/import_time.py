@@ -0,0 +1,123 @@
+"""
+Measures the startup cost of the command line entry points and of the modules they import.
+
+Every measurement runs in a fresh interpreter, so nothing is cached in sys.modules between repeats. Two things are
+measured:
+- the cumulative import time of a module as reported by `python -X importtime`
+- the wall time of `python <entry point> --help`, which is what a user waits for before anything happens
+
+Usage: python -m universalclassifier.benchmarks.import_time [-n 5] [-o import_time.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+repository_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+default_modules = [
+    "universalclassifier",
+    "universalclassifier.inference.predict_simple",
+    "universalclassifier.inference.predict",
+    "universalclassifier.inference.visualization",
+    "universalclassifier.training.network_training.ClassifierTrainer",
+    "universalclassifier.run.run_training",
+    "universalclassifier.experiment_planning.plan_and_preprocess",
+]
+
+default_entry_points = [
+    "uc_predict.py",
+    "uc_train.py",
+    "uc_plan_and_preprocess.py",
+    "uc_serve.py",
+    "uc_export.py",
+    "uc_quantize.py",
+    "uc_soup.py",
+    "uc_cache.py",
+]
+
+
+def measure_import_time(module, python=sys.executable):
+    """
+    :return: cumulative import time of module in seconds, as reported by -X importtime
+    """
+    result = subprocess.run([python, "-X", "importtime", "-c", "import " + module], cwd=repository_root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    # lines look like 'import time:       self [us] |  cumulative | imported package'. The requested module is the
+    # last line with exactly its name, since a package is reported after all of its imports
+    for line in reversed(result.stderr.splitlines()):
+        if not line.startswith("import time:"):
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if parts[2] == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"no import time reported for {module}")
+
+
+def measure_help_time(entry_point, python=sys.executable):
+    """
+    :return: wall time in seconds of running entry_point with --help
+    """
+    start = time.perf_counter()
+    result = subprocess.run([python, entry_point, "--help"], cwd=repository_root, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    end = time.perf_counter()
+    if result.returncode != 0:
+        raise RuntimeError(f"{entry_point} --help failed:\n{result.stderr[-2000:]}")
+    return end - start
+
+
+def summarize(times):
+    return {"median": float(np.median(times)), "min": float(np.min(times)), "max": float(np.max(times)),
+            "repeats": len(times)}
+
+
+def run_benchmark(modules=default_modules, entry_points=default_entry_points, repeats=5):
+    results = {"python": sys.version.split()[0], "modules": {}, "entry_points": {}}
+    for module in modules:
+        try:
+            results["modules"][module] = summarize([measure_import_time(module) for _ in range(repeats)])
+        except RuntimeError as e:
+            results["modules"][module] = {"error": str(e).splitlines()[0]}
+    for entry_point in entry_points:
+        try:
+            results["entry_points"][entry_point] = summarize([measure_help_time(entry_point) for _ in range(repeats)])
+        except RuntimeError as e:
+            results["entry_points"][entry_point] = {"error": str(e).splitlines()[0]}
+    return results
+
+
+def print_results(results):
+    for section in ["modules", "entry_points"]:
+        print(f"\n{section}:")
+        for name, r in results[section].items():
+            if "error" in r:
+                print(f"  {name:<70s} {r['error']}")
+            else:
+                print(f"  {name:<70s} median {r['median']:7.3f}s (min {r['min']:.3f}s, max {r['max']:.3f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time benchmark of universalclassifier and its entry points")
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="fresh interpreters per measurement. Default: 5")
+    parser.add_argument("-m", "--modules", nargs="+", default=default_modules, help="modules to import")
+    parser.add_argument("-e", "--entry_points", nargs="+", default=default_entry_points,
+                        help="scripts (relative to the repository root) to run with --help")
+    parser.add_argument("-o", "--output_file", required=False, default=None, help="save the results as json")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.modules, args.entry_points, args.repeats)
+    print_results(results)
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
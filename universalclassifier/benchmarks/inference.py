@@ -0,0 +1,278 @@
+"""
+End-to-end inference benchmark on synthetic data, on the cpu.
+
+Generates synthetic multi-modality volumes (.nii.gz or .mha) with randomized shapes and spacings around those of
+prostate MRI, and a model folder with a plans.pkl and randomly initialized I3D checkpoints for a number of folds, in the
+layout of a grand challenge artifact. Then measures, for every number of folds and number of torch threads (intra-op
+threads of the forward pass, torch.set_num_threads):
+- predict_cases, for every batch size and number of preprocessing processes: throughput in cases/s (with and without
+  loading the model) and the time and peak memory of every stage (see universalclassifier.profiling)
+- predict_grand_challenge: latency of a single case, including loading the model
+
+No patient data and no gpu are needed, the results are saved as json so that runs can be compared.
+
+Usage: python -m universalclassifier.benchmarks.inference -o inference.json [--num_cases 8] [--batch_sizes 1 4]
+    [--folds 1 5] [--num_threads_preprocessing 1 4] [--torch_threads 1 4] [--image_size 20 300 300]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+task_name = "Task999_SyntheticBenchmark"
+trainer_name = "ClassifierTrainer"
+plans_identifier = "UniversalClassifierPlansv1.0"
+checkpoint_name = "model_final_checkpoint"
+
+
+def generate_case(rnd, num_modalities, shape, spacing):
+    """
+    :return: list with one volume of shape (z, y, x) per modality: a smooth ellipsoid 'body' with noise on a zero
+    background, so that cropping to the nonzero region has something to do
+    """
+    zz, yy, xx = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij")
+    body = (zz / 1.2) ** 2 + (yy / rnd.uniform(0.6, 0.9)) ** 2 + (xx / rnd.uniform(0.6, 0.9)) ** 2 < 1
+    volumes = []
+    for _ in range(num_modalities):
+        v = rnd.normal(rnd.uniform(200, 600), rnd.uniform(50, 150), size=shape) * body
+        volumes.append(np.clip(v, 0, None).astype(np.float32))
+    return volumes
+
+
+def write_synthetic_cases(folder, num_cases, num_modalities=1, file_format=".nii.gz", seed=12345):
+    """
+    Writes CASE_XXXX<file_format> files with shapes around (24, 384, 384) and spacings around (3, 0.5, 0.5) (z, y, x)
+    :return: list of lists with the image files of every case
+    """
+    import SimpleITK as sitk
+    rnd = np.random.RandomState(seed)
+    list_of_lists = []
+    for c in range(num_cases):
+        shape = (rnd.randint(18, 31), rnd.randint(320, 513), rnd.randint(320, 513))
+        spacing = (rnd.uniform(2.5, 3.6), rnd.uniform(0.3, 0.7), rnd.uniform(0.3, 0.7))
+        files = []
+        for m, v in enumerate(generate_case(rnd, num_modalities, shape, spacing)):
+            img = sitk.GetImageFromArray(v)
+            img.SetSpacing(spacing[::-1])  # sitk uses (x, y, z)
+            files.append(os.path.join(folder, "case_%03d_%04d%s" % (c, m, file_format)))
+            sitk.WriteImage(img, files[-1])
+        list_of_lists.append(files)
+    return list_of_lists
+
+
+def get_synthetic_plans(num_modalities, image_size, spacing):
+    """
+    :return: plans with the entries ClassifierTrainer and UniversalClassifierPreprocessor use, as written by
+    ClassificationExperimentPlanner3D, for a single binary classification label and no roi segmentation classes
+    """
+    from collections import OrderedDict
+    transpose_forward = [int(np.argmax(spacing))] + [i for i in range(3) if i != int(np.argmax(spacing))]
+    return {
+        'num_stages': 1,
+        'num_modalities': num_modalities,
+        'modalities': {i: "MRI" for i in range(num_modalities)},
+        'normalization_schemes': OrderedDict((i, "nonCT") for i in range(num_modalities)),
+        'dataset_properties': {'intensityproperties': None, 'all_classes': [1],
+                               'all_classification_labels': [{'name': 'quality',
+                                                              'values': {'0': 'insufficient', '1': 'sufficient'}}]},
+        'num_classes': 1,
+        'all_classes': [1],
+        'num_classification_classes': [2],
+        'all_classification_labels': [{'name': 'quality', 'values': {'0': 'insufficient', '1': 'sufficient'}}],
+        'use_mask_for_norm': OrderedDict((i, False) for i in range(num_modalities)),
+        'transpose_forward': transpose_forward,
+        'transpose_backward': [transpose_forward.index(i) for i in range(3)],
+        'data_identifier': "universal_classifier_plans_v1.0",
+        'plans_per_stage': {0: {'batch_size': 2, 'image_size': list(image_size), 'current_spacing': np.array(spacing),
+                                'do_dummy_2D_data_aug': False}},
+        'preprocessor_name': "UniversalClassifierPreprocessor",
+    }
+
+
+def write_synthetic_model(artifact_folder, num_folds, num_modalities, image_size, spacing, seed=12345):
+    """
+    Writes plans.pkl and a randomly initialized checkpoint for folds 0 .. num_folds - 1, as saved by
+    ClassifierTrainer.save_checkpoint, to <artifact_folder>/nnUNet/3d_fullres/<task>/<trainer>__<plans>
+    :return: model folder
+    """
+    import torch
+    from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_pickle
+    from universalclassifier.network_architecture.i3d.i3dpt import I3D
+
+    model_folder = join(artifact_folder, "nnUNet", "3d_fullres", task_name, trainer_name + "__" + plans_identifier)
+    maybe_mkdir_p(model_folder)
+    plans = get_synthetic_plans(num_modalities, image_size, spacing)
+    save_pickle(plans, join(model_folder, "plans.pkl"))
+    torch.manual_seed(seed)
+    for fold in range(num_folds):
+        fold_folder = join(model_folder, "fold_%d" % fold)
+        maybe_mkdir_p(fold_folder)
+        network = I3D(num_modalities + 1, plans['num_classification_classes'])
+        torch.save({'epoch': 0, 'state_dict': network.state_dict(), 'optimizer_state_dict': None},
+                   join(fold_folder, checkpoint_name + ".model"))
+        init = (join(model_folder, "plans.pkl"), fold, model_folder, None, True, True, False)
+        save_pickle({'init': init, 'name': trainer_name, 'class': trainer_name, 'plans': plans},
+                    join(fold_folder, checkpoint_name + ".model.pkl"))
+    return model_folder
+
+
+def run_predict_cases(model_folder, list_of_lists, output_folder, batch_size, num_folds, num_threads, torch_threads):
+    from universalclassifier.inference.predict import predict_cases
+    from universalclassifier.profiling import load_records, summarize_records
+
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    profile_file = os.path.join(output_folder, "profile.jsonl")
+    output_files = [os.path.join(output_folder, "case_%03d.npz" % c) for c in range(len(list_of_lists))]
+    start = time.perf_counter()
+    predict_cases(model_folder, list_of_lists, [None] * len(list_of_lists), output_files, list(range(num_folds)),
+                  mixed_precision=False, overwrite_existing=True, checkpoint_name=checkpoint_name,
+                  batch_size=batch_size, num_threads_preprocessing=num_threads, profile_file=profile_file)
+    total = time.perf_counter() - start
+
+    stages = summarize_records(load_records(profile_file))
+    load_model = stages.get("load_model", {}).get("total_s", 0.)
+    return {"batch_size": batch_size, "num_folds": num_folds, "num_threads_preprocessing": num_threads,
+            "torch_threads": torch_threads, "num_cases": len(list_of_lists), "total_s": total, "load_model_s": load_model,
+            "cases_per_s": len(list_of_lists) / total,
+            "cases_per_s_without_loading": len(list_of_lists) / max(total - load_model, 1e-9),
+            "stages": stages}
+
+
+def run_predict_grand_challenge(artifact_folder, list_of_lists, num_folds, torch_threads, work_folder):
+    from universalclassifier.inference.predict_grand_challenge import predict_grand_challenge
+    from universalclassifier.profiling import load_records, summarize_records
+
+    latencies = []
+    records = []
+    for it, files in enumerate(list_of_lists):
+        profile_file = os.path.join(work_folder, "profile_grand_challenge_%d.jsonl" % it)
+        start = time.perf_counter()
+        predict_grand_challenge(artifact_folder, files, folds=[str(f) for f in range(num_folds)],
+                                disable_mixed_precision=True, checkpoint_name=checkpoint_name,
+                                profile_file=profile_file)
+        latencies.append(time.perf_counter() - start)
+        records += load_records(profile_file)
+    return {"num_folds": num_folds, "torch_threads": torch_threads, "num_cases": len(list_of_lists),
+            "median_latency_s": float(np.median(latencies)),
+            "min_latency_s": float(np.min(latencies)), "max_latency_s": float(np.max(latencies)),
+            "stages": summarize_records(records)}
+
+
+def get_environment():
+    import torch
+    return {"python": sys.version.split()[0], "torch": torch.__version__, "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "torch_num_threads": torch.get_num_threads()}
+
+
+def run_benchmark(work_folder, num_cases=8, num_modalities=1, image_size=(20, 300, 300), spacing=(3., .5, .5),
+                  batch_sizes=(1, 4), folds=(1, 5), num_threads=(1, 4), torch_threads=None, file_format=".nii.gz",
+                  grand_challenge_cases=2, seed=12345):
+    """
+    :param num_threads: numbers of preprocessing processes
+    :param torch_threads: numbers of torch threads for the forward pass. Default: only torch's default
+    """
+    import torch
+    default_torch_threads = torch.get_num_threads()
+    torch_threads = [default_torch_threads] if torch_threads is None else torch_threads
+    artifact_folder = os.path.join(work_folder, "artifact")
+    input_folder = os.path.join(work_folder, "input")
+    os.makedirs(input_folder, exist_ok=True)
+    print(f"writing {num_cases} synthetic cases to {input_folder}")
+    list_of_lists = write_synthetic_cases(input_folder, num_cases, num_modalities, file_format, seed)
+    print(f"writing a random model with {max(folds)} folds to {artifact_folder}")
+    model_folder = write_synthetic_model(artifact_folder, max(folds), num_modalities, image_size, spacing, seed)
+
+    results = {"environment": get_environment(),
+               "config": {"num_cases": num_cases, "num_modalities": num_modalities, "image_size": list(image_size),
+                          "spacing": list(spacing), "file_format": file_format, "seed": seed},
+               "predict_cases": [], "predict_grand_challenge": []}
+    try:
+        for num_folds in folds:
+            for n_torch in torch_threads:
+                torch.set_num_threads(n_torch)
+                for batch_size in batch_sizes:
+                    for threads in num_threads:
+                        print(f"\n=== predict_cases: batch size {batch_size}, {num_folds} fold(s), {threads} "
+                              f"preprocessing process(es), {n_torch} torch thread(s)")
+                        results["predict_cases"].append(run_predict_cases(
+                            model_folder, list_of_lists, os.path.join(work_folder, "output"), batch_size, num_folds,
+                            threads, n_torch))
+                if grand_challenge_cases > 0:
+                    print(f"\n=== predict_grand_challenge: {num_folds} fold(s), {n_torch} torch thread(s)")
+                    results["predict_grand_challenge"].append(run_predict_grand_challenge(
+                        artifact_folder, list_of_lists[:grand_challenge_cases], num_folds, n_torch, work_folder))
+    finally:
+        torch.set_num_threads(default_torch_threads)
+    return results
+
+
+def print_results(results):
+    print("\npredict_cases:")
+    print("  %10s %6s %14s %13s %10s %18s %12s" % ("batch size", "folds", "preprocessing", "torch threads",
+                                                    "cases/s", "cases/s w/o load", "total s"))
+    for r in results["predict_cases"]:
+        print("  %10d %6d %14d %13d %10.3f %18.3f %12.1f" % (r["batch_size"], r["num_folds"],
+                                                            r["num_threads_preprocessing"], r["torch_threads"],
+                                                            r["cases_per_s"], r["cases_per_s_without_loading"],
+                                                            r["total_s"]))
+    if len(results["predict_grand_challenge"]) > 0:
+        print("\npredict_grand_challenge:")
+        print("  %6s %13s %18s" % ("folds", "torch threads", "median latency s"))
+        for r in results["predict_grand_challenge"]:
+            print("  %6d %13d %18.2f" % (r["num_folds"], r["torch_threads"], r["median_latency_s"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end cpu inference benchmark on synthetic volumes with a "
+                                                 "randomly initialized model")
+    parser.add_argument("-o", "--output_file", required=False, default=None, help="save the results as json")
+    parser.add_argument("--work_folder", required=False, default=None,
+                        help="folder for the synthetic data, model and predictions. Default: a temporary folder that "
+                             "is removed afterwards")
+    parser.add_argument("--num_cases", type=int, default=8, help="Default: 8")
+    parser.add_argument("--num_modalities", type=int, default=1, help="Default: 1")
+    parser.add_argument("--image_size", type=int, nargs=3, default=[20, 300, 300],
+                        help="planned image size (z, y, x). Default: 20 300 300, as planned for the quality "
+                             "classifier")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[3., .5, .5],
+                        help="planned spacing (z, y, x). Default: 3 0.5 0.5")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4], help="Default: 1 4")
+    parser.add_argument("--folds", type=int, nargs="+", default=[1, 5], help="numbers of folds. Default: 1 5")
+    parser.add_argument("--num_threads_preprocessing", type=int, nargs="+", default=[1, 4],
+                        help="numbers of preprocessing processes. Default: 1 4")
+    parser.add_argument("--torch_threads", type=int, nargs="+", default=None,
+                        help="numbers of torch threads for the forward pass (torch.set_num_threads). Default: torch's "
+                             "default")
+    parser.add_argument("--file_format", default=".nii.gz", choices=[".nii.gz", ".mha"], help="Default: .nii.gz")
+    parser.add_argument("--grand_challenge_cases", type=int, default=2,
+                        help="cases predicted one by one with predict_grand_challenge, per number of folds. 0 skips "
+                             "it. Default: 2")
+    parser.add_argument("--seed", type=int, default=12345)
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # cpu only, before torch is imported
+
+    work_folder = args.work_folder if args.work_folder is not None else tempfile.mkdtemp(prefix="uc_benchmark_")
+    try:
+        results = run_benchmark(work_folder, args.num_cases, args.num_modalities, args.image_size, args.spacing,
+                                args.batch_sizes, args.folds, args.num_threads_preprocessing, args.torch_threads,
+                                args.file_format, args.grand_challenge_cases, args.seed)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+    print_results(results)
+    if args.output_file is not None:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ import nnunet
 from batchgenerators.utilities.file_and_folder_operations import *
 
 from nnunet.configuration import default_num_threads
-from nnunet.training.model_restore import recursive_find_python_class
+from universalclassifier.training.model_restore import recursive_find_python_class
 from nnunet.experiment_planning.experiment_planner_baseline_3DUNet_v21 import ExperimentPlanner3D_v21
 import numpy as np
 
@@ -106,7 +106,7 @@ class ClassificationExperimentPlanner3D(ExperimentPlanner3D_v21):
         self.plans = plans
         self.save_my_plans()
 
-    def run_preprocessing(self, num_threads):
+    def run_preprocessing(self, num_threads, restrict_resampling_to_fov=False):
         # Remove any existing ground truth segmentations if present
         gt_seg_path = join(self.preprocessed_output_folder, "gt_segmentations")
         if os.path.isdir(gt_seg_path):
@@ -149,5 +149,6 @@ class ClassificationExperimentPlanner3D(ExperimentPlanner3D_v21):
             self.folder_with_cropped_data,
             self.preprocessed_output_folder,
             self.plans['data_identifier'],
-            num_threads
+            num_threads,
+            restrict_to_fov=restrict_resampling_to_fov
         )
\ No newline at end of file
@@ -24,7 +24,7 @@ import shutil
 import nnunet.utilities.shutil_sol as shutil_sol
 from nnunet.utilities.task_name_id_conversion import convert_id_to_task_name
 from nnunet.preprocessing.sanity_checks import verify_dataset_integrity as verify_dataset_integrity_original_function
-from nnunet.training.model_restore import recursive_find_python_class
+from universalclassifier.training.model_restore import recursive_find_python_class
 from nnunet.paths import *
 
 from universalclassifier.preprocessing import utils
@@ -53,7 +53,7 @@ def main(args):
 
     # Crop data
     print("Cropping...", flush=True)
-    crop(task_name, False, args.tf)
+    changed_cases = crop(task_name, False, args.tf)
 
     # Set up 3D planner
     planner_3d = find_planner(
@@ -69,7 +69,9 @@ def main(args):
 
     # Dataset Analysis
     print("Analyzing data...", flush=True)
-    dataset_analyzer = ClassificationDatasetAnalyzer(cropped_out_dir, overwrite=False, num_processes=args.tf)
+    # the dataset properties only need to be computed again if cases were added, changed or removed
+    dataset_analyzer = ClassificationDatasetAnalyzer(cropped_out_dir, overwrite=len(changed_cases) > 0,
+                                                     num_processes=args.tf)
     dataset_analyzer.analyze_dataset(collect_intensityproperties=True)  # Assume MRI intensity properties needed
 
     # Copy necessary files
@@ -81,7 +83,7 @@ def main(args):
     exp_planner = planner_3d(cropped_out_dir, preprocessing_output_dir_task)
     exp_planner.plan_experiment()
     if not args.no_pp:
-        exp_planner.run_preprocessing((args.tl, args.tf))
+        exp_planner.run_preprocessing((args.tl, args.tf), args.restrict_resampling_to_fov)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,15 +1,26 @@
 
+import os
 import shutil
+from collections import OrderedDict
+
 import nnunet.utilities.shutil_sol as shutil_sol
-from batchgenerators.utilities.file_and_folder_operations import join, isdir, maybe_mkdir_p
+from batchgenerators.utilities.file_and_folder_operations import join, isdir, isfile, maybe_mkdir_p
 from nnunet.configuration import default_num_threads
 from nnunet.paths import nnUNet_raw_data, nnUNet_cropped_data, preprocessing_output_dir
 from nnunet.experiment_planning.utils import create_lists_from_splitted_dataset
+from nnunet.preprocessing.cropping import get_case_identifier
 
 from universalclassifier.preprocessing.cropping import ClassificationImageCropper
+from universalclassifier.preprocessing.preprocessing_manifest import PreprocessingManifest, remove_case_outputs
 
 
 def crop(task_string, override=False, num_threads=default_num_threads, create_dummy_seg=False):
+    """
+    Crops the cases of the task that are new or whose images or roi segmentation changed since the last run (see
+    PreprocessingManifest), and removes the cropped data of cases that are no longer in dataset.json
+    :param override: remove all cropped data and crop every case again
+    :return: case ids that were cropped or removed
+    """
     cropped_out_dir = join(nnUNet_cropped_data, task_string)
     maybe_mkdir_p(cropped_out_dir)
 
@@ -20,6 +31,22 @@ def crop(task_string, override=False, num_threads=default_num_threads, create_du
     splitted_4d_output_dir_task = join(nnUNet_raw_data, task_string)
     lists, _ = create_lists_from_splitted_dataset(splitted_4d_output_dir_task)
 
+    case_files = OrderedDict((get_case_identifier(case), case) for case in lists)
+    manifest = PreprocessingManifest(cropped_out_dir)
+    to_crop, removed = manifest.find_changes(
+        case_files, {"cropper": ClassificationImageCropper.__name__},
+        is_complete=lambda c: isfile(join(cropped_out_dir, c + ".npz")) and isfile(join(cropped_out_dir, c + ".pkl")))
+    print("cropping %d new or changed cases, removing %d cases, %d cases are up to date" %
+          (len(to_crop), len(removed), len(case_files) - len(to_crop)))
+
+    for case_id in removed:
+        remove_case_outputs(cropped_out_dir, case_id)
+        gt_file = join(cropped_out_dir, "gt_segmentations", case_id + ".nii.gz")
+        if isfile(gt_file):
+            os.remove(gt_file)
+
     imgcrop = ClassificationImageCropper(num_threads, cropped_out_dir)
-    imgcrop.run_cropping(lists, overwrite_existing=override)
-    shutil_sol.copyfile(join(nnUNet_raw_data, task_string, "dataset.json"), cropped_out_dir)
\ No newline at end of file
+    imgcrop.run_cropping([case_files[c] for c in to_crop], overwrite_existing=True)
+    manifest.save()
+    shutil_sol.copyfile(join(nnUNet_raw_data, task_string, "dataset.json"), cropped_out_dir)
+    return to_crop + removed
\ No newline at end of file
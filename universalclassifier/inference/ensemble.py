@@ -0,0 +1,254 @@
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import combinations
+from typing import List
+
+import numpy as np
+import torch
+from torch.cuda.amp import autocast
+from nnunet.utilities.random_stuff import no_op
+from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
+
+from universalclassifier.profiling import profiling_enabled, stage
+from universalclassifier.training.model_restore import load_model_and_checkpoint_files
+
+
+def _synchronize():
+    # cuda kernels run asynchronously: wait for them, so that the time of a stage is spent in that stage
+    if profiling_enabled() and torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def get_mirror_axes(trainer, mirror_axes=None):
+    """
+    :param mirror_axes: if not None, the spatial axes (0, 1, 2) to mirror along instead of those used in training. Axes
+    that were not mirrored in training are allowed, but a warning is printed
+    :return: spatial axes the network was trained to be invariant to (data_aug_params['mirror_axes'] of the trainer),
+    empty if mirroring was not used in training
+    """
+    trained_axes = tuple(trainer.data_aug_params.get("mirror_axes", ())) \
+        if trainer.data_aug_params.get("do_mirror", True) else ()
+    if mirror_axes is None:
+        return trained_axes
+    mirror_axes = tuple(sorted(set(int(a) for a in mirror_axes)))
+    assert all(0 <= a <= 2 for a in mirror_axes), "mirror_axes must be spatial axes in [0, 1, 2]"
+    untrained = [a for a in mirror_axes if a not in trained_axes]
+    if len(untrained) > 0:
+        print(f"WARNING: mirroring along axes {untrained}, which were not mirrored in training")
+    return mirror_axes
+
+
+def get_mirror_variants(mirror_axes):
+    """
+    :return: every combination of mirror_axes that is flipped for test time augmentation, starting with the unflipped
+    case. 2 ** len(mirror_axes) variants
+    """
+    return [v for n in range(len(mirror_axes) + 1) for v in combinations(mirror_axes, n)]
+
+
+def stack_mirrored(data, variants):
+    """
+    :param data: torch tensor or numpy array of shape (b, c, x, y, z)
+    :return: the mirrored variants of data concatenated along the batch dimension, shape (len(variants) * b, ...)
+    """
+    flip_dims = [[a + 2 for a in v] for v in variants]
+    if isinstance(data, np.ndarray):
+        return np.ascontiguousarray(np.concatenate([np.flip(data, d) if d else data for d in flip_dims]))
+    return torch.cat([torch.flip(data, d) if d else data for d in flip_dims])
+
+
+def average_mirrored(output, num_variants):
+    """
+    :param output: network output of shape (num_variants * b, ...) for inputs stacked with stack_mirrored
+    :return: average over the variants, shape (b, ...)
+    """
+    return output.reshape(num_variants, -1, *output.shape[1:]).mean(0)
+
+
+class FoldEnsemble(object):
+    """
+    Keeps one network per fold resident in memory, so that predicting with the cross-validation ensemble is a single
+    call. This replaces calling trainer.load_checkpoint_ram for every fold and every case, which copies a full state
+    dict into trainer.network each time.
+    """
+
+    def __init__(self, trainer, params, freeze=True):
+        """
+        :param trainer: trainer as returned by load_model_and_checkpoint_files. trainer.network is used as template
+        :param params: list of fold checkpoints as returned by load_model_and_checkpoint_files
+        :param freeze: apply I3D.freeze_for_inference for the planned image size (same outputs, fewer passes over the
+        activations)
+        """
+        assert len(params) > 0, "need at least one fold checkpoint to build an ensemble"
+        self.networks = []
+        for checkpoint in params:
+            network = deepcopy(trainer.network)
+            network.load_state_dict(self._match_state_dict_keys(network, checkpoint['state_dict']))
+            network.eval()
+            if freeze:
+                network.freeze_for_inference(trainer.image_size)
+            self.networks.append(network)
+
+    @staticmethod
+    def _match_state_dict_keys(network, state_dict):
+        # same key handling as NetworkTrainer.load_checkpoint_ram: checkpoints saved from DataParallel have 'module.'
+        new_state_dict = OrderedDict()
+        curr_state_dict_keys = list(network.state_dict().keys())
+        for k, value in state_dict.items():
+            key = k
+            if key not in curr_state_dict_keys and key.startswith('module.'):
+                key = key[7:]
+            new_state_dict[key] = value
+        return new_state_dict
+
+    def __len__(self):
+        return len(self.networks)
+
+    def predict(self, data: np.ndarray, mixed_precision: bool = True, average: str = "logits",
+                return_cam: bool = False, cam_head: int = 0, cam_class: int = 0, mirror_axes=None):
+        """
+        :param data: preprocessed data of shape (b, c, x, y, z)
+        :param mixed_precision:
+        :param average: 'logits' averages the raw network outputs over the folds (as predict_cases does), 'softmax'
+        averages the softmax probabilities (as predict_grand_challenge does)
+        :param return_cam: if True, also return class activation maps computed from the mixed_5c features of the same
+        forward pass (see I3D.class_activation_map), averaged over the folds
+        :param mirror_axes: spatial axes (0, 1, 2) for mirroring test time augmentation, see get_mirror_axes. All
+        2 ** len(mirror_axes) mirrored variants of the batch are stacked into a single forward pass per fold and
+        averaged like the folds. Class activation maps are flipped back before averaging. None or () disables it
+        :param cam_head: classification head for the class activation maps
+        :param cam_class: class of cam_head for the class activation maps
+        :return: list with one array of shape (b, num_classes) per classification head. If return_cam, a tuple of that
+        list and the class activation maps of shape (b, x', y', z'), each scaled to [0, 1]
+        """
+        assert average in ("logits", "softmax"), "average must be 'logits' or 'softmax'"
+        if mixed_precision:
+            context = autocast
+        else:
+            context = no_op
+
+        data = maybe_to_torch(data)
+        if torch.cuda.is_available():
+            data = to_cuda(data)
+        variants = get_mirror_variants(mirror_axes or ())
+        if len(variants) > 1:
+            data = stack_mirrored(data, variants)
+
+        summed = None
+        summed_cam = None
+        with context():
+            with torch.no_grad():
+                for fold, network in enumerate(self.networks):
+                    with stage("forward_fold_%d" % fold, batch_size=data.shape[0]):
+                        features = network.forward_features(data)
+                        output = [o.float() for o in network.forward_head(features)]
+                        _synchronize()
+                    if average == "softmax":
+                        output = [torch.softmax(o, 1) for o in output]
+                    output = [average_mirrored(o, len(variants)) for o in output]
+                    summed = output if summed is None else [s + o for s, o in zip(summed, output)]
+                    if return_cam:
+                        with stage("cam"):
+                            cam = network.class_activation_map(features, cam_head)[:, cam_class].float()
+                            cam = torch.stack([torch.flip(c, [a + 1 for a in v]) if v else c
+                                               for c, v in zip(cam.chunk(len(variants)), variants)]).mean(0)
+                            _synchronize()
+                        summed_cam = cam if summed_cam is None else summed_cam + cam
+        pred = [(s / len(self.networks)).cpu().numpy() for s in summed]
+        if not return_cam:
+            return pred
+
+        cam = torch.clamp(summed_cam, min=0)
+        cam /= torch.clamp(cam.flatten(1).max(dim=1)[0], min=1e-8).view(-1, 1, 1, 1)
+        return pred, cam.cpu().numpy()
+
+    @staticmethod
+    def _is_decided(softmax, margin):
+        """
+        :param softmax: list with one tensor of shape (b, num_classes) per classification head
+        :return: bool tensor of shape (b,), True for the cases for which, in every head, the most likely class leads
+        the runner-up by at least 2 * margin. For a binary head this means that the probability of the positive class
+        is at least margin away from the decision threshold of 0.5
+        """
+        decided = None
+        for s in softmax:
+            top2 = torch.topk(s, 2, dim=1)[0]
+            head_decided = (top2[:, 0] - top2[:, 1]) >= 2 * margin
+            decided = head_decided if decided is None else decided & head_decided
+        return decided
+
+    def predict_early_exit(self, data: np.ndarray, margin: float, mixed_precision: bool = True,
+                           average: str = "logits", min_folds: int = 1, mirror_axes=None):
+        """
+        Evaluates the folds in order and stops, per case, as soon as the running average of the softmax over the folds
+        evaluated so far is decided for every classification head (see _is_decided), but not before min_folds folds.
+        Undecided cases continue with the next fold as a smaller batch. With margin > 0.5 all folds are always used,
+        and the result equals predict.
+        :param data: preprocessed data of shape (b, c, x, y, z)
+        :param margin: distance of the averaged softmax to the decision threshold at which the remaining folds are
+        skipped, in [0, 0.5]
+        :param average: see predict. The decision is always made on the averaged softmax
+        :param mirror_axes: see predict
+        :return: list with one array of shape (b, num_classes) per classification head (averaged over the folds that
+        were used for each case), array of shape (b,) with the number of folds used for every case
+        """
+        assert average in ("logits", "softmax"), "average must be 'logits' or 'softmax'"
+        assert 1 <= min_folds, "min_folds must be at least 1"
+        if mixed_precision:
+            context = autocast
+        else:
+            context = no_op
+
+        data = maybe_to_torch(data)
+        if torch.cuda.is_available():
+            data = to_cuda(data)
+
+        variants = get_mirror_variants(mirror_axes or ())
+        active = torch.arange(data.shape[0], device=data.device)
+        num_folds = torch.zeros(data.shape[0], dtype=torch.long, device=data.device)
+        summed = None
+        summed_softmax = None
+        with context():
+            with torch.no_grad():
+                for fold, network in enumerate(self.networks):
+                    inp = data[active]
+                    if len(variants) > 1:
+                        inp = stack_mirrored(inp, variants)
+                    with stage("forward_fold_%d" % fold, batch_size=inp.shape[0]):
+                        output = [o.float() for o in network(inp)]
+                        _synchronize()
+                    softmax = [average_mirrored(torch.softmax(o, 1), len(variants)) for o in output]
+                    if average == "softmax":
+                        output = softmax
+                    else:
+                        output = [average_mirrored(o, len(variants)) for o in output]
+                    if summed is None:
+                        summed = [torch.zeros((data.shape[0], o.shape[1]), device=o.device) for o in output]
+                        summed_softmax = [torch.zeros_like(s) for s in summed]
+                    for s, o in zip(summed, output):
+                        s[active] += o
+                    for s, o in zip(summed_softmax, softmax):
+                        s[active] += o
+                    num_folds[active] += 1
+
+                    if num_folds[active[0]] < min_folds:
+                        continue
+                    running = [s[active] / num_folds[active, None] for s in summed_softmax]
+                    active = active[~self._is_decided(running, margin)]
+                    if len(active) == 0:
+                        break
+        pred = [(s / num_folds[:, None]).cpu().numpy() for s in summed]
+        return pred, num_folds.cpu().numpy()
+
+
+def load_fold_ensemble(folder, folds=None, mixed_precision=None, checkpoint_name="model_final_checkpoint",
+                       freeze=True):
+    """
+    Restores the trainer (needed for preprocessing) and builds a FoldEnsemble with all requested folds resident.
+    :return: trainer, ensemble
+    """
+    trainer, params = load_model_and_checkpoint_files(folder, folds, mixed_precision=mixed_precision,
+                                                      checkpoint_name=checkpoint_name)
+    ensemble = FoldEnsemble(trainer, params, freeze)
+    del params
+    return trainer, ensemble
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join
+
+
+def load_training_dataset(trainer):
+    """
+    Loads the preprocessed training cases of the task into trainer.dataset (without splitting them)
+    """
+    trainer.folder_with_preprocessed_data = join(trainer.dataset_directory, trainer.plans['data_identifier'] +
+                                                 "_stage%d" % trainer.stage)
+    trainer.load_dataset()
+
+
+def split_for_fold_folder(trainer, fold_folder):
+    """
+    Sets trainer.dataset_tr and trainer.dataset_val to the split the model in fold_folder (fold_X, all or soup) was
+    trained on. A soup has seen all cases, like fold 'all'.
+    :return: name of the fold folder
+    """
+    fold_name = os.path.basename(fold_folder)
+    trainer.fold = "all" if fold_name in ("all", "soup") else int(fold_name[len("fold_"):])
+    trainer.do_split()
+    return fold_name
+
+
+def load_preprocessed_case(trainer, key):
+    """
+    :return: preprocessed case as the network gets it in ClassifierTrainer.validate, with batch dimension
+    """
+    data = np.load(trainer.dataset[key]['data_file'])['data']
+    return trainer.rescale_segmentation_channel(data)[None].astype(np.float32)
+
+
+def compute_metrics(targets, outputs, classification_labels):
+    """
+    Accuracy and AUC per classification label and value (one vs rest), as computed in ClassifierTrainer.validate
+    :param targets: (num_cases, num_labels)
+    :param outputs: list with one array of softmax outputs of shape (num_cases, num_values) per label
+    :return: dict with an entry "<label>: <value>" per label and value
+    """
+    from sklearn.metrics import accuracy_score, roc_auc_score
+    metrics = {}
+    for label_it, label in enumerate(classification_labels):
+        values = label['values']
+        preds = outputs[label_it].argmax(1)
+        for value in range(len(values)):
+            if len(values) == 2 and value == 0:
+                continue  # no need to compute the performance twice for binary labels
+            task_targets = targets[:, label_it] == value
+            title = f"{label['name']}: {values[str(value)]}"
+            metrics[title] = {"acc": float(accuracy_score(task_targets, preds == value))}
+            if 0 < task_targets.sum() < len(task_targets):
+                metrics[title]["auc"] = float(roc_auc_score(task_targets, outputs[label_it][:, value]))
+            else:
+                metrics[title]["auc"] = None  # undefined if the validation split contains only one class
+    return metrics
+
+
+def print_metric_differences(prefix, reference_name, reference, name, metrics):
+    """
+    Prints the metrics of compute_metrics for two models side by side, with the difference to the reference
+    """
+    for title in reference:
+        for metric in ["acc", "auc"]:
+            reference_value, value = reference[title][metric], metrics[title][metric]
+            difference = None if reference_value is None else value - reference_value
+            print(f"{prefix} {title} {metric}: {reference_name} {reference_value} {name} {value} "
+                  f"difference {difference}")
+
+
+def predict_softmax(network, cases):
+    outputs = []
+    with torch.no_grad():
+        for data in cases:
+            outputs.append([torch.softmax(o.float(), 1).numpy() for o in network(torch.from_numpy(data))])
+    return [np.concatenate(o) for o in zip(*outputs)]
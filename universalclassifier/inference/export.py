@@ -16,15 +16,26 @@
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
 
+from universalclassifier.profiling import stage
+
 
 def save_output(pred_categorical: List[np.ndarray],
                 pred_softmax: List[np.ndarray],
                 pred_softmax_npz_fname: str,
                 properties_dict: dict):
+    """
+    Both files are written to a temporary file first and then renamed, so an interrupted export never leaves a
+    partially written output behind. The .npz is renamed last: if it exists, the .pkl is complete as well.
+    """
     if pred_softmax_npz_fname is not None:
-        np.savez_compressed(pred_softmax_npz_fname,
-                            logits=pred_softmax,
-                            categorical=pred_categorical)
-        save_pickle(properties_dict, pred_softmax_npz_fname[:-4] + ".pkl")
+        with stage("export", case=os.path.basename(pred_softmax_npz_fname)[:-4]):
+            pkl_fname = pred_softmax_npz_fname[:-4] + ".pkl"
+            save_pickle(properties_dict, pkl_fname + ".tmp")
+            os.replace(pkl_fname + ".tmp", pkl_fname)
+            with open(pred_softmax_npz_fname + ".tmp", "wb") as f:  # a file object keeps savez from appending .npz
+                np.savez_compressed(f,
+                                    logits=pred_softmax,
+                                    categorical=pred_categorical)
+            os.replace(pred_softmax_npz_fname + ".tmp", pred_softmax_npz_fname)
 
 
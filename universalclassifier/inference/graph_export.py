@@ -0,0 +1,154 @@
+import inspect
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import *
+
+from universalclassifier.profiling import stage
+from universalclassifier.training.model_restore import get_fold_folders, restore_model
+
+# int8 graphs are created by quantization.quantize_model_folder
+graph_backends = {"torchscript": ".pt", "onnx": ".onnx", "int8": "_int8.pt"}
+
+
+class TupleOutputWrapper(torch.nn.Module):
+    """
+    I3D returns a list with one output per classification head. Tracing and ONNX export need a tuple.
+    """
+
+    def __init__(self, network):
+        super(TupleOutputWrapper, self).__init__()
+        self.network = network
+
+    def forward(self, inp):
+        return tuple(self.network(inp))
+
+
+def get_graph_file(fold_folder, checkpoint_name="model_final_checkpoint", backend="torchscript"):
+    assert backend in graph_backends, "backend must be one of %s" % list(graph_backends.keys())
+    return join(fold_folder, checkpoint_name + graph_backends[backend])
+
+
+def export_network(network, image_size, num_input_channels, output_file, backend="torchscript"):
+    """
+    Exports network for inputs of shape (b, num_input_channels, *image_size). The spatial shape is fixed in the graph
+    (the final average pooling depends on it), the batch dimension is not.
+    :param network: I3D
+    :param image_size: planned image size, see plans_per_stage[stage]['image_size']
+    :param num_input_channels: number of modalities + 1 for the roi segmentation
+    :param output_file:
+    :param backend: 'torchscript' saves a traced and frozen graph, 'onnx' an onnx graph (requires the onnx package)
+    """
+    assert backend in ("torchscript", "onnx"), "backend must be 'torchscript' or 'onnx'"
+    wrapper = TupleOutputWrapper(network).float().cpu().eval()
+    example = torch.zeros((1, num_input_channels, *image_size), dtype=torch.float32)
+    with torch.no_grad():
+        if backend == "torchscript":
+            # optimize_for_inference is applied after loading instead: its output depends on the device and cannot
+            # always be saved and loaded again
+            graph = torch.jit.freeze(torch.jit.trace(wrapper, example))
+            torch.jit.save(graph, output_file)
+        else:
+            num_heads = len(wrapper(example))
+            output_names = ["logits_%d" % i for i in range(num_heads)]
+            dynamic_axes = {name: {0: "batch"} for name in ["data"] + output_names}
+            kwargs = {}
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                kwargs["dynamo"] = False  # the traced exporter handles the fixed pooling kernel without extra setup
+            torch.onnx.export(wrapper, example, output_file, input_names=["data"], output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=13, **kwargs)
+    print("exported", output_file)
+
+
+def export_model_folder(folder, folds=None, checkpoint_name="model_final_checkpoint", backend="torchscript"):
+    """
+    Exports the network of every requested fold to fold_X/<checkpoint_name>.pt (or .onnx)
+    :return: list of exported files
+    """
+    from universalclassifier.inference.ensemble import load_fold_ensemble
+    trainer, ensemble = load_fold_ensemble(folder, folds, mixed_precision=False, checkpoint_name=checkpoint_name)
+    output_files = []
+    for fold_folder, network in zip(get_fold_folders(folder, folds), ensemble.networks):
+        output_file = get_graph_file(fold_folder, checkpoint_name, backend)
+        export_network(network, trainer.image_size, trainer.num_input_channels, output_file, backend)
+        output_files.append(output_file)
+    return output_files
+
+
+class GraphEnsemble(object):
+    """
+    Same interface as FoldEnsemble, for graphs exported with export_model_folder. Running them needs neither the
+    I3D definition nor the fold checkpoints. Class activation maps are not available.
+    """
+
+    def __init__(self, graph_files, backend="torchscript"):
+        assert backend in graph_backends, "backend must be one of %s" % list(graph_backends.keys())
+        assert len(graph_files) > 0, "need at least one exported graph to build an ensemble"
+        self.backend = backend
+        self.graphs = []
+        for f in graph_files:
+            assert isfile(f), "exported graph %s not found. Run uc_export.py (or uc_quantize.py for int8) first" % f
+            if backend == "int8":
+                # quantized kernels only run on the cpu
+                self.graphs.append(torch.jit.load(f, map_location=torch.device("cpu")).eval())
+            elif backend == "torchscript":
+                device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+                graph = torch.jit.load(f, map_location=device).eval()
+                if hasattr(torch.jit, "optimize_for_inference"):
+                    graph = torch.jit.optimize_for_inference(graph)
+                self.graphs.append(graph)
+            else:
+                try:
+                    import onnxruntime
+                except ImportError:
+                    raise ImportError("the onnx backend requires onnxruntime (pip install onnxruntime)")
+                self.graphs.append(onnxruntime.InferenceSession(f, providers=onnxruntime.get_available_providers()))
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def _run(self, graph, data):
+        if self.backend in ("torchscript", "int8"):
+            with torch.no_grad():
+                inp = torch.from_numpy(data)
+                if self.backend == "torchscript" and torch.cuda.is_available():
+                    inp = inp.cuda()
+                return [o.float().cpu().numpy() for o in graph(inp)]
+        return graph.run(None, {"data": data})
+
+    def predict(self, data: np.ndarray, mixed_precision: bool = True, average: str = "logits",
+                return_cam: bool = False, cam_head: int = 0, cam_class: int = 0, mirror_axes=None):
+        """
+        See FoldEnsemble.predict. mixed_precision is ignored: the graphs are exported in fp32 (or int8)
+        """
+        assert average in ("logits", "softmax"), "average must be 'logits' or 'softmax'"
+        assert not return_cam, "class activation maps need the pytorch backend"
+        from universalclassifier.inference.ensemble import average_mirrored, get_mirror_variants, stack_mirrored
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        variants = get_mirror_variants(mirror_axes or ())
+        if len(variants) > 1:
+            data = stack_mirrored(data, variants)
+        summed = None
+        for fold, graph in enumerate(self.graphs):
+            with stage("forward_fold_%d" % fold, batch_size=data.shape[0]):
+                output = self._run(graph, data)
+            if average == "softmax":
+                output = [np.exp(o - o.max(1, keepdims=True)) for o in output]
+                output = [o / o.sum(1, keepdims=True) for o in output]
+            output = [average_mirrored(o, len(variants)) for o in output]
+            summed = output if summed is None else [s + o for s, o in zip(summed, output)]
+        return [s / len(self.graphs) for s in summed]
+
+
+def load_graph_ensemble(folder, folds=None, checkpoint_name="model_final_checkpoint", backend="torchscript"):
+    """
+    Restores the trainer for preprocessing only (no network is built and no checkpoint is loaded) and builds a
+    GraphEnsemble from the exported graphs of the requested folds.
+    :return: trainer, ensemble
+    """
+    fold_folders = get_fold_folders(folder, folds)
+    trainer = restore_model(join(fold_folders[0], "%s.model.pkl" % checkpoint_name))
+    trainer.output_folder = folder
+    trainer.output_folder_base = folder
+    ensemble = GraphEnsemble([get_graph_file(f, checkpoint_name, backend) for f in fold_folders], backend)
+    return trainer, ensemble
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+
+from batchgenerators.utilities.file_and_folder_operations import *
+
+manifest_prefix = "prediction_manifest_part"
+
+
+def get_manifest_file(output_folder, part_id=0):
+    return join(output_folder, "%s%d.jsonl" % (manifest_prefix, part_id))
+
+
+def select_part(items, num_parts=1, part_id=0):
+    """
+    :return: the items of shard part_id out of num_parts (every num_parts-th item, starting at part_id). Every process
+    that sees the same items in the same order selects a disjoint part, without any coordination
+    """
+    assert num_parts >= 1, "num_parts must be at least 1"
+    assert 0 <= part_id < num_parts, "part_id must be in [0, num_parts)"
+    return items[part_id::num_parts]
+
+
+class RunManifest(object):
+    """
+    Append-only json lines log of the finished cases of a prediction run. A case is recorded only after its output has
+    been written completely, so when a run is resumed, cases that are not in the manifest are predicted again, even if
+    an output file exists (it may be left over from an older, interrupted run).
+
+    Every part of a sharded run writes its own manifest file (see get_manifest_file) and reads those of all parts in
+    the same folder, so a run can be resumed with a different number of parts. A truncated last line (from a process
+    that was killed while writing) is ignored.
+    """
+
+    def __init__(self, filename, run_info=None):
+        """
+        :param filename: manifest of this process
+        :param run_info: json serializable dict that is logged at the start of the run, e.g. model folder and part
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.done = {}
+        folder = os.path.dirname(filename)
+        for f in subfiles(folder if len(folder) > 0 else ".", prefix=manifest_prefix, suffix=".jsonl"):
+            self.done.update(self._read(f))
+        if isfile(filename) and os.path.getsize(filename) > 0:
+            with open(filename, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # terminate a truncated last line, so that the next record is readable
+        if run_info is not None:
+            self._append({"event": "start", "time": time.time(), **run_info})
+
+    @staticmethod
+    def _read(filename):
+        done = {}
+        with open(filename, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("event") == "done":
+                    done[record["case_id"]] = record["output_file"]
+        return done
+
+    def _append(self, record):
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def is_done(self, case_id, output_file):
+        return self.done.get(case_id) == os.path.basename(output_file) and isfile(output_file)
+
+    def mark_done(self, case_id, output_file):
+        self._append({"event": "done", "case_id": case_id, "output_file": os.path.basename(output_file),
+                      "time": time.time()})
+        with self.lock:
+            self.done[case_id] = os.path.basename(output_file)
@@ -1,33 +1,23 @@
 import os
-import shutil
-import nibabel as nib
 import numpy as np
 import torch
-import cv2
 from pathlib import Path
 from batchgenerators.utilities.file_and_folder_operations import *
-from universalclassifier.training.model_restore import load_model_and_checkpoint_files
+from universalclassifier.inference.ensemble import get_mirror_axes, load_fold_ensemble
+from universalclassifier.inference.graph_export import load_graph_ensemble
 from universalclassifier.inference.export import save_output
+from universalclassifier.inference.manifest import RunManifest, get_manifest_file, select_part
+from universalclassifier.inference.prediction_cache import PredictionCache, get_input_key, get_model_fingerprint
+from universalclassifier.profiling import print_summary, profiling, set_case, stage
+from universalclassifier.inference.result_store import ResultStore
+from universalclassifier.inference.visualization import plot_or_save_slices, overlay_heatmap, save_overlay_mosaics
 from typing import Union, Tuple, List
-from copy import deepcopy
-import SimpleITK as sitk
-# Install scipy if not already installed
-import subprocess
-import sys
-from matplotlib import pyplot as plt
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
 import warnings
 
 warnings.filterwarnings("ignore")
 
-try:
-    import scipy
-except ImportError:
-    print("scipy not found. Installing scipy...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "scipy"])
-    import scipy  # Import again after installation
-
-from scipy.ndimage import zoom
-
 
 class ModelWrapper(torch.nn.Module):
     def __init__(self, model):
@@ -36,327 +26,580 @@ class ModelWrapper(torch.nn.Module):
         self.feature_maps = None
         self.gradients = None
         self.hook = self.model.mixed_3b.register_forward_hook(self.save_feature_maps)
-        self.hook_backward = self.model.mixed_3b.register_backward_hook(self.save_gradients)
 
     def save_feature_maps(self, module, input, output):
-        self.feature_maps = output
+        # Cut the graph at mixed_3b: only the part of the network after the feature maps is needed for Grad-CAM, so
+        # no activations before mixed_3b are kept for the backward pass.
+        self.feature_maps = output.detach().requires_grad_(True)
+        return self.feature_maps
 
-    def save_gradients(self, module, grad_input, grad_output):
-        self.gradients = grad_output[0]
+    def remove(self):
+        self.hook.remove()
 
     def forward(self, x):
         output = self.model(x)
         return output
 
 
-def plot_or_save_slices(image, path=None):
+def generate_grad_cam(model, input_tensor, target_class, head=0):
     """
-    Plots or saves a grid of slices from a 3D or 4D image.
+    Computes Grad-CAM heatmaps on the mixed_3b feature maps for a batch of cases in a single forward and backward pass.
 
-    Parameters:
-    - image: 3D or 4D numpy array representing the image.
-    - path: Optional. If provided, the grid will be saved to this path instead of being plotted.
+    :param model: ModelWrapper around the network
+    :param input_tensor: preprocessed data of shape (b, c, x, y, z) or (c, x, y, z)
+    :param target_class: class of the classification head for which the heatmap is computed
+    :param head: index of the classification head
+    :return: heatmaps of shape (b, x', y', z') at the resolution of mixed_3b, each scaled to [0, 1]
     """
-    if image.ndim not in [3, 4]:
-        raise ValueError("Input image must be a 3D or 4D array")
-
-    if image.ndim == 4 and image.shape[3] != 3:
-        raise ValueError("For 4D input, the last dimension must be 3 (RGB channels)")
-
-    # Identify the dimension with the smallest length
-    min_dim = np.argmin(image.shape[:3])
-
-    if min_dim == 0:
-        num_slices = image.shape[0]
-        if image.ndim == 3:
-            slice_func = lambda img, idx: img[idx, :, :]
-        else:
-            slice_func = lambda img, idx: img[idx, :, :, :]
-    elif min_dim == 1:
-        num_slices = image.shape[1]
-        if image.ndim == 3:
-            slice_func = lambda img, idx: img[:, idx, :]
-        else:
-            slice_func = lambda img, idx: img[:, idx, :, :]
-    else:
-        num_slices = image.shape[2]
-        if image.ndim == 3:
-            slice_func = lambda img, idx: img[:, :, idx]
-        else:
-            slice_func = lambda img, idx: img[:, :, idx, :]
-
-    num_cols = int(np.ceil(np.sqrt(num_slices)))
-    num_rows = int(np.ceil(num_slices / num_cols))
-
-    fig, axes = plt.subplots(num_rows, num_cols, figsize=(10, 10))
-    fig.subplots_adjust(wspace=0.1, hspace=0.1)
-
-    for i in range(num_rows):
-        for j in range(num_cols):
-            slice_index = i * num_cols + j
-            if slice_index < num_slices:
-                axes[i, j].imshow(slice_func(image, slice_index), cmap='gray' if image.ndim == 3 else None)
-                axes[i, j].axis('off')
-            else:
-                axes[i, j].axis('off')
-
-    if path is None:
-        plt.show()
-    else:
-        plt.savefig(path, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
-
-
-def generate_grad_cam(model, input_tensor, target_class):
     model.eval()
-    input_tensor = input_tensor.unsqueeze(0)  # Add batch dimension
-    input_tensor.requires_grad_(True)
+    if input_tensor.ndim == 4:
+        input_tensor = input_tensor.unsqueeze(0)  # Add batch dimension
 
     # Move input tensor to the same device as the model
     input_tensor = input_tensor.to(next(model.parameters()).device)
 
-    output = model(input_tensor)
+    with torch.enable_grad():
+        output = model(input_tensor)[head]
+        # cases in a batch do not interact in eval mode, so the gradient of the sum gives every case its own gradient
+        target = output[:, target_class].sum()
+        model.gradients = torch.autograd.grad(target, model.feature_maps)[0]
 
-    # Ensure output is a tensor, not a list
-    if isinstance(output, list):
-        output = output[0]  # Assuming the first element is the relevant output
-
-    target = output[0, target_class]
-    target.backward()
-
-    gradients = model.gradients
-    pooled_gradients = torch.mean(gradients, dim=[0, 2, 3, 4])
+    pooled_gradients = torch.mean(model.gradients, dim=[2, 3, 4], keepdim=True)
     feature_maps = model.feature_maps.detach()
 
-    for i in range(feature_maps.size(1)):
-        feature_maps[:, i, :, :, :] *= pooled_gradients[i]
-
-    heatmap = torch.mean(feature_maps, dim=1).squeeze()
-    heatmap = torch.maximum(heatmap, torch.tensor(0.0).to(heatmap.device))
-    heatmap /= torch.max(heatmap)
+    heatmap = torch.mean(feature_maps * pooled_gradients, dim=1)
+    heatmap = torch.clamp(heatmap, min=0)
+    heatmap /= torch.clamp(heatmap.flatten(1).max(dim=1)[0], min=1e-8).view(-1, 1, 1, 1)
 
     return heatmap.cpu().numpy()
 
 
-def overlay_heatmap(image, heatmap):
-    # Calculate the zoom factors for each dimension
-    zoom_factors = (
-        image.shape[0] / heatmap.shape[0],
-        image.shape[1] / heatmap.shape[1],
-        image.shape[2] / heatmap.shape[2]
-    )
-
-    # Resize heatmap using 3D interpolation
-    heatmap_resized = zoom(heatmap, zoom_factors, order=1)
-
-    # Ensure the resized heatmap has the same shape as the image
-    assert heatmap_resized.shape == image.shape, "Resized heatmap shape does not match image shape"
-
-    # Initialize the colored heatmap array
-    heatmap_colored = np.zeros((image.shape[0], image.shape[1], image.shape[2], 3), dtype=np.uint8)
-
-    # Convert each slice of the heatmap to uint8 and apply color map
-    for z in range(image.shape[2]):
-        heatmap_slice = np.uint8(255 * (1 - heatmap_resized[:, :, z]))
-        heatmap_colored[:, :, z, :] = cv2.applyColorMap(heatmap_slice, cv2.COLORMAP_JET)
-
-    # Convert image to uint8 if it's not already
-    if image.dtype != np.uint8:
-        image = np.uint8(255 * (image - image.min()) / (image.max() - image.min()))
+def find_mha_cases_in_patient_folders(patient_folder_root: str, modality: str):
+    """
+    Collects the .mha scans listed in patient_folder_root/subject_list.txt. The scans are read directly by SimpleITK
+    during preprocessing, so no intermediate .nii.gz copies are written.
 
-    opacity = heatmap_resized / heatmap_resized.max()
+    :param patient_folder_root: folder with one folder per patient and a subject_list.txt with one PATIENTID_STUDYID
+    per line
+    :param modality: 'DWI' (reads *_hbv.mha) or 'T2W' (reads *_t2w.mha)
+    :return: case_ids, list_of_lists with one single-modality file list per case
+    """
+    mha_suffixes = {'DWI': 'hbv', 'T2W': 't2w'}
+    if modality not in mha_suffixes:
+        raise ValueError(f"Unknown modality {modality}. Expected one of {list(mha_suffixes.keys())}")
 
-    # Superimpose the heatmap on the image
-    superimposed_img = np.round(heatmap_colored * opacity[..., np.newaxis] * 0.7 + image[..., np.newaxis]).astype(
-        np.uint8)
+    subject_list_path = Path(patient_folder_root) / 'subject_list.txt'
+    # Read the subject list file and process each patient/study
+    with open(subject_list_path, 'r') as f:
+        subject_list = f.read().splitlines()
 
-    superimposed_img = np.clip(superimposed_img, 0, 255)
+    case_ids = []
+    list_of_lists = []
+    for subject in subject_list:
+        patient_id, study_id = subject.split('_')
+        patient_folder = Path(patient_folder_root) / patient_id
 
-    return superimposed_img
+        if not patient_folder.is_dir():
+            print(f"Patient folder not found for {patient_id}. Skipping.")
+            continue
 
+        mha_path = patient_folder / f"{patient_id}_{study_id}_{mha_suffixes[modality]}.mha"
+        if not mha_path.exists():
+            print(f"{mha_suffixes[modality].upper()} file not found for patient {patient_id} and study {study_id}")
+            continue
 
-def convert_mha_to_nii_gz(mha_path, output_path):
-    image = sitk.ReadImage(str(mha_path))
-    sitk.WriteImage(image, str(output_path))
+        case_ids.append(f"{patient_id}_{study_id}")
+        list_of_lists.append([str(mha_path)])
+    print(f"Found {len(case_ids)} cases in {patient_folder_root}")
+    return case_ids, list_of_lists
 
 
-def process_input_folder(patient_folder: str, patient_id: str, study_id: str, input_folder: str, modality: str):
-    """Processes a patient folder, converting the HBV file to .nii.gz format."""
-    if modality == 'DWI':
-        hbv_mha_path = Path(patient_folder) / f"{patient_id}_{study_id}_hbv.mha"
-    if modality == 'T2W':
-        hbv_mha_path = Path(patient_folder) / f"{patient_id}_{study_id}_t2w.mha"
-    if hbv_mha_path.exists():
-        hbv_nii_path = Path(input_folder) / f"{patient_id}_{study_id}_0000.nii.gz"
-        convert_mha_to_nii_gz(hbv_mha_path, hbv_nii_path)
-        return hbv_nii_path
-    else:
-        print(f"HBV file not found for patient {patient_id} and study {study_id}")
+def split_case_filename(filename, suffix=".nii.gz"):
+    """
+    :return: case_id, modality index of a CASE_XXXX<suffix> file name (XXXX is the zero padded modality), or None if
+    the name does not follow this scheme
+    """
+    if not filename.endswith(suffix):
+        return None
+    name = filename[:-len(suffix)]
+    case_id, _, modality = name.rpartition("_")
+    if len(case_id) == 0 or len(modality) != 4 or not modality.isdigit():
         return None
+    return case_id, int(modality)
 
 
-def check_input_folder_and_return_caseIDs(input_folder, expected_num_modalities):
+def iterate_cases_in_folder(input_folder, expected_num_modalities, suffix=".nii.gz", unexpected=None,
+                            incomplete=None):
+    """
+    Streams the cases of input_folder in a single os.scandir pass, without listing or sorting the folder first. A case
+    is yielded as soon as its files of all expected modalities have been seen, so the first cases are available right
+    away, even for folders with a very large number of files. Cases are yielded in directory order.
+
+    :param unexpected: if a list is given, the names of <suffix> files that do not belong to a case (wrong name or
+    modality index) are appended to it
+    :param incomplete: if a dict is given, it is filled with case_id: names of the missing files of every case that
+    is still incomplete after the whole folder has been scanned
+    :return: generator of case_id, [files of modality 0, 1, ...] (full paths)
+    """
+    pending = {}  # case_id: [file or None per modality], only for cases of which not all modalities were seen yet
+    with os.scandir(input_folder) as it:
+        for entry in it:
+            if not entry.name.endswith(suffix) or not entry.is_file():
+                continue
+            parsed = split_case_filename(entry.name, suffix)
+            if parsed is None or parsed[1] >= expected_num_modalities:
+                if unexpected is not None:
+                    unexpected.append(entry.name)
+                continue
+            case_id, modality = parsed
+            files = pending.setdefault(case_id, [None] * expected_num_modalities)
+            files[modality] = entry.path
+            if all(f is not None for f in files):
+                del pending[case_id]
+                yield case_id, files
+    if incomplete is not None:
+        for case_id, files in pending.items():
+            incomplete[case_id] = [case_id + "_%04.0d" % n + suffix for n, f in enumerate(files) if f is None]
+
+
+def get_cases_in_folder(input_folder, expected_num_modalities, suffix=".nii.gz"):
+    """
+    Finds and validates all cases of input_folder in a single pass, see iterate_cases_in_folder
+    :return: case_ids (sorted, so that all processes of a sharded run see the same order), list_of_lists with the
+    files of every case in modality order
+    """
     print("This model expects %d input modalities for each image" % expected_num_modalities)
-    files = subfiles(input_folder, suffix=".nii.gz", join=False, sort=True)
+    unexpected = []
+    incomplete = {}
+    cases = sorted(iterate_cases_in_folder(input_folder, expected_num_modalities, suffix, unexpected, incomplete),
+                   key=lambda c: c[0])
 
-    maybe_case_ids = np.unique([i[:-12] for i in files])
+    assert len(cases) + len(incomplete) > 0, \
+        "input folder did not contain any images (expected to find %s file endings)" % suffix
 
-    remaining = deepcopy(files)
-    missing = []
+    case_ids = [c for c, _ in cases]
+    print("Found %d unique case ids, here are some examples:" % len(case_ids), case_ids[:10])
+    print("If they don't look right, make sure to double check your filenames. They must end with _0000%s etc" %
+          suffix)
 
-    assert len(files) > 0, "input folder did not contain any images (expected to find .nii.gz file endings)"
+    if len(unexpected) > 0:
+        print("found %d unexpected remaining files in the folder. Here are some examples:" % len(unexpected),
+              unexpected[:10])
 
-    # now check if all required files are present and that no unexpected files are remaining
-    for c in maybe_case_ids:
-        for n in range(expected_num_modalities):
-            expected_output_file = c + "_%04.0d.nii.gz" % n
-            if not isfile(join(input_folder, expected_output_file)):
-                missing.append(expected_output_file)
-            else:
-                remaining.remove(expected_output_file)
-
-    print("Found %d unique case ids, here are some examples:" % len(maybe_case_ids),
-          np.random.choice(maybe_case_ids, min(len(maybe_case_ids), 10)))
-    print("If they don't look right, make sure to double check your filenames. They must end with _0000.nii.gz etc")
-
-    if len(remaining) > 0:
-        print("found %d unexpected remaining files in the folder. Here are some examples:" % len(remaining),
-              np.random.choice(remaining, min(len(remaining), 10)))
-
-    if len(missing) > 0:
+    if len(incomplete) > 0:
         print("Some files are missing:")
-        print(missing)
+        print([f for missing in incomplete.values() for f in missing])
         raise RuntimeError("missing files in input_folder")
 
-    return maybe_case_ids
+    return case_ids, [files for _, files in cases]
+
+
+def check_input_folder_and_return_caseIDs(input_folder, expected_num_modalities):
+    return get_cases_in_folder(input_folder, expected_num_modalities)[0]
 
 
 def predict_from_folder(model: str, patient_folder_root: str, output_folder: str,
                         folds: Union[Tuple[int], List[int]], mixed_precision: bool = True,
                         overwrite_existing: bool = True, checkpoint_name: str = "model_final_checkpoint",
-                        folders_format: bool = True, modality: str = ''):
-    """Predicts from a folder of patient folders based on a subject list file."""
+                        folders_format: bool = True, modality: str = '', batch_size: int = 1,
+                        num_threads_preprocessing: int = 6, num_threads_export: int = 1, explain: str = "none",
+                        explain_method: str = "gradcam", render_backend: str = "mosaic",
+                        heatmap_downsample: int = 1, backend: str = "pytorch", early_exit_margin: float = None,
+                        do_tta: bool = False, result_store: str = None, num_parts: int = 1, part_id: int = 0,
+                        cache_dir: str = None, cache_max_size: int = 10 * 1024 ** 3, profile_file: str = None,
+                        restrict_resampling_to_fov: bool = False, mirror_axes: Tuple[int] = None):
+    """
+    Predicts from a folder of patient folders based on a subject list file.
+    :param num_parts: split the cases into num_parts shards, e.g. one per node. Every part writes its own run manifest
+    (and result store) in output_folder, see RunManifest
+    :param part_id: shard predicted by this process, in [0, num_parts)
+    """
     maybe_mkdir_p(output_folder)
 
     if folders_format:
-        input_folder = Path("temp_nifti_inputs")
-        maybe_mkdir_p(input_folder)
-        subject_list_path = Path(patient_folder_root) / 'subject_list.txt'
-        # Read the subject list file and process each patient/study
-        with open(subject_list_path, 'r') as f:
-            subject_list = f.read().splitlines()
-        for subject in subject_list:
-            patient_id, study_id = subject.split('_')
-            patient_folder = Path(patient_folder_root) / patient_id
-
-            if not patient_folder.is_dir():
-                print(f"Patient folder not found for {patient_id}. Skipping.")
-                continue
-
-            hbv_nii_file = process_input_folder(patient_folder, patient_id, study_id, input_folder, modality)
-            if not hbv_nii_file:
-                continue  # Skip if HBV file was not found or converted
+        case_ids, list_of_lists = find_mha_cases_in_patient_folders(patient_folder_root, modality)
     else:
         input_folder = patient_folder_root  # Comment to infere in Folder of patient folders
 
-    # After conversions, check input folder integrity and predict
-    case_ids = check_input_folder_and_return_caseIDs(input_folder, 1)  # Assuming only HBV modality for simplicity
+        # check input folder integrity and group the files by case id
+        expected_num_modalities = load_pickle(join(model, "plans.pkl"))['num_modalities']
+        case_ids, list_of_lists = get_cases_in_folder(input_folder, expected_num_modalities)
 
-    output_files = [join(output_folder, f"{i}.npz") for i in case_ids]
-    all_files = subfiles(input_folder, suffix=".nii.gz", join=False, sort=True)
-    list_of_lists = [[join(input_folder, i) for i in all_files if i.startswith(case_id)] for case_id in case_ids]
+    if num_parts > 1:
+        case_ids = select_part(list(case_ids), num_parts, part_id)
+        list_of_lists = select_part(list_of_lists, num_parts, part_id)
+        print(f"part {part_id} of {num_parts}: {len(case_ids)} cases")
+        if result_store is not None:
+            # SQLite files should not be written by several processes (or nodes) at the same time
+            base, ext = os.path.splitext(result_store)
+            result_store = f"{base}_part{part_id}{ext}"
 
+    output_files = [join(output_folder, f"{i}.npz") for i in case_ids]
     seg_files = [None] * len(case_ids)  # Assuming no segmentation files are provided for inference
+    manifest_file = get_manifest_file(output_folder, part_id) if result_store is None else None
 
     # Run predictions
     predict_cases(model, list_of_lists, seg_files, output_files, folds, mixed_precision=mixed_precision,
-                  overwrite_existing=overwrite_existing, checkpoint_name=checkpoint_name)
-
-    # Clean up temporary input folder after predictions
-    if folders_format:
-        shutil.rmtree(Path("temp_nifti_inputs"), ignore_errors=True)
+                  overwrite_existing=overwrite_existing, checkpoint_name=checkpoint_name, batch_size=batch_size,
+                  num_threads_preprocessing=num_threads_preprocessing, num_threads_export=num_threads_export,
+                  explain=explain, explain_method=explain_method, render_backend=render_backend,
+                  heatmap_downsample=heatmap_downsample, backend=backend, early_exit_margin=early_exit_margin,
+                  do_tta=do_tta, result_store=result_store, manifest_file=manifest_file, cache_dir=cache_dir,
+                  cache_max_size=cache_max_size, profile_file=profile_file,
+                  restrict_resampling_to_fov=restrict_resampling_to_fov, mirror_axes=mirror_axes)
+
+
+def preprocess_save_to_queue(trainer, q, list_of_lists, seg_filenames, output_files):
+    errors_in = []
+    for input_files, seg_file, output_file in zip(list_of_lists, seg_filenames, output_files):
+        try:
+            print(f"=== Preprocessing {input_files}, {seg_file}:")
+            set_case(os.path.basename(output_file)[:-len(".npz")])
+            with stage("preprocess"):
+                d, s, properties = trainer.preprocess_patient(input_files, seg_file)
+                d = trainer.combine_data_and_seg(d, s)
+            q.put((output_file, (d, properties)))
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except Exception as e:
+            print("error in", input_files)
+            print(e)
+            errors_in.append(input_files)
+    q.put("end")
+    if len(errors_in) > 0:
+        print("There were some errors in the following cases:", errors_in)
+        print("These cases were ignored.")
+    else:
+        print("This worker has ended successfully, no errors to report")
 
 
-def predict_cases(model, list_of_lists_of_modality_filenames, seg_filenames, output_filenames, folds,
-                  mixed_precision=True, overwrite_existing=False, checkpoint_name="model_final_checkpoint"):
-    assert len(list_of_lists_of_modality_filenames) == len(output_filenames)
-    assert len(list_of_lists_of_modality_filenames) == len(seg_filenames)
-
-    cleaned_output_files = []
-    for o in output_filenames:
-        dr, f = os.path.split(o)
-        if len(dr) > 0:
-            maybe_mkdir_p(dr)
-        if not f.endswith(".npz"):
-            f, _ = os.path.splitext(f)
-            f = f + ".npz"
-        cleaned_output_files.append(join(dr, f))
-
-    if not overwrite_existing:
-        print("number of cases:", len(list_of_lists_of_modality_filenames))
-        not_done_idx = [i for i, j in enumerate(cleaned_output_files) if not isfile(j)]
-
-        cleaned_output_files = [cleaned_output_files[i] for i in not_done_idx]
-        list_of_lists_of_modality_filenames = [list_of_lists_of_modality_filenames[i] for i in not_done_idx]
-        seg_filenames = [seg_filenames[i] for i in not_done_idx]
-
-        print("number of cases that still need to be predicted:", len(cleaned_output_files))
-
-    print("emptying cuda cache")
-    torch.cuda.empty_cache()
-
-    print("loading parameters for folds,", folds)
-    trainer, params = load_model_and_checkpoint_files(model, folds, mixed_precision=mixed_precision,
-                                                      checkpoint_name=checkpoint_name)
-
-    for input_files, seg_file, output_filename in zip(list_of_lists_of_modality_filenames,
-                                                      seg_filenames, output_filenames):
-
-        print(f"=== Processing {input_files}, {seg_file}:")
-        print("preprocessing...")
-        d, s, properties = trainer.preprocess_patient(input_files, seg_file)
-        d = trainer.combine_data_and_seg(d, s)
-
-        print("predicting...")
-        trainer.load_checkpoint_ram(params[0], False)
-        pred = trainer.predict_preprocessed_data_return_pred_and_logits(d[None], mixed_precision=mixed_precision)[1]
-
-        for p in params[1:]:
-            trainer.load_checkpoint_ram(p, False)
-            new_pred = \
-                trainer.predict_preprocessed_data_return_pred_and_logits(d[None], mixed_precision=mixed_precision)[1]
-            pred = [p + n_p for p, n_p in zip(pred, new_pred)]
-
-        if len(params) > 1:
-            pred = [p / len(params) for p in pred]
-
-        print("exporting prediction...")
-        categorical_output = [np.argmax(p) for p in pred]
-        save_output(categorical_output, pred, output_filename, properties)
+def preprocess_multithreaded(trainer, list_of_lists, seg_filenames, output_files, num_processes=2):
+    """
+    Preprocesses the cases in num_processes worker processes while the caller consumes them. The bounded queue keeps
+    the workers at most a few cases ahead of the network, so memory use does not grow with the number of cases.
+    Yields (output_file, (data, properties)) in the order in which the workers finish.
+    """
+    num_processes = max(1, min(len(list_of_lists), num_processes))
+
+    q = Queue(1)
+    processes = []
+    for i in range(num_processes):
+        pr = Process(target=preprocess_save_to_queue, args=(trainer, q,
+                                                            list_of_lists[i::num_processes],
+                                                            seg_filenames[i::num_processes],
+                                                            output_files[i::num_processes]))
+        pr.start()
+        processes.append(pr)
+
+    try:
+        end_ctr = 0
+        while end_ctr != num_processes:
+            item = q.get()
+            if item == "end":
+                end_ctr += 1
+                continue
+            else:
+                yield item
 
-        # Generate and overlay Grad-CAM heatmap on preprocessed image
-        model_wrapper = ModelWrapper(trainer.network).to(next(trainer.network.parameters()).device)
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()  # this should not happen but better safe than sorry right
+            p.join()
 
-        target_class = 0  # np.argmax(pred[0])
-        input_tensor = torch.tensor(d)
+        q.close()
 
-        heatmap = generate_grad_cam(model_wrapper, input_tensor, target_class)
 
-        # Print shape for troubleshooting
-        print(f"Preprocessed image shape (d): {d.shape}, Heatmap shape: {heatmap.shape}")
+def save_explanation(d, heatmap, output_filename, render_backend="mosaic", downsample=1):
+    """
+    Saves the heatmap overlay and the image itself as slice grids next to output_filename.
+    :param render_backend: 'mosaic' tiles the slices into one array and encodes it with cv2 (thread safe, no figure
+    creation). 'matplotlib' draws a subplot grid, downsample is ignored
+    :param downsample: downsampling factor of the slices in the mosaic, e.g. for thumbnails
+    """
+    # Ensure heatmap and preprocessed image (d) have the correct dimensions
+    if heatmap.ndim != 3 or d.ndim != 4:
+        raise ValueError("Heatmap must be 3D and preprocessed image must be 4D (with channel dimension)")
 
-        # Ensure heatmap and preprocessed image (d) have the correct dimensions
-        if heatmap.ndim != 3 or d.ndim != 4:
-            raise ValueError("Heatmap must be 3D and preprocessed image must be 4D (with channel dimension)")
+    # Remove channel dimension for visualization
+    d = d[0]  # Assuming d has shape (1, depth, height, width)
 
-        # Remove channel dimension for visualization
-        d = d[0]  # Assuming d has shape (1, depth, height, width)
+    heatmap_output_path = output_filename.replace('.npz', f'_Heatmap.jpg')
+    image_output_path = output_filename.replace('.npz', f'_Image.jpg')
 
+    if render_backend == "mosaic":
+        save_overlay_mosaics(d, heatmap, heatmap_output_path, image_output_path, downsample)
+    else:
         heatmap_image = overlay_heatmap(d, heatmap)
-
-        heatmap_output_path = output_filename.replace('.npz', f'_Heatmap.jpg')
-        image_output_path = output_filename.replace('.npz', f'_Image.jpg')
-        # cv2.imwrite(heatmap_output_path, heatmap_image)
         plot_or_save_slices(heatmap_image, heatmap_output_path)
         plot_or_save_slices(d, image_output_path)
-        print("done")
+
+
+def save_output_and_mark_done(pred_categorical, pred, output_filename, properties, manifest):
+    save_output(pred_categorical, pred, output_filename, properties)
+    manifest.mark_done(os.path.basename(output_filename)[:-len(".npz")], output_filename)
+
+
+def export_prediction(categorical_output, pred, output_filename, properties, export_pool, result_store=None,
+                      manifest=None):
+    """
+    Saves one prediction with save_output in export_pool, or adds it to result_store. See predict_and_export_batch
+    :return: list of AsyncResults of the export jobs
+    """
+    if result_store is not None:
+        result_store.add(os.path.basename(output_filename)[:-len(".npz")], categorical_output, pred, properties)
+        return []
+    print(f"exporting prediction to {output_filename}...")
+    if manifest is not None:
+        return [export_pool.apply_async(save_output_and_mark_done,
+                                        (categorical_output, pred, output_filename, properties, manifest))]
+    return [export_pool.apply_async(save_output, (categorical_output, pred, output_filename, properties))]
+
+
+def predict_and_export_batch(ensemble, batch, export_pool, mixed_precision=True, explain="none",
+                             explain_method="gradcam", model_wrapper=None, render_backend="mosaic",
+                             heatmap_downsample=1, early_exit_margin=None, mirror_axes=None, result_store=None,
+                             manifest=None, cache=None, cache_keys=None):
+    """
+    Runs the ensemble on a batch of preprocessed cases and hands the outputs to export_pool.
+    :param batch: list of (output_filename, data, properties)
+    :param explain: 'none', 'positives' (cases for which any classification head predicts a class other than 0) or
+    'all'. Selects the cases for which heatmaps are saved
+    :param explain_method: 'gradcam' runs an extra forward and backward pass through model_wrapper for the selected
+    cases, 'cam' uses class activation maps from the mixed_5c features of the prediction forward pass
+    :param render_backend: see save_explanation. The 'mosaic' backend renders in export_pool, 'matplotlib' (not thread
+    safe) renders here
+    :param early_exit_margin: if not None, see FoldEnsemble.predict_early_exit. The number of folds used for a case is
+    saved as 'num_folds_used' in its properties
+    :param mirror_axes: axes for mirroring test time augmentation, see FoldEnsemble.predict. Grad-CAM heatmaps are
+    computed without mirroring
+    :param result_store: ResultStore. If not None, the predictions are added to it (with the file name of
+    output_filename without .npz as case id) instead of being saved with save_output
+    :param manifest: RunManifest. If not None, every case is marked as done once its output has been saved
+    :param cache: PredictionCache. If not None, the predictions are added to it with the keys in cache_keys (a dict
+    output_filename: input key)
+    :return: list of AsyncResults of the export jobs
+    """
+    results = []
+    print(f"predicting {len(batch)} case(s)...")
+    set_case([os.path.basename(output_filename)[:-len(".npz")] for output_filename, _, _ in batch])
+    data = np.stack([d for _, d, _ in batch])
+    num_folds_used = None
+    if explain != "none" and explain_method == "cam":
+        batch_pred, cams = ensemble.predict(data, mixed_precision=mixed_precision, return_cam=True,
+                                            mirror_axes=mirror_axes)
+    elif early_exit_margin is not None:
+        batch_pred, num_folds_used = ensemble.predict_early_exit(data, early_exit_margin,
+                                                                 mixed_precision=mixed_precision,
+                                                                 mirror_axes=mirror_axes)
+        print(f"used {num_folds_used.mean():.2f} of {len(ensemble)} folds per case")
+    else:
+        batch_pred = ensemble.predict(data, mixed_precision=mixed_precision, mirror_axes=mirror_axes)
+
+    for it, (output_filename, d, properties) in enumerate(batch):
+        pred = [p[it:it + 1] for p in batch_pred]  # keep the batch dimension of size 1 in the exported logits
+        if num_folds_used is not None:
+            properties['num_folds_used'] = int(num_folds_used[it])
+
+        categorical_output = [np.argmax(p) for p in pred]
+        if cache is not None:
+            cache.put(cache_keys[output_filename], categorical_output, pred, properties)
+        results += export_prediction(categorical_output, pred, output_filename, properties, export_pool,
+                                     result_store, manifest)
+
+    if explain == "none":
+        return results
+
+    selected = [it for it in range(len(batch)) if explain == "all" or any(np.argmax(p[it]) > 0 for p in batch_pred)]
+    if len(selected) > 0:
+        if explain_method == "cam":
+            heatmaps = cams[selected]
+        else:
+            # Generate Grad-CAM heatmaps for the selected cases in one batched pass
+            print(f"generating Grad-CAM heatmaps for {len(selected)} case(s)...")
+            with stage("gradcam", batch_size=len(selected)):
+                heatmaps = generate_grad_cam(model_wrapper, torch.from_numpy(data[selected]),
+                                             target_class=0)  # np.argmax(pred[0])
+        for it, heatmap in zip(selected, heatmaps):
+            output_filename, d, _ = batch[it]
+            if render_backend == "mosaic":
+                results.append(export_pool.apply_async(save_explanation, (d, heatmap, output_filename, render_backend,
+                                                                          heatmap_downsample)))
+            else:
+                save_explanation(d, heatmap, output_filename, render_backend)
+    return results
+
+
+def predict_cases(model, list_of_lists_of_modality_filenames, seg_filenames, output_filenames, folds,
+                  mixed_precision=True, overwrite_existing=False, checkpoint_name="model_final_checkpoint",
+                  batch_size=1, num_threads_preprocessing=6, num_threads_export=1, explain="none",
+                  explain_method="gradcam", render_backend="mosaic", heatmap_downsample=1, backend="pytorch",
+                  early_exit_margin=None, do_tta=False, result_store=None, manifest_file=None, cache_dir=None,
+                  cache_max_size=10 * 1024 ** 3, profile_file=None, restrict_resampling_to_fov=False, mirror_axes=None):
+    """
+    :param do_tta: mirroring test time augmentation along the mirror axes the networks were trained with (see
+    get_mirror_axes). The mirrored variants of a batch are predicted in a single forward pass per fold
+    :param mirror_axes: with do_tta, only mirror along these spatial axes, e.g. (1, 2). Default: the axes used in
+    training
+    :param result_store: if not None, file name of a ResultStore (SQLite) that all predictions are appended to, instead
+    of an npz and pkl per case. The case ids are the output file names without .npz. Cases already in the store count
+    as existing outputs
+    :param manifest_file: if not None, the finished cases are logged in this RunManifest and, unless
+    overwrite_existing, only cases that are recorded as finished in it (or in the manifests of the other parts in the
+    same folder) and whose output exists are skipped. Without it, any existing output is skipped. Outputs are always
+    written atomically (see save_output)
+    :param cache_dir: if not None, a PredictionCache shared by all runs. Cases whose image and segmentation bytes were
+    predicted before with the same model files and options are exported from the cache, without preprocessing or
+    prediction. Also with overwrite_existing. Heatmaps are not cached, so cases that need one for explain are always
+    predicted
+    :param cache_max_size: in bytes. The least recently used entries are removed above it
+    :param profile_file: if not None, record the time and peak memory of every stage of every case (reading,
+    cropping, resampling, forward pass per fold, export, ...) in this json lines file and print a summary at the end,
+    see universalclassifier.profiling
+    :param restrict_resampling_to_fov: only resample the field of view that is kept by the central crop to the
+    planned image size, see UniversalClassifierPreprocessor.resample_and_normalize_fov. Faster for large images with
+    CT or noNorm normalization, the predictions are the same
+    """
+    with profiling(profile_file):
+        assert len(list_of_lists_of_modality_filenames) == len(output_filenames)
+        assert len(list_of_lists_of_modality_filenames) == len(seg_filenames)
+        assert batch_size >= 1, "batch_size must be at least 1"
+        assert explain in ("none", "positives", "all"), "explain must be 'none', 'positives' or 'all'"
+        assert explain_method in ("gradcam", "cam"), "explain_method must be 'gradcam' or 'cam'"
+        assert render_backend in ("mosaic", "matplotlib"), "render_backend must be 'mosaic' or 'matplotlib'"
+        assert backend in ("pytorch", "torchscript", "onnx", "int8"), \
+            "backend must be 'pytorch', 'torchscript', 'onnx' or 'int8'"
+        assert backend == "pytorch" or explain == "none", "explanations need the pytorch backend"
+        assert early_exit_margin is None or backend == "pytorch", "early exit needs the pytorch backend"
+        assert early_exit_margin is None or explain == "none" or explain_method == "gradcam", \
+            "early exit cannot be combined with class activation maps, use explain_method 'gradcam'"
+
+        cleaned_output_files = []
+        for o in output_filenames:
+            dr, f = os.path.split(o)
+            if len(dr) > 0:
+                maybe_mkdir_p(dr)
+            if not f.endswith(".npz"):
+                f, _ = os.path.splitext(f)
+                f = f + ".npz"
+            cleaned_output_files.append(join(dr, f))
+            for tmp in (cleaned_output_files[-1] + ".tmp", cleaned_output_files[-1][:-len(".npz")] + ".pkl.tmp"):
+                if isfile(tmp):
+                    os.remove(tmp)  # left behind by an interrupted export, see save_output
+
+        manifest = None
+        if manifest_file is not None and result_store is None:
+            manifest = RunManifest(manifest_file, run_info={"model": model, "folds": folds,
+                                                            "checkpoint_name": checkpoint_name,
+                                                            "num_cases": len(cleaned_output_files)})
+
+        store = None
+        if result_store is not None:
+            store = ResultStore(result_store)
+            print("saving the predictions in", result_store)
+
+        if not overwrite_existing:
+            print("number of cases:", len(list_of_lists_of_modality_filenames))
+            if store is not None:
+                done = store.case_ids()
+                not_done_idx = [i for i, j in enumerate(cleaned_output_files)
+                                if os.path.basename(j)[:-len(".npz")] not in done]
+            elif manifest is not None:
+                not_done_idx = [i for i, j in enumerate(cleaned_output_files)
+                                if not manifest.is_done(os.path.basename(j)[:-len(".npz")], j)]
+            else:
+                not_done_idx = [i for i, j in enumerate(cleaned_output_files) if not isfile(j)]
+
+            cleaned_output_files = [cleaned_output_files[i] for i in not_done_idx]
+            list_of_lists_of_modality_filenames = [list_of_lists_of_modality_filenames[i] for i in not_done_idx]
+            seg_filenames = [seg_filenames[i] for i in not_done_idx]
+
+            print("number of cases that still need to be predicted:", len(cleaned_output_files))
+
+        export_pool = ThreadPool(num_threads_export)
+        results = []
+
+        cache = None
+        cache_keys = None
+        if cache_dir is not None:
+            fingerprint = get_model_fingerprint(model, folds, checkpoint_name, backend, mixed_precision=mixed_precision,
+                                                do_tta=do_tta, mirror_axes=mirror_axes if do_tta else None,
+                                                early_exit_margin=early_exit_margin,
+                                                restrict_resampling_to_fov=restrict_resampling_to_fov)
+            cache = PredictionCache(cache_dir, fingerprint, cache_max_size,
+                                    model_info={"model_folder": os.path.abspath(model), "folds": folds,
+                                                "checkpoint_name": checkpoint_name, "backend": backend})
+            cache_keys = {}
+            not_cached_idx = []
+            for i, (input_files, seg_file, output_filename) in enumerate(zip(list_of_lists_of_modality_filenames,
+                                                                             seg_filenames, cleaned_output_files)):
+                with stage("cache_lookup", case=os.path.basename(output_filename)[:-len(".npz")]):
+                    key = get_input_key(input_files, seg_file)
+                # heatmaps are not cached, cases that need one are predicted again
+                entry = cache.get(key) if explain != "all" else None
+                if entry is not None and explain == "positives" and any(c > 0 for c in entry["categorical"]):
+                    entry = None
+                if entry is None:
+                    cache_keys[output_filename] = key
+                    not_cached_idx.append(i)
+                else:
+                    # the entry may have been made for another case with the same image files
+                    properties = dict(entry["properties"], list_of_data_files=input_files, seg_file=seg_file)
+                    results += export_prediction(entry["categorical"], entry["pred"], output_filename,
+                                                 properties, export_pool, store, manifest)
+            print(f"{len(cleaned_output_files) - len(not_cached_idx)} cases found in the prediction cache")
+            cleaned_output_files = [cleaned_output_files[i] for i in not_cached_idx]
+            list_of_lists_of_modality_filenames = [list_of_lists_of_modality_filenames[i] for i in not_cached_idx]
+            seg_filenames = [seg_filenames[i] for i in not_cached_idx]
+
+        print("emptying cuda cache")
+        torch.cuda.empty_cache()
+
+        print("loading parameters for folds,", folds)
+        with stage("load_model"):
+            if backend == "pytorch":
+                trainer, ensemble = load_fold_ensemble(model, folds, mixed_precision=mixed_precision,
+                                                       checkpoint_name=checkpoint_name)
+            else:
+                trainer, ensemble = load_graph_ensemble(model, folds, checkpoint_name=checkpoint_name, backend=backend)
+        trainer.restrict_resampling_to_fov = restrict_resampling_to_fov
+
+        mirror_axes = get_mirror_axes(trainer, mirror_axes) if do_tta else None
+        if do_tta:
+            print("test time augmentation: mirroring along axes", mirror_axes)
+
+        if explain != "none" and explain_method == "gradcam":
+            network = ensemble.networks[-1]
+            model_wrapper = ModelWrapper(network).to(next(network.parameters()).device)
+        else:
+            model_wrapper = None
+
+        batch = []
+        for output_filename, (d, properties) in preprocess_multithreaded(trainer, list_of_lists_of_modality_filenames,
+                                                                         seg_filenames, cleaned_output_files,
+                                                                         num_threads_preprocessing):
+            batch.append((output_filename, d, properties))
+            if len(batch) == batch_size:
+                results += predict_and_export_batch(ensemble, batch, export_pool, mixed_precision, explain,
+                                                    explain_method, model_wrapper, render_backend,
+                                                    heatmap_downsample, early_exit_margin, mirror_axes, store,
+                                                    manifest, cache, cache_keys)
+                batch = []
+        if len(batch) > 0:
+            results += predict_and_export_batch(ensemble, batch, export_pool, mixed_precision, explain,
+                                                explain_method, model_wrapper, render_backend,
+                                                heatmap_downsample, early_exit_margin, mirror_axes, store,
+                                                manifest, cache, cache_keys)
+
+        if model_wrapper is not None:
+            model_wrapper.remove()
+
+        print("waiting for the export to finish...")
+        _ = [i.get() for i in results]
+        export_pool.close()
+        export_pool.join()
+        if store is not None:
+            store.close()
+        if profile_file is not None:
+            print_summary(profile_file)
+    print("done")
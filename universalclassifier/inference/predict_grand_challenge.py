@@ -1,26 +1,17 @@
 import os
+import numpy as np
 import torch
 from batchgenerators.utilities.file_and_folder_operations import *
 from typing import Tuple, Union, List
-from scipy.special import softmax
 from universalclassifier.paths import default_plans_identifier, default_trainer
-from universalclassifier.training.model_restore import load_model_and_checkpoint_files
+from universalclassifier.inference.ensemble import get_mirror_axes, load_fold_ensemble
+from universalclassifier.profiling import print_summary, profiling, set_case, stage
 
 
-def predict_grand_challenge(artifact_path: str,
-                            ordered_image_files: List[str],
-                            roi_segmentation_file: str = None,
-                            folds: Union[Tuple[int], List[int]] = None,
-                            model: str = "3d_fullres",
-                            trainer_class_name: str = default_trainer,
-                            plans_identifier: str = default_plans_identifier,
-                            disable_mixed_precision: bool = True,
-                            checkpoint_name: str = "model_final_checkpoint"):
-    mixed_precision = not disable_mixed_precision
-
-    if folds is None:
-        folds = ["all"]
-
+def get_model_folder_from_artifact(artifact_path: str,
+                                   model: str = "3d_fullres",
+                                   trainer_class_name: str = default_trainer,
+                                   plans_identifier: str = default_plans_identifier):
     task_path = os.path.join(artifact_path, "nnUNet", "3d_fullres")
     task_names = os.listdir(task_path)
     if len(task_names) == 0:
@@ -34,8 +25,19 @@ def predict_grand_challenge(artifact_path: str,
 
     assert model in ["3d_fullres"], "-m must be 3d_fullres"
 
+    model_folder_name = join(artifact_path, "nnUNet", model, task_name, trainer_class_name + "__" +
+                             plans_identifier)
+    print("using model stored in ", model_folder_name)
+    assert isdir(model_folder_name), "model output folder not found. Expected: %s" % model_folder_name
+    return model_folder_name
+
+
+def parse_folds(folds):
+    if folds is None:
+        folds = ["all"]
+
     if isinstance(folds, list):
-        if folds[0] == 'all' and len(folds) == 1:
+        if folds[0] in ('all', 'soup') and len(folds) == 1:
             pass
         else:
             folds = [int(i) for i in folds]
@@ -43,44 +45,82 @@ def predict_grand_challenge(artifact_path: str,
         folds = None
     else:
         raise ValueError("Unexpected value for argument folds")
+    return folds
 
-    model_folder_name = join(artifact_path, "nnUNet", model, task_name, trainer_class_name + "__" +
-                             plans_identifier)
-    print("using model stored in ", model_folder_name)
-    assert isdir(model_folder_name), "model output folder not found. Expected: %s" % model_folder_name
-
-    expected_num_modalities = load_pickle(join(model_folder_name, "plans.pkl"))['num_modalities']
-    assert len(ordered_image_files) == expected_num_modalities, \
-        f"Expected {expected_num_modalities} input modalities (excluding the optional roi segmentation), but len(ordered_image_files)=={len(ordered_image_files)}"
-
-    print("emptying cuda cache")
-    torch.cuda.empty_cache()
-
-    print("loading parameters for folds,", folds)
-    trainer, params = load_model_and_checkpoint_files(model_folder_name, folds, mixed_precision=mixed_precision,
-                                                      checkpoint_name=checkpoint_name)
-
-    print(f"=== Processing {ordered_image_files}, {roi_segmentation_file}:")
-    print("preprocessing...")
-    d, s, properties = trainer.preprocess_patient(ordered_image_files, roi_segmentation_file)
-    d = trainer.combine_data_and_seg(d, s)
-
-    print("predicting...")
-    trainer.load_checkpoint_ram(params[0], False)
-    pred = trainer.predict_preprocessed_data_return_pred_and_logits(d[None], mixed_precision=mixed_precision)[1]
-    pred = [softmax(p) for p in pred]
-
-    for p in params[1:]:
-        trainer.load_checkpoint_ram(p, False)
-        new_pred = trainer.predict_preprocessed_data_return_pred_and_logits(d[None], mixed_precision=mixed_precision)[1]
-        pred = [p + softmax(n_p) for p, n_p in zip(pred, new_pred)]
-
-    if len(params) > 1:
-        pred = [p / len(params) for p in pred]
 
-    pred = [p[0].tolist() for p in pred]  # remove batch dimension and convert to list for storing as json
+def to_grand_challenge_output(pred: List[np.ndarray]):
+    """
+    :param pred: averaged softmax of a single case, one array of shape (num_classes,) per classification head
+    :return: json serializable list with one entry per classification head
+    """
+    pred = [p.tolist() for p in pred]
 
     # Binary task outputs need to be stored as the probability of the positive class
-    pred = [p if len(p) > 2 else p[1] for p in pred]
+    return [p if len(p) > 2 else p[1] for p in pred]
 
-    return pred
+
+def predict_grand_challenge(artifact_path: str,
+                            ordered_image_files: List[str],
+                            roi_segmentation_file: str = None,
+                            folds: Union[Tuple[int], List[int]] = None,
+                            model: str = "3d_fullres",
+                            trainer_class_name: str = default_trainer,
+                            plans_identifier: str = default_plans_identifier,
+                            disable_mixed_precision: bool = True,
+                            checkpoint_name: str = "model_final_checkpoint",
+                            early_exit_margin: float = None,
+                            disable_tta: bool = True,
+                            profile_file: str = None,
+                            restrict_resampling_to_fov: bool = False,
+                            mirror_axes: Tuple[int] = None):
+    """
+    :param early_exit_margin: if not None, stop evaluating folds once the averaged softmax is decided (see
+    FoldEnsemble.predict_early_exit). The number of folds used is printed
+    :param disable_tta: set to False for mirroring test time augmentation along the mirror axes used in training
+    :param mirror_axes: without disable_tta, only mirror along these spatial axes. Default: the axes used in training
+    :param profile_file: if not None, record the time and peak memory of every stage in this json lines file and
+    print a summary, see universalclassifier.profiling
+    :param restrict_resampling_to_fov: only resample the field of view that is kept by the central crop, see
+    UniversalClassifierPreprocessor.resample_and_normalize_fov
+    :return: averaged softmax per classification head, see to_grand_challenge_output
+    """
+    mixed_precision = not disable_mixed_precision
+    with profiling(profile_file):
+        folds = parse_folds(folds)
+        model_folder_name = get_model_folder_from_artifact(artifact_path, model, trainer_class_name, plans_identifier)
+
+        expected_num_modalities = load_pickle(join(model_folder_name, "plans.pkl"))['num_modalities']
+        assert len(ordered_image_files) == expected_num_modalities, \
+            f"Expected {expected_num_modalities} input modalities (excluding the optional roi segmentation), but len(ordered_image_files)=={len(ordered_image_files)}"
+
+        print("emptying cuda cache")
+        torch.cuda.empty_cache()
+
+        print("loading parameters for folds,", folds)
+        with stage("load_model"):
+            trainer, ensemble = load_fold_ensemble(model_folder_name, folds, mixed_precision=mixed_precision,
+                                                   checkpoint_name=checkpoint_name)
+        trainer.restrict_resampling_to_fov = restrict_resampling_to_fov
+
+        print(f"=== Processing {ordered_image_files}, {roi_segmentation_file}:")
+        print("preprocessing...")
+        set_case(os.path.basename(ordered_image_files[0]))
+        with stage("preprocess"):
+            d, s, properties = trainer.preprocess_patient(ordered_image_files, roi_segmentation_file)
+            d = trainer.combine_data_and_seg(d, s)
+
+        print("predicting...")
+        mirror_axes = None if disable_tta else get_mirror_axes(trainer, mirror_axes)
+        if early_exit_margin is None:
+            pred = ensemble.predict(d[None], mixed_precision=mixed_precision, average="softmax",
+                                    mirror_axes=mirror_axes)
+        else:
+            pred, num_folds_used = ensemble.predict_early_exit(d[None], early_exit_margin,
+                                                               mixed_precision=mixed_precision, average="softmax",
+                                                               mirror_axes=mirror_axes)
+            print(f"used {num_folds_used[0]} of {len(ensemble)} folds")
+        if profile_file is not None:
+            print_summary(profile_file)
+
+    # remove batch dimension and convert to list for storing as json
+    return to_grand_challenge_output([p[0] for p in pred])
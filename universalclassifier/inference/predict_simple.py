@@ -18,6 +18,23 @@ from universalclassifier.inference.predict import predict_from_folder
 from nnunet.paths import network_training_output_dir
 from batchgenerators.utilities.file_and_folder_operations import join, isdir
 from nnunet.utilities.task_name_id_conversion import convert_id_to_task_name
+from universalclassifier.paths import default_plans_identifier, default_trainer
+
+
+def get_model_folder(task_name, model="3d_fullres", trainer_class_name=default_trainer,
+                     plans_identifier=default_plans_identifier):
+    """
+    :param task_name: task name or task id
+    :return: trained model folder in RESULTS_FOLDER
+    """
+    if not task_name.startswith("Task"):
+        task_name = convert_id_to_task_name(int(task_name))
+    assert model in ["3d_fullres"], "-m must be 3d_fullres"
+    model_folder_name = join(network_training_output_dir, model, task_name, trainer_class_name + "__" +
+                             plans_identifier)
+    print("using model stored in ", model_folder_name)
+    assert isdir(model_folder_name), "model output folder not found. Expected: %s" % model_folder_name
+    return model_folder_name
 
 
 def predict(args):
@@ -46,7 +63,7 @@ def predict(args):
     assert model in ["3d_fullres"], "-m must be 3d_fullres"
 
     if isinstance(folds, list):
-        if folds[0] == 'all' and len(folds) == 1:
+        if folds[0] in ('all', 'soup') and len(folds) == 1:
             pass
         else:
             folds = [int(i) for i in folds]
@@ -55,12 +72,7 @@ def predict(args):
     else:
         raise ValueError("Unexpected value for argument folds")
 
-    trainer = trainer_class_name
-
-    model_folder_name = join(network_training_output_dir, model, task_name, trainer + "__" +
-                             args.plans_identifier)
-    print("using model stored in ", model_folder_name)
-    assert isdir(model_folder_name), "model output folder not found. Expected: %s" % model_folder_name
+    model_folder_name = get_model_folder(task_name, model, trainer_class_name, args.plans_identifier)
 
     if seg_folder is not None and isdir(seg_folder):
         print("\nSegmentation folder found. If this folder does not contain cases for each case in the input folder, "
@@ -72,4 +84,13 @@ def predict(args):
               "poor results.\n")  #Todo make it not fail silently
 
     predict_from_folder(model_folder_name, input_folder, output_folder, folds,
-                        not args.disable_mixed_precision, overwrite_existing, args.chk, folders_format, modality)
+                        not args.disable_mixed_precision, overwrite_existing, args.chk, folders_format, modality,
+                        batch_size=args.batch_size, num_threads_preprocessing=args.num_threads_preprocessing,
+                        num_threads_export=args.num_threads_export, explain=args.explain,
+                        explain_method=args.explain_method, render_backend=args.render_backend,
+                        heatmap_downsample=args.heatmap_downsample, backend=args.backend,
+                        early_exit_margin=args.early_exit_margin, do_tta=args.tta,
+                        result_store=args.result_store, num_parts=args.num_parts, part_id=args.part_id,
+                        cache_dir=args.cache_dir, cache_max_size=int(args.cache_max_size_gb * 1024 ** 3),
+                        profile_file=args.profile, restrict_resampling_to_fov=args.restrict_resampling_to_fov,
+                        mirror_axes=args.mirror_axes)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import shutil
+import time
+
+from batchgenerators.utilities.file_and_folder_operations import *
+
+from universalclassifier.inference.graph_export import get_graph_file
+from universalclassifier.preprocessing.preprocessing_manifest import hash_files
+from universalclassifier.training.model_restore import get_fold_folders
+
+model_info_file = "model.json"
+
+# temporary files of put that are older than this were left behind by an interrupted process
+stale_tmp_age = 3600
+
+
+def get_input_key(image_files, seg_file=None):
+    """
+    :return: key of a case: hash of the bytes of its image files (in modality order) and roi segmentation. The case id
+    and file names do not matter, so the same scan sent under another case id hits the cache
+    """
+    return hash_files(list(image_files) + [seg_file])
+
+
+def get_model_fingerprint(model_folder, folds=None, checkpoint_name="model_final_checkpoint", backend="pytorch",
+                          **prediction_options):
+    """
+    :param prediction_options: everything else that changes the predictions, e.g. mixed_precision, mirror_axes,
+    early_exit_margin. Must be json serializable
+    :return: hash of plans.pkl, the checkpoint (or exported graph) and .model.pkl of every fold that is used and
+    prediction_options
+    """
+    files = [join(model_folder, "plans.pkl")]
+    for fold_folder in get_fold_folders(model_folder, folds):
+        if backend == "pytorch":
+            files.append(join(fold_folder, checkpoint_name + ".model"))
+        else:
+            files.append(get_graph_file(fold_folder, checkpoint_name, backend))
+        files.append(join(fold_folder, checkpoint_name + ".model.pkl"))
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(json.dumps({"backend": backend, **prediction_options}, sort_keys=True, default=str).encode())
+    return hash_files(files, hasher)
+
+
+class PredictionCache(object):
+    """
+    Content addressed cache of ensemble predictions on disk, so that a scan that is sent again is not preprocessed and
+    predicted again. Entries are stored as <cache_dir>/<model fingerprint>/<input key>.pkl (see get_model_fingerprint
+    and get_input_key), with the outputs, argmax and properties of the case. A new checkpoint, plans.pkl or prediction
+    option gives a new fingerprint, so stale predictions are never returned.
+
+    Every get touches the entry. When the cache grows beyond max_size bytes, the least recently used entries (of all
+    models) are removed. Several processes can share a cache_dir: entries are written atomically and each process
+    evicts based on its own view of the folder.
+    """
+
+    def __init__(self, cache_dir, model_fingerprint, max_size=10 * 1024 ** 3, model_info=None):
+        """
+        :param model_info: json serializable description of the model (e.g. the model folder and folds), saved in the
+        folder of the fingerprint so that entries can be invalidated per model folder, see invalidate_model_folder
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.folder = join(cache_dir, model_fingerprint)
+        maybe_mkdir_p(self.folder)
+        if model_info is not None and not isfile(join(self.folder, model_info_file)):
+            save_json(model_info, join(self.folder, model_info_file))
+
+        # path: [last use, size] of every entry in the cache, for eviction
+        self.entries = {}
+        now = time.time()
+        for model_folder in subdirs(cache_dir, join=True):
+            for entry in os.scandir(model_folder):
+                if entry.name.endswith(".pkl"):
+                    st = entry.stat()
+                    self.entries[entry.path] = [st.st_mtime, st.st_size]
+                elif entry.name.endswith(".tmp"):
+                    # recent ones may still be written by another process sharing the cache
+                    try:
+                        if now - entry.stat().st_mtime > stale_tmp_age:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+        self.size = sum(s for _, s in self.entries.values())
+
+    def _path(self, key):
+        return join(self.folder, key + ".pkl")
+
+    def get(self, key):
+        """
+        :return: dict with 'pred' (one array of shape (1, num_classes) per classification head), 'categorical' and
+        'properties', or None if key is not in the cache
+        """
+        path = self._path(key)
+        try:
+            entry = load_pickle(path)
+            os.utime(path)
+        except (FileNotFoundError, EOFError):
+            return None
+        if path in self.entries:
+            self.entries[path][0] = time.time()
+        return entry
+
+    def put(self, key, pred_categorical, pred, properties):
+        path = self._path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())  # per process, so that concurrent puts of the same key do not collide
+        save_pickle({"pred": pred, "categorical": pred_categorical, "properties": properties}, tmp)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        if path in self.entries:
+            self.size -= self.entries[path][1]
+        self.entries[path] = [time.time(), size]
+        self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self, target_size=None):
+        """
+        Removes the least recently used entries until the cache is at most target_size (default: 90% of max_size)
+        """
+        target_size = 0.9 * self.max_size if target_size is None else target_size
+        for path, (_, size) in sorted(self.entries.items(), key=lambda x: x[1][0]):
+            if self.size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self.entries[path]
+            self.size -= size
+
+
+def invalidate_model_folder(cache_dir, model_folder):
+    """
+    Removes the cached predictions of every fingerprint of model_folder (all folds, checkpoints and options)
+    :return: number of removed fingerprints
+    """
+    removed = 0
+    for folder in subdirs(cache_dir, join=True):
+        info_file = join(folder, model_info_file)
+        if isfile(info_file) and os.path.abspath(load_json(info_file)["model_folder"]) == \
+                os.path.abspath(model_folder):
+            shutil.rmtree(folder)
+            removed += 1
+    return removed
+
+
+def get_cache_summary(cache_dir):
+    """
+    :return: list with the model info, number of entries and size in bytes of every fingerprint in cache_dir
+    """
+    summary = []
+    for folder in subdirs(cache_dir, join=True):
+        info_file = join(folder, model_info_file)
+        sizes = [e.stat().st_size for e in os.scandir(folder) if e.name.endswith(".pkl")]
+        summary.append({"fingerprint": os.path.basename(folder),
+                        "model_info": load_json(info_file) if isfile(info_file) else None,
+                        "num_entries": len(sizes), "size": sum(sizes)})
+    return summary
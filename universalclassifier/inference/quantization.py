@@ -0,0 +1,128 @@
+from copy import deepcopy
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import *
+
+from universalclassifier.inference.evaluation import compute_metrics, load_preprocessed_case, load_training_dataset, \
+    predict_softmax, print_metric_differences, split_for_fold_folder
+from universalclassifier.inference.graph_export import TupleOutputWrapper, get_graph_file
+from universalclassifier.network_architecture.i3d.i3dpt import Mixed
+from universalclassifier.training.model_restore import get_fold_folders
+
+
+class FeatureExtractor(torch.nn.Module):
+    """
+    I3D.forward_features as a module of its own. Only this part is quantized: forward_head derives its pooling kernel
+    from the feature shape, which FX cannot trace, and it is a negligible part of the compute.
+    """
+
+    def __init__(self, network):
+        super(FeatureExtractor, self).__init__()
+        self.network = network
+
+    def forward(self, inp):
+        return self.network.forward_features(inp)
+
+
+class QuantizedI3D(torch.nn.Module):
+    """
+    int8 backbone (dequantized at the output) followed by the fp32 pooling and classification heads of the original
+    network.
+    """
+
+    def __init__(self, quantized_backbone, network):
+        super(QuantizedI3D, self).__init__()
+        self.backbone = quantized_backbone
+        self.network = network
+
+    def forward(self, inp):
+        return self.network.forward_head(self.backbone(inp))
+
+
+def quantize_network(network, calibration_data, backend="fbgemm"):
+    """
+    Post-training static quantization of the I3D backbone with FX graph mode quantization. Conv3d, BatchNorm3d and
+    relu are fused before quantization.
+    :param network: I3D in fp32
+    :param calibration_data: iterable of preprocessed cases of shape (b, c, x, y, z), used to collect activation ranges
+    :param backend: quantization engine, 'fbgemm' for x86, 'qnnpack' for arm
+    :return: QuantizedI3D on the cpu
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    network = deepcopy(network).float().cpu().eval()
+    backbone = FeatureExtractor(deepcopy(network)).eval()
+    for m in backbone.modules():
+        if isinstance(m, Mixed):
+            m.fuse_1x1 = False  # FX fuses and quantizes Conv3d modules, not convolutions with concatenated weights
+    calibration_data = iter(calibration_data)
+    first = torch.from_numpy(next(calibration_data)).float()
+
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(backend), example_inputs=(first,))
+    with torch.no_grad():
+        prepared(first)
+        for data in calibration_data:
+            prepared(torch.from_numpy(data).float())
+    return QuantizedI3D(convert_fx(prepared), network).eval()
+
+
+def export_quantized_network(quantized_network, image_size, num_input_channels, output_file):
+    """
+    Saves quantized_network as frozen TorchScript graph for inputs of shape (b, num_input_channels, *image_size), so
+    that it can be run with GraphEnsemble (backend 'int8')
+    """
+    example = torch.zeros((1, num_input_channels, *image_size), dtype=torch.float32)
+    with torch.no_grad():
+        graph = torch.jit.freeze(torch.jit.trace(TupleOutputWrapper(quantized_network).eval(), example))
+    torch.jit.save(graph, output_file)
+    print("exported", output_file)
+
+
+def quantize_model_folder(folder, folds=None, checkpoint_name="model_final_checkpoint", num_calibration_cases=32,
+                          backend="fbgemm", seed=12345):
+    """
+    Quantizes the network of every requested fold, calibrated on (a random sample of) its training cases. The result
+    is saved as fold_X/<checkpoint_name>_int8.pt, next to the checkpoint. The accuracy and AUC of the fp32 and int8
+    networks on the validation split of the fold are saved as fold_X/<checkpoint_name>_int8.json.
+    Requires the preprocessed training data of the task.
+    :return: dict with the report of every fold
+    """
+    from universalclassifier.inference.ensemble import load_fold_ensemble
+    trainer, ensemble = load_fold_ensemble(folder, folds, mixed_precision=False, checkpoint_name=checkpoint_name)
+    load_training_dataset(trainer)
+
+    reports = {}
+    for fold_folder, network in zip(get_fold_folders(folder, folds), ensemble.networks):
+        fold_name = split_for_fold_folder(trainer, fold_folder)
+
+        tr_keys = sorted(trainer.dataset_tr.keys())
+        rnd = np.random.RandomState(seed)
+        calibration_keys = rnd.choice(tr_keys, min(num_calibration_cases, len(tr_keys)), replace=False)
+        print(f"{fold_name}: calibrating on {len(calibration_keys)} training cases")
+        network = network.float().cpu().eval()
+        quantized = quantize_network(network, (load_preprocessed_case(trainer, k) for k in calibration_keys),
+                                     backend)
+
+        output_file = get_graph_file(fold_folder, checkpoint_name, "int8")
+        export_quantized_network(quantized, trainer.image_size, trainer.num_input_channels, output_file)
+
+        print(f"{fold_name}: evaluating fp32 and int8 on {len(trainer.dataset_val)} validation cases")
+        val_keys = sorted(trainer.dataset_val.keys())
+        targets = np.stack([trainer.dataset[k]['target'] for k in val_keys])
+        classification_labels = trainer.dataset[val_keys[0]]['classification_labels']
+        fp32_outputs = predict_softmax(network, (load_preprocessed_case(trainer, k) for k in val_keys))
+        int8_outputs = predict_softmax(torch.jit.load(output_file),
+                                       (load_preprocessed_case(trainer, k) for k in val_keys))
+
+        report = {"num_calibration_cases": len(calibration_keys), "num_validation_cases": len(val_keys),
+                  "fp32": compute_metrics(targets, fp32_outputs, classification_labels),
+                  "int8": compute_metrics(targets, int8_outputs, classification_labels),
+                  "max_abs_softmax_difference": float(max(np.abs(a - b).max()
+                                                          for a, b in zip(fp32_outputs, int8_outputs)))}
+        print_metric_differences(fold_name, "fp32", report["fp32"], "int8", report["int8"])
+        save_json(report, output_file[:-len(".pt")] + ".json")
+        reports[fold_name] = report
+    return reports
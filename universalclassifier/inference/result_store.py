@@ -0,0 +1,116 @@
+import json
+import sqlite3
+
+import numpy as np
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class ResultStore(object):
+    """
+    Appends the predictions of a run to a single SQLite file instead of writing an npz and a pkl per case (see
+    export.save_output). Every case is one row with its case id, the argmax and the outputs of every classification
+    head (float32, all heads concatenated) and its properties as json. Rows are buffered and written buffer_size at a
+    time in a single transaction. Use load_results to read the whole file back as arrays.
+
+    A case that is added again replaces the earlier row. Not thread safe: add from the thread that created the store.
+    """
+
+    def __init__(self, filename, buffer_size=256):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.head_sizes = None
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (case_id TEXT PRIMARY KEY, categorical TEXT, "
+                                "outputs BLOB, properties TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+        row = self.connection.execute("SELECT value FROM meta WHERE key='head_sizes'").fetchone()
+        if row is not None:
+            self.head_sizes = json.loads(row[0])
+
+    def case_ids(self):
+        """
+        :return: set of the case ids in the store, including buffered ones
+        """
+        done = set(r[0] for r in self.connection.execute("SELECT case_id FROM results"))
+        return done | set(r[0] for r in self.buffer)
+
+    def add(self, case_id, pred_categorical, pred, properties=None):
+        """
+        :param case_id:
+        :param pred_categorical: argmax of every classification head
+        :param pred: list with one array of shape (1, num_classes) or (num_classes,) per classification head
+        :param properties: dict, stored as json (numpy values are converted, anything else becomes a string)
+        """
+        head_sizes = [int(np.prod(p.shape)) for p in pred]
+        if self.head_sizes is None:
+            self.head_sizes = head_sizes
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('head_sizes', ?)", (json.dumps(head_sizes),))
+        assert head_sizes == self.head_sizes, \
+            "all cases in a result store need the same heads. Expected %s, got %s" % (self.head_sizes, head_sizes)
+        outputs = np.concatenate([np.asarray(p, dtype=np.float32).ravel() for p in pred])
+        self.buffer.append((case_id, json.dumps([int(c) for c in pred_categorical]), outputs.tobytes(),
+                            json.dumps(_to_json(properties)) if properties is not None else None))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_results(filename, case_ids=None, load_properties=False):
+    """
+    Reads a ResultStore file with a single query.
+    :param case_ids: only return these cases, in this order. Default: all cases sorted by case id
+    :param load_properties: also parse the json properties of every case
+    :return: dict with 'case_ids' (list), 'categorical' (num_cases, num_heads), 'outputs' (list with one array of shape
+    (num_cases, num_classes) per classification head) and, if load_properties, 'properties' (list of dicts)
+    """
+    connection = sqlite3.connect(filename)
+    try:
+        head_sizes = json.loads(connection.execute("SELECT value FROM meta WHERE key='head_sizes'").fetchone()[0])
+        columns = "case_id, categorical, outputs" + (", properties" if load_properties else "")
+        rows = connection.execute("SELECT %s FROM results ORDER BY case_id" % columns).fetchall()
+    finally:
+        connection.close()
+    if case_ids is not None:
+        by_id = {r[0]: r for r in rows}
+        missing = [c for c in case_ids if c not in by_id]
+        assert len(missing) == 0, "cases not found in %s: %s" % (filename, missing[:10])
+        rows = [by_id[c] for c in case_ids]
+
+    outputs = np.frombuffer(b"".join(r[2] for r in rows), dtype=np.float32).reshape(len(rows), sum(head_sizes))
+    results = {"case_ids": [r[0] for r in rows],
+               "categorical": np.array([json.loads(r[1]) for r in rows], dtype=np.int64).reshape(len(rows), -1),
+               "outputs": np.split(outputs, np.cumsum(head_sizes)[:-1], axis=1)}
+    if load_properties:
+        results["properties"] = [json.loads(r[3]) if r[3] is not None else None for r in rows]
+    return results
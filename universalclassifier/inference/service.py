@@ -0,0 +1,196 @@
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from universalclassifier.inference.ensemble import load_fold_ensemble
+from universalclassifier.inference.predict_grand_challenge import to_grand_challenge_output
+
+
+class BatchingPredictor(object):
+    """
+    Keeps the trainer (for preprocessing) and the fold ensemble resident and groups concurrently submitted cases into
+    batches. A batch is predicted as soon as max_batch_size cases are waiting or max_latency seconds have passed since
+    the first case of the batch arrived, whichever comes first.
+    """
+
+    def __init__(self, trainer, ensemble, mixed_precision=False, max_batch_size=8, max_latency=0.05):
+        """
+        :param trainer: trainer as returned by load_fold_ensemble, used for preprocessing
+        :param ensemble: FoldEnsemble
+        :param mixed_precision: predict with autocast. Off by default, like predict_grand_challenge, so that the
+        probabilities are the same as those of predict_grand_challenge
+        :param max_batch_size: maximum number of cases in one forward pass per fold
+        :param max_latency: maximum time in seconds the first case of a batch waits for more cases
+        """
+        assert max_batch_size >= 1, "max_batch_size must be at least 1"
+        self.trainer = trainer
+        self.ensemble = ensemble
+        self.mixed_precision = mixed_precision
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def preprocess(self, image_files=None, roi_segmentation_file=None, data=None, spacing=None, seg=None):
+        """
+        Preprocesses a case given either as files (image_files, roi_segmentation_file) or as arrays (data, spacing,
+        seg). Runs in the calling thread, so concurrent requests are preprocessed in parallel.
+        """
+        if image_files is not None:
+            expected_num_modalities = self.trainer.plans['num_modalities']
+            assert len(image_files) == expected_num_modalities, \
+                f"Expected {expected_num_modalities} input modalities (excluding the optional roi segmentation), " \
+                f"but got {len(image_files)}"
+            d, s, properties = self.trainer.preprocess_patient(image_files, roi_segmentation_file)
+        else:
+            assert data is not None and spacing is not None, "provide either image_files or data and spacing"
+            d, s, properties = self.trainer.preprocess_patient_from_arrays(data, spacing, seg)
+        return self.trainer.combine_data_and_seg(d, s)
+
+    def submit(self, data: np.ndarray) -> Future:
+        """
+        :param data: preprocessed case of shape (c, x, y, z) as returned by preprocess
+        :return: future that resolves to the grand-challenge style output of this case
+        """
+        future = Future()
+        self._queue.put((data, future))
+        return future
+
+    def predict(self, **case):
+        return self.submit(self.preprocess(**case)).result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                data = np.stack([d for d, _ in batch])
+                pred = self.ensemble.predict(data, mixed_precision=self.mixed_precision, average="softmax")
+                for it, (_, future) in enumerate(batch):
+                    future.set_result(to_grand_challenge_output([p[it] for p in pred]))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health: returns the number of resident folds.
+    POST /predict with a json body {"image_files": [...], "roi_segmentation_file": ...} classifies a case from disk.
+    POST /predict with an npz body (Content-Type application/octet-stream) with the arrays 'data' (c, z, y, x),
+    'spacing' (z, y, x) and optionally 'seg' (z, y, x) classifies a case from memory.
+    The response is the json list predict_grand_challenge returns.
+    """
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/health":
+            self._send_json(404, {"error": "unknown path %s" % self.path})
+            return
+        self._send_json(200, {"status": "ok", "num_folds": len(self.server.predictor.ensemble)})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/predict":
+            self._send_json(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            case = self._read_case()
+        except Exception as e:
+            self._send_json(400, {"error": "could not parse request: %s" % e})
+            return
+        try:
+            self._send_json(200, self.server.predictor.predict(**case))
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+    def _read_case(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "application/json").startswith("application/json"):
+            request = json.loads(body)
+            return {"image_files": list(request["image_files"]),
+                    "roi_segmentation_file": request.get("roi_segmentation_file")}
+        arrays = np.load(io.BytesIO(body), allow_pickle=False)
+        return {"data": arrays["data"], "spacing": arrays["spacing"],
+                "seg": arrays["seg"] if "seg" in arrays.files else None}
+
+    def _send_json(self, code, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def serve(model_folder, folds=None, host="127.0.0.1", port=8000, unix_socket=None, mixed_precision=False,
+          checkpoint_name="model_final_checkpoint", max_batch_size=8, max_latency=0.05):
+    """
+    Restores the trainer and all fold weights once and serves predictions until interrupted.
+    :param model_folder: trained model folder, e.g. .../Task001_X/ClassifierTrainer__ClassifierPlans
+    :param folds: folds to use, see load_model_and_checkpoint_files
+    :param unix_socket: if given, listen on this unix socket instead of host:port
+    :param mixed_precision: see BatchingPredictor
+    """
+    print("emptying cuda cache")
+    torch.cuda.empty_cache()
+
+    print("loading parameters for folds,", folds)
+    trainer, ensemble = load_fold_ensemble(model_folder, folds, mixed_precision=mixed_precision,
+                                           checkpoint_name=checkpoint_name)
+    predictor = BatchingPredictor(trainer, ensemble, mixed_precision=mixed_precision, max_batch_size=max_batch_size,
+                                  max_latency=max_latency)
+
+    if unix_socket is not None:
+        server = UnixHTTPServer(unix_socket, PredictionRequestHandler)
+        print("serving %d folds on unix socket %s" % (len(ensemble), unix_socket), flush=True)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+        print("serving %d folds on http://%s:%d" % (len(ensemble), host, port), flush=True)
+    server.daemon_threads = True
+    server.predictor = predictor
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,133 @@
+import shutil
+from collections import OrderedDict
+from copy import deepcopy
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import *
+
+from universalclassifier.inference.ensemble import FoldEnsemble
+from universalclassifier.inference.evaluation import compute_metrics, load_preprocessed_case, load_training_dataset, \
+    print_metric_differences, split_for_fold_folder
+from universalclassifier.training.model_restore import get_fold_folders, load_model_and_checkpoint_files
+
+soup_folder_name = "soup"
+
+
+def average_state_dicts(state_dicts):
+    """
+    Uniform average of the floating point entries of state_dicts. Integer entries (num_batches_tracked) are taken from
+    the first state dict.
+    """
+    averaged = OrderedDict()
+    for k, value in state_dicts[0].items():
+        if torch.is_floating_point(value):
+            averaged[k] = sum(sd[k].float() for sd in state_dicts) / len(state_dicts)
+            averaged[k] = averaged[k].to(value.dtype)
+        else:
+            averaged[k] = value.clone()
+    return averaged
+
+
+def recompute_batch_norm_statistics(network, cases):
+    """
+    Replaces the running mean and variance of every batch norm layer by the cumulative statistics of network on cases.
+    Averaged weights no longer match the statistics of any of the folds, so these need to be recomputed.
+    :param network: I3D, not frozen
+    :param cases: iterable of preprocessed cases of shape (b, c, x, y, z)
+    """
+    bn_layers = [m for m in network.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in bn_layers]
+    for m in bn_layers:
+        m.reset_running_stats()
+        m.momentum = None  # cumulative moving average
+        m.train()
+
+    device = next(network.parameters()).device
+    with torch.no_grad():
+        for data in cases:
+            network(torch.from_numpy(data).to(device))
+
+    for m, momentum in zip(bn_layers, momenta):
+        m.momentum = momentum
+    network.eval()
+
+
+def make_soup(folder, folds=None, checkpoint_name="model_final_checkpoint", num_bn_cases=64, seed=12345):
+    """
+    Averages the weights of the requested folds into a single network, recomputes its batch norm statistics on a
+    sample of the training cases and saves it as <folder>/soup/<checkpoint_name>.model (with the .model.pkl of the
+    first fold), so that it can be used as fold 'soup' for prediction. The soup, the ensemble of the folds and the
+    model of the fold itself are evaluated on the validation cases of every fold, the results are saved as
+    <folder>/soup/<checkpoint_name>.json. Requires the preprocessed training data of the task.
+
+    Note that the soup and the ensemble contain the other folds, which were trained on these validation cases, and
+    that the batch norm statistics of the soup are recomputed on training cases that include them. Their metrics are
+    in-sample and optimistic (the report says so with "in_sample"), only those of the fold's own model are not.
+    :return: report
+    """
+    fold_folders = get_fold_folders(folder, folds)
+    assert len(fold_folders) > 1, "a soup needs at least two folds"
+    trainer, params = load_model_and_checkpoint_files(folder, folds, mixed_precision=False,
+                                                      checkpoint_name=checkpoint_name)
+    load_training_dataset(trainer)
+
+    print("averaging the weights of", fold_folders)
+    network = deepcopy(trainer.network)
+    state_dicts = [FoldEnsemble._match_state_dict_keys(network, p['state_dict']) for p in params]
+    network.load_state_dict(average_state_dicts(state_dicts))
+
+    keys = sorted(trainer.dataset.keys())
+    bn_keys = np.random.RandomState(seed).choice(keys, min(num_bn_cases, len(keys)), replace=False)
+    print(f"recomputing batch norm statistics on {len(bn_keys)} training cases")
+    recompute_batch_norm_statistics(network, (load_preprocessed_case(trainer, k) for k in bn_keys))
+
+    soup_checkpoint = dict(params[0])
+    soup_checkpoint['state_dict'] = OrderedDict((k, v.cpu()) for k, v in network.state_dict().items())
+    soup_checkpoint['optimizer_state_dict'] = None
+    soup_checkpoint['soup_of'] = [os.path.basename(f) for f in fold_folders]
+
+    output_folder = join(folder, soup_folder_name)
+    maybe_mkdir_p(output_folder)
+    torch.save(soup_checkpoint, join(output_folder, checkpoint_name + ".model"))
+    shutil.copy(join(fold_folders[0], checkpoint_name + ".model.pkl"),
+                join(output_folder, checkpoint_name + ".model.pkl"))
+    print("saved", join(output_folder, checkpoint_name + ".model"))
+
+    ensemble = FoldEnsemble(trainer, params)
+    soup = FoldEnsemble(trainer, [soup_checkpoint])
+
+    report = {"folds": soup_checkpoint['soup_of'], "num_bn_cases": len(bn_keys),
+              "in_sample": {"ensemble": True, "soup": True, "fold_model": False}, "per_fold": {}}
+    for fold_folder, fold_params in zip(fold_folders, params):
+        fold_name = split_for_fold_folder(trainer, fold_folder)
+        fold_model = FoldEnsemble(trainer, [fold_params])
+        val_keys = sorted(trainer.dataset_val.keys())
+        print(f"{fold_name}: evaluating the ensemble, the soup and the fold's own model on {len(val_keys)} "
+              f"validation cases")
+        ensemble_outputs, soup_outputs, fold_outputs = [], [], []
+        for k in val_keys:
+            data = load_preprocessed_case(trainer, k)
+            ensemble_outputs.append(ensemble.predict(data, mixed_precision=False, average="softmax"))
+            soup_outputs.append(soup.predict(data, mixed_precision=False, average="softmax"))
+            fold_outputs.append(fold_model.predict(data, mixed_precision=False, average="softmax"))
+        del fold_model
+        ensemble_outputs = [np.concatenate(o) for o in zip(*ensemble_outputs)]
+        soup_outputs = [np.concatenate(o) for o in zip(*soup_outputs)]
+        fold_outputs = [np.concatenate(o) for o in zip(*fold_outputs)]
+
+        targets = np.stack([trainer.dataset[k]['target'] for k in val_keys])
+        classification_labels = trainer.dataset[val_keys[0]]['classification_labels']
+        fold_report = {"num_validation_cases": len(val_keys),
+                       "ensemble": compute_metrics(targets, ensemble_outputs, classification_labels),
+                       "soup": compute_metrics(targets, soup_outputs, classification_labels),
+                       "fold_model": compute_metrics(targets, fold_outputs, classification_labels)}
+        print_metric_differences(fold_name + " (in-sample)", "ensemble", fold_report["ensemble"], "soup",
+                                 fold_report["soup"])
+        print_metric_differences(fold_name, "fold model", fold_report["fold_model"], "soup (in-sample)",
+                                 fold_report["soup"])
+        report["per_fold"][fold_name] = fold_report
+    del params
+
+    save_json(report, join(output_folder, checkpoint_name + ".json"))
+    return report
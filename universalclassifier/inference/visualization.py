@@ -0,0 +1,196 @@
+import numpy as np
+import torch
+
+# matplotlib, cv2 and scipy are imported inside the functions that use them: they are only needed when explanations
+# are rendered and importing them takes a noticeable part of the startup time of uc_predict.py
+
+def plot_or_save_slices(image, path=None):
+    """
+    Plots or saves a grid of slices from a 3D or 4D image.
+
+    Parameters:
+    - image: 3D or 4D numpy array representing the image.
+    - path: Optional. If provided, the grid will be saved to this path instead of being plotted.
+    """
+    from matplotlib import pyplot as plt
+    if image.ndim not in [3, 4]:
+        raise ValueError("Input image must be a 3D or 4D array")
+
+    if image.ndim == 4 and image.shape[3] != 3:
+        raise ValueError("For 4D input, the last dimension must be 3 (RGB channels)")
+
+    # Identify the dimension with the smallest length
+    min_dim = np.argmin(image.shape[:3])
+
+    if min_dim == 0:
+        num_slices = image.shape[0]
+        if image.ndim == 3:
+            slice_func = lambda img, idx: img[idx, :, :]
+        else:
+            slice_func = lambda img, idx: img[idx, :, :, :]
+    elif min_dim == 1:
+        num_slices = image.shape[1]
+        if image.ndim == 3:
+            slice_func = lambda img, idx: img[:, idx, :]
+        else:
+            slice_func = lambda img, idx: img[:, idx, :, :]
+    else:
+        num_slices = image.shape[2]
+        if image.ndim == 3:
+            slice_func = lambda img, idx: img[:, :, idx]
+        else:
+            slice_func = lambda img, idx: img[:, :, idx, :]
+
+    num_cols = int(np.ceil(np.sqrt(num_slices)))
+    num_rows = int(np.ceil(num_slices / num_cols))
+
+    fig, axes = plt.subplots(num_rows, num_cols, figsize=(10, 10))
+    fig.subplots_adjust(wspace=0.1, hspace=0.1)
+
+    for i in range(num_rows):
+        for j in range(num_cols):
+            slice_index = i * num_cols + j
+            if slice_index < num_slices:
+                axes[i, j].imshow(slice_func(image, slice_index), cmap='gray' if image.ndim == 3 else None)
+                axes[i, j].axis('off')
+            else:
+                axes[i, j].axis('off')
+
+    if path is None:
+        plt.show()
+    else:
+        plt.savefig(path, bbox_inches='tight', pad_inches=0)
+        plt.close(fig)
+
+
+def overlay_heatmap(image, heatmap):
+    import cv2
+    from scipy.ndimage import zoom
+
+    # Calculate the zoom factors for each dimension
+    zoom_factors = (
+        image.shape[0] / heatmap.shape[0],
+        image.shape[1] / heatmap.shape[1],
+        image.shape[2] / heatmap.shape[2]
+    )
+
+    # Resize heatmap using 3D interpolation
+    heatmap_resized = zoom(heatmap, zoom_factors, order=1)
+
+    # Ensure the resized heatmap has the same shape as the image
+    assert heatmap_resized.shape == image.shape, "Resized heatmap shape does not match image shape"
+
+    # Initialize the colored heatmap array
+    heatmap_colored = np.zeros((image.shape[0], image.shape[1], image.shape[2], 3), dtype=np.uint8)
+
+    # Convert each slice of the heatmap to uint8 and apply color map
+    for z in range(image.shape[2]):
+        heatmap_slice = np.uint8(255 * (1 - heatmap_resized[:, :, z]))
+        heatmap_colored[:, :, z, :] = cv2.applyColorMap(heatmap_slice, cv2.COLORMAP_JET)
+
+    # Convert image to uint8 if it's not already
+    if image.dtype != np.uint8:
+        image = np.uint8(255 * (image - image.min()) / (image.max() - image.min()))
+
+    opacity = heatmap_resized / heatmap_resized.max()
+
+    # Superimpose the heatmap on the image
+    superimposed_img = np.round(heatmap_colored * opacity[..., np.newaxis] * 0.7 + image[..., np.newaxis]).astype(
+        np.uint8)
+
+    superimposed_img = np.clip(superimposed_img, 0, 255)
+
+    return superimposed_img
+
+
+_jet_lut = None
+
+
+def get_jet_lut():
+    """
+    :return: (256, 3) uint8 lookup table with the BGR colors of cv2.COLORMAP_JET
+    """
+    global _jet_lut
+    if _jet_lut is None:
+        import cv2
+        _jet_lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, None], cv2.COLORMAP_JET)[:, 0, :]
+    return _jet_lut
+
+
+def resize_heatmap(heatmap, shape):
+    """
+    Linear interpolation of a 3D heatmap to shape. Same corner-aligned sampling as scipy.ndimage.zoom(order=1), but
+    vectorized in torch.
+    """
+    heatmap = torch.from_numpy(np.ascontiguousarray(heatmap, dtype=np.float32))[None, None]
+    return torch.nn.functional.interpolate(heatmap, size=tuple(shape), mode='trilinear',
+                                           align_corners=True)[0, 0].numpy()
+
+
+def to_uint8(image):
+    if image.dtype == np.uint8:
+        return image
+    mn, mx = image.min(), image.max()
+    return np.uint8(255 * (image - mn) / max(mx - mn, 1e-8))
+
+
+def overlay_heatmap_fast(image, heatmap):
+    """
+    Same overlay as overlay_heatmap, with the color map applied to the whole volume in a single table lookup.
+
+    :param image: 3D image
+    :param heatmap: 3D heatmap in [0, 1], at any resolution
+    :return: (x, y, z, 3) uint8 BGR overlay
+    """
+    heatmap_resized = resize_heatmap(heatmap, image.shape)
+    heatmap_colored = get_jet_lut()[np.uint8(255 * (1 - np.clip(heatmap_resized, 0, 1)))]
+
+    opacity = heatmap_resized / max(heatmap_resized.max(), 1e-8)
+    superimposed_img = heatmap_colored * (opacity[..., np.newaxis] * 0.7) + to_uint8(image)[..., np.newaxis]
+    return np.clip(np.round(superimposed_img), 0, 255).astype(np.uint8)
+
+
+def make_mosaic(image, downsample=1):
+    """
+    Tiles the slices along the shortest of the first three axes into a single 2D array, in the same grid layout as
+    plot_or_save_slices.
+
+    :param image: 3D array or 4D array with 3 color channels in the last dimension
+    :param downsample: integer factor by which each slice is downsampled (block average), e.g. for thumbnails
+    :return: 2D array (or 3D with color channels) of the same dtype as image
+    """
+    if image.ndim not in [3, 4]:
+        raise ValueError("Input image must be a 3D or 4D array")
+
+    dtype = image.dtype
+    slices = np.moveaxis(image, int(np.argmin(image.shape[:3])), 0)
+    if downsample > 1:
+        n, h, w = slices.shape[:3]
+        h, w = h // downsample * downsample, w // downsample * downsample
+        slices = slices[:, :h, :w].reshape(n, h // downsample, downsample, w // downsample, downsample,
+                                           *slices.shape[3:]).mean(axis=(2, 4)).astype(dtype)
+
+    num_slices, h, w = slices.shape[:3]
+    num_cols = int(np.ceil(np.sqrt(num_slices)))
+    num_rows = int(np.ceil(num_slices / num_cols))
+
+    grid = np.zeros((num_rows * num_cols, h, w) + slices.shape[3:], dtype=dtype)
+    grid[:num_slices] = slices
+    grid = grid.reshape(num_rows, num_cols, h, w, *slices.shape[3:]).swapaxes(1, 2)
+    return grid.reshape(num_rows * h, num_cols * w, *slices.shape[3:])
+
+
+def save_mosaic(image, path, downsample=1, jpeg_quality=90):
+    """
+    Encodes the mosaic of image directly to path. The format follows the file extension (.jpg, .png, ...)
+    """
+    import cv2
+    mosaic = make_mosaic(to_uint8(image), downsample)
+    params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if path.lower().endswith((".jpg", ".jpeg")) else []
+    if not cv2.imwrite(path, mosaic, params):
+        raise RuntimeError(f"Could not write {path}")
+
+
+def save_overlay_mosaics(image, heatmap, heatmap_output_path, image_output_path, downsample=1):
+    save_mosaic(overlay_heatmap_fast(image, heatmap), heatmap_output_path, downsample)
+    save_mosaic(image, image_output_path, downsample)
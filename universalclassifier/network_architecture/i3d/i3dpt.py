@@ -4,6 +4,7 @@ import universalclassifier
 
 import math
 import os
+from copy import deepcopy
 
 import numpy as np
 import torch
@@ -98,15 +99,62 @@ class Unit3Dpy(torch.nn.Module):
         if activation == 'relu':
             self.activation = torch.nn.functional.relu
 
-    def forward(self, inp):
+    def forward(self, inp, out=None):
+        """
+        :param inp:
+        :param out: optional preallocated tensor the result is written into (only without autograd)
+        """
         if self.padding == 'SAME' and self.simplify_pad is False:
             inp = self.pad(inp)
-        out = self.conv3d(inp)
+        return self.forward_after_conv(self.conv3d(inp), out)
+
+    def forward_after_conv(self, conv_out, out=None):
+        """
+        Batch norm and activation, applied to the output of conv3d (or to a slice of a fused convolution, see Mixed)
+        """
         if self.use_bn:
-            out = self.batch3d(out)
-        if self.activation is not None:
-            out = torch.nn.functional.relu(out)
-        return out
+            conv_out = self.batch3d(conv_out)
+        if out is None:
+            if self.activation is not None:
+                conv_out = torch.nn.functional.relu(conv_out)
+            return conv_out
+        if self.activation is None:
+            return out.copy_(conv_out)
+        if conv_out.dtype == out.dtype:
+            return torch.clamp(conv_out, min=0, out=out)
+        return out.copy_(torch.nn.functional.relu(conv_out))
+
+    def freeze(self, input_shape):
+        """
+        Inference only. Folds batch3d into the weights and bias of conv3d, and replaces the explicit (asymmetric)
+        padding by the native padding of conv3d if that gives the same output shape for input_shape. The window
+        positions are the same in both cases, so the output is unchanged up to floating point rounding.
+        :param input_shape: shape of the input of this unit, as (b, c, x, y, z)
+        """
+        if self.use_bn:
+            bn = self.batch3d
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            bias = bn.bias - bn.running_mean * scale
+            if self.conv3d.bias is not None:
+                bias = bias + self.conv3d.bias * scale
+            with torch.no_grad():
+                self.conv3d.weight.mul_(scale.view(-1, 1, 1, 1, 1))
+            self.conv3d.bias = torch.nn.Parameter(bias.detach())
+            del self.batch3d
+            self.use_bn = False
+
+        if self.padding == 'SAME' and self.simplify_pad is False:
+            # ConstantPad3d pads the last dimension first
+            native_padding = tuple(self.pad.padding[i] for i in (4, 2, 0))
+            inp = torch.empty(input_shape, device='meta')
+            weight = self.conv3d.weight.to('meta')
+            explicit_shape = torch.nn.functional.conv3d(self.pad(inp), weight, stride=self.conv3d.stride).shape
+            native_shape = torch.nn.functional.conv3d(inp, weight, stride=self.conv3d.stride,
+                                                      padding=native_padding).shape
+            if explicit_shape == native_shape:
+                self.conv3d.padding = native_padding
+                self.simplify_pad = True
+                del self.pad
 
 
 class MaxPool3dTFPadding(torch.nn.Module):
@@ -116,13 +164,35 @@ class MaxPool3dTFPadding(torch.nn.Module):
             padding_shape = get_padding_shape(kernel_size, stride)
             self.padding_shape = padding_shape
             self.pad = torch.nn.ConstantPad3d(padding_shape, 0)
+        else:
+            self.pad = None
         self.pool = torch.nn.MaxPool3d(kernel_size, stride, ceil_mode=True)
 
     def forward(self, inp):
-        inp = self.pad(inp)
+        if self.pad is not None:
+            inp = self.pad(inp)
         out = self.pool(inp)
         return out
 
+    def freeze(self, input_shape):
+        """
+        Inference only. Replaces the explicit zero padding by the native padding of the max pooling if that gives the
+        same output shape for input_shape. Native padding pads with -inf instead of 0, which gives the same maxima
+        because every input of these pooling layers comes from a relu and is non-negative.
+        :param input_shape: shape of the input of this layer, as (b, c, x, y, z)
+        """
+        if self.pad is None:
+            return
+        native_padding = tuple(self.pad.padding[i] for i in (4, 2, 0))
+        kernel_size = self.pool.kernel_size
+        if any(p > k // 2 for p, k in zip(native_padding, kernel_size)):
+            return  # not supported by MaxPool3d
+        native_pool = torch.nn.MaxPool3d(kernel_size, self.pool.stride, padding=native_padding, ceil_mode=True)
+        inp = torch.empty(input_shape, device='meta')
+        if self.pool(self.pad(inp)).shape == native_pool(inp).shape:
+            self.pool = native_pool
+            self.pad = None
+
 
 class Mixed(torch.nn.Module):
     def __init__(self, in_channels, out_channels):
@@ -152,12 +222,47 @@ class Mixed(torch.nn.Module):
             in_channels, out_channels[5], kernel_size=(1, 1, 1))
         self.branch_3 = torch.nn.Sequential(branch_3_pool, branch_3_conv2)
 
+        # compute the three 1x1 convolutions on the block input as one wider convolution. The weights stay in the
+        # original submodules, so checkpoints are unaffected. Disabled for FX quantization, which needs the modules
+        self.fuse_1x1 = True
+
     def forward(self, inp):
-        out_0 = self.branch_0(inp)
-        out_1 = self.branch_1(inp)
-        out_2 = self.branch_2(inp)
-        out_3 = self.branch_3(inp)
-        out = torch.cat((out_0, out_1, out_2, out_3), 1)
+        if not self.fuse_1x1:
+            out_0 = self.branch_0(inp)
+            out_1 = self.branch_1(inp)
+            out_2 = self.branch_2(inp)
+            out_3 = self.branch_3(inp)
+            return torch.cat((out_0, out_1, out_2, out_3), 1)
+
+        units_1x1 = (self.branch_0, self.branch_1[0], self.branch_2[0])
+        weight = torch.cat([u.conv3d.weight for u in units_1x1], 0)
+        if all(u.conv3d.bias is None for u in units_1x1):
+            bias = None
+        else:
+            bias = torch.cat([u.conv3d.bias if u.conv3d.bias is not None else
+                              torch.zeros(u.conv3d.out_channels, device=weight.device, dtype=weight.dtype)
+                              for u in units_1x1])
+        fused = torch.nn.functional.conv3d(inp, weight, bias)
+        conv_0, conv_1, conv_2 = torch.split(fused, [u.conv3d.out_channels for u in units_1x1], 1)
+
+        if torch.is_grad_enabled() or torch.jit.is_tracing():
+            # writing into views of a preallocated tensor is not supported by autograd and not recorded reliably by
+            # the tracer
+            out_0 = self.branch_0.forward_after_conv(conv_0)
+            out_1 = self.branch_1[1](self.branch_1[0].forward_after_conv(conv_1))
+            out_2 = self.branch_2[1](self.branch_2[0].forward_after_conv(conv_2))
+            out_3 = self.branch_3(inp)
+            return torch.cat((out_0, out_1, out_2, out_3), 1)
+
+        # without autograd, every branch writes its result directly into its channels of the output
+        channels = [self.branch_0.conv3d.out_channels, self.branch_1[1].conv3d.out_channels,
+                    self.branch_2[1].conv3d.out_channels, self.branch_3[1].conv3d.out_channels]
+        out = torch.empty((inp.shape[0], sum(channels), *inp.shape[2:]), device=inp.device, dtype=fused.dtype)
+        out_0, out_1, out_2, out_3 = torch.split(out, channels, 1)
+        self.branch_0.forward_after_conv(conv_0, out_0)
+        self.branch_1[1](self.branch_1[0].forward_after_conv(conv_1), out_1)
+        self.branch_2[1](self.branch_2[0].forward_after_conv(conv_2), out_2)
+        self.branch_3[1](self.branch_3[0](inp), out_3)
         return out
 
 
@@ -208,10 +313,25 @@ class I3D(torch.nn.Module):
                  dropout_prob=0,
                  name='inception',
                  pre_trained=False,
-                 pre_trained_path= os.path.join(universalclassifier.__path__[0], 'network_architecture/i3d/model_rgb.pth')):
+                 pre_trained_path= os.path.join(universalclassifier.__path__[0], 'network_architecture/i3d/model_rgb.pth'),
+                 width_multiplier=1.):
+        """
+        :param width_multiplier: scales the number of channels of every layer, e.g. 0.5 for a narrower (student)
+        network. Pretrained weights are only available for 1
+        """
         super(I3D, self).__init__()
         if nr_outputs is None:
             nr_outputs = [2]
+        assert width_multiplier == 1 or not pre_trained, "pretrained weights need width_multiplier=1"
+        self.width_multiplier = width_multiplier
+
+        def width(channels):
+            return max(1, int(round(channels * width_multiplier)))
+
+        def mixed_channels(channels):
+            # output channels of a Mixed block: branch_0, branch_1, branch_2 and branch_3 are concatenated
+            return channels[0] + channels[2] + channels[4] + channels[5]
+
         self.name = name
         self.input_channels = input_channels
         self.pre_trained_path = pre_trained_path
@@ -229,7 +349,7 @@ class I3D(torch.nn.Module):
         else:
             first_layer_init_in_channels = input_channels
         conv3d_1a_7x7 = Unit3Dpy(
-            out_channels=64,
+            out_channels=width(64),
             in_channels=first_layer_init_in_channels,
             kernel_size=(7, 7, 7),
             stride=(2, 2, 2),
@@ -240,49 +360,62 @@ class I3D(torch.nn.Module):
             kernel_size=(1, 3, 3), stride=(1, 2, 2), padding='SAME')
         # conv conv
         conv3d_2b_1x1 = Unit3Dpy(
-            out_channels=64,
-            in_channels=64,
+            out_channels=width(64),
+            in_channels=width(64),
             kernel_size=(1, 1, 1),
             padding='SAME')
         self.conv3d_2b_1x1 = conv3d_2b_1x1
         conv3d_2c_3x3 = Unit3Dpy(
-            out_channels=192,
-            in_channels=64,
+            out_channels=width(192),
+            in_channels=width(64),
             kernel_size=(3, 3, 3),
             padding='SAME')
         self.conv3d_2c_3x3 = conv3d_2c_3x3
         self.maxPool3d_3a_3x3 = MaxPool3dTFPadding(
             kernel_size=(1, 3, 3), stride=(1, 2, 2), padding='SAME')
 
+        channels_3b = [width(c) for c in [64, 96, 128, 16, 32, 32]]
+        channels_3c = [width(c) for c in [128, 128, 192, 32, 96, 64]]
+        channels_4b = [width(c) for c in [192, 96, 208, 16, 48, 64]]
+        channels_4c = [width(c) for c in [160, 112, 224, 24, 64, 64]]
+        channels_4d = [width(c) for c in [128, 128, 256, 24, 64, 64]]
+        channels_4e = [width(c) for c in [112, 144, 288, 32, 64, 64]]
+        channels_4f = [width(c) for c in [256, 160, 320, 32, 128, 128]]
+        channels_5b = [width(c) for c in [256, 160, 320, 32, 128, 128]]
+        channels_5c = [width(c) for c in [384, 192, 384, 48, 128, 128]]
+        self.num_features = mixed_channels(channels_5c)
+
         # Mixed_3b
-        self.mixed_3b = Mixed(192, [64, 96, 128, 16, 32, 32])
-        self.mixed_3c = Mixed(256, [128, 128, 192, 32, 96, 64])
+        self.mixed_3b = Mixed(width(192), channels_3b)
+        self.mixed_3c = Mixed(mixed_channels(channels_3b), channels_3c)
 
         self.maxPool3d_4a_3x3 = MaxPool3dTFPadding(
             kernel_size=(3, 3, 3), stride=(2, 2, 2), padding='SAME')
 
         # Mixed 4
-        self.mixed_4b = Mixed(480, [192, 96, 208, 16, 48, 64])
-        self.mixed_4c = Mixed(512, [160, 112, 224, 24, 64, 64])
-        self.mixed_4d = Mixed(512, [128, 128, 256, 24, 64, 64])
-        self.mixed_4e = Mixed(512, [112, 144, 288, 32, 64, 64])
-        self.mixed_4f = Mixed(528, [256, 160, 320, 32, 128, 128])
+        self.mixed_4b = Mixed(mixed_channels(channels_3c), channels_4b)
+        self.mixed_4c = Mixed(mixed_channels(channels_4b), channels_4c)
+        self.mixed_4d = Mixed(mixed_channels(channels_4c), channels_4d)
+        self.mixed_4e = Mixed(mixed_channels(channels_4d), channels_4e)
+        self.mixed_4f = Mixed(mixed_channels(channels_4e), channels_4f)
 
         self.maxPool3d_5a_2x2 = MaxPool3dTFPadding(
             kernel_size=(2, 2, 2), stride=(2, 2, 2), padding='SAME')
 
         # Mixed 5
-        self.mixed_5b = Mixed(832, [256, 160, 320, 32, 128, 128])
-        self.mixed_5c = Mixed(832, [384, 192, 384, 48, 128, 128])
+        self.mixed_5b = Mixed(mixed_channels(channels_4f), channels_5b)
+        self.mixed_5c = Mixed(mixed_channels(channels_5b), channels_5c)
 
         self.avg_pool_kernel_shape = (2, 2, 7)
-        #self.avg_pool = torch.nn.AvgPool3d(self.avg_pool_kernel_shape, (1, 1, 1))
+        # set by freeze_for_inference for the feature shape of the planned image size
+        self.avg_pool = None
+        self.avg_pool_input_shape = None
 
         self.dropout = torch.nn.Dropout(dropout_prob)
 
         # set original final layer to original 400 classes
         self.conv3d_0c_1x1 = Unit3Dpy(
-            in_channels=1024,
+            in_channels=self.num_features,
             out_channels=400,
             kernel_size=(1, 1, 1),
             activation=None,
@@ -296,10 +429,17 @@ class I3D(torch.nn.Module):
                                                                         input_channels)
 
         # add new final linear layer to replace the original one
-        linear_list = [torch.nn.Linear(1024, nr) for nr in nr_outputs]
+        linear_list = [torch.nn.Linear(self.num_features, nr) for nr in nr_outputs]
         self.linear_list = torch.nn.ModuleList(linear_list)
 
     def forward(self, inp):
+        out = self.forward_features(inp)
+        return self.forward_head(out)
+
+    def forward_features(self, inp):
+        """
+        Runs the network up to and including mixed_5c
+        """
         out = self.conv3d_1a_7x7(inp)
         out = self.maxPool3d_2a_3x3(out)
         out = self.conv3d_2b_1x1(out)
@@ -316,10 +456,20 @@ class I3D(torch.nn.Module):
         out = self.maxPool3d_5a_2x2(out)
         out = self.mixed_5b(out)
         out = self.mixed_5c(out)
-        shape1, shape2, shape3 = tuple(min(s1, s2) for s1, s2 in zip(out.shape[-3:], self.avg_pool_kernel_shape))
-        avg_pool = torch.nn.AvgPool3d((shape1, shape2, shape3), (1, 1, 1))
+        return out
 
-        out = avg_pool(out)
+    def forward_head(self, features):
+        """
+        Pools the mixed_5c features and applies the classification heads
+        """
+        if self.avg_pool is not None and tuple(features.shape[-3:]) == self.avg_pool_input_shape:
+            avg_pool = self.avg_pool
+        else:
+            shape1, shape2, shape3 = tuple(min(s1, s2) for s1, s2 in zip(features.shape[-3:],
+                                                                        self.avg_pool_kernel_shape))
+            avg_pool = torch.nn.AvgPool3d((shape1, shape2, shape3), (1, 1, 1))
+
+        out = avg_pool(features)
         out = self.dropout(out)
 
         out = out.mean(dim=[2, 3, 4])
@@ -327,6 +477,53 @@ class I3D(torch.nn.Module):
         out = [linear(out) for linear in self.linear_list]
         return out
 
+    def freeze_for_inference(self, image_size):
+        """
+        Inference only, in place. Folds all batch norms into the preceding convolutions, replaces the explicit TF-style
+        padding by native padding wherever that is equivalent for inputs of image_size, and builds the final average
+        pooling once. The outputs stay the same up to floating point rounding. Load the weights before freezing: the
+        state dict of a frozen network no longer matches the checkpoints.
+        :param image_size: planned image size (x, y, z) of the input
+        :return: self
+        """
+        assert not self.training, "freeze_for_inference is for networks in eval mode"
+        # shapes are propagated on the meta device, so no actual forward pass is needed
+        input_shapes = {}
+        meta_network = deepcopy(self).to('meta')
+        for m in meta_network.modules():
+            if isinstance(m, Mixed):
+                m.fuse_1x1 = False  # the fused path skips the module calls of the 1x1 units
+        hooks = [m.register_forward_pre_hook(lambda module, inp, name=name: input_shapes.__setitem__(name, inp[0].shape))
+                 for name, m in meta_network.named_modules() if isinstance(m, (Unit3Dpy, MaxPool3dTFPadding))]
+        with torch.no_grad():
+            features = meta_network.forward_features(torch.empty((1, self.input_channels, *image_size),
+                                                                 device='meta'))
+        for hook in hooks:
+            hook.remove()
+        del meta_network
+
+        for name, m in self.named_modules():
+            if isinstance(m, (Unit3Dpy, MaxPool3dTFPadding)) and name in input_shapes:
+                m.freeze(input_shapes[name])
+
+        self.avg_pool_input_shape = tuple(features.shape[-3:])
+        self.avg_pool = torch.nn.AvgPool3d(tuple(min(s1, s2) for s1, s2 in zip(self.avg_pool_input_shape,
+                                                                                self.avg_pool_kernel_shape)),
+                                           (1, 1, 1))
+        return self
+
+    def class_activation_map(self, features, head=0):
+        """
+        Class activation maps (Zhou et al., 2016) from the mixed_5c features. Average pooling and the linear head are
+        both linear, so weighting the features with the head weights gives a map whose spatial average (up to the
+        border weighting of the average pooling) equals the logits minus the bias. No backward pass is needed.
+        :param features: output of forward_features, shape (b, c, x, y, z)
+        :param head: index of the classification head in linear_list
+        :return: maps of shape (b, num_classes, x, y, z)
+        """
+        weight = self.linear_list[head].weight.to(features.dtype)
+        return torch.einsum('kc,bcxyz->bkxyz', weight, features)
+
     def load_tf_weights(self, sess):
         state_dict = {}
         if self.modality == 'rgb':
@@ -1,7 +1,11 @@
+from collections import OrderedDict
+
 import numpy as np
 from nnunet.preprocessing.cropping import ImageCropper, crop_to_nonzero, crop_to_bbox, get_bbox_from_mask, \
     create_nonzero_mask, load_case_from_list_of_files
 
+from universalclassifier.profiling import stage
+
 
 def get_bbox_from_mask_with_margin(mask, outside_value=0, margin=0.05):
     bbx = get_bbox_from_mask(mask, outside_value)
@@ -60,13 +64,45 @@ class ClassificationImageCropper(ImageCropper):
     def crop_from_list_of_files(data_files, seg_file=None, create_dummy_seg=False):
         if seg_file is None:
             assert create_dummy_seg
-        data, seg, properties = load_case_from_list_of_files(data_files, seg_file)
+        with stage("read"):
+            data, seg, properties = load_case_from_list_of_files(data_files, seg_file)
         if create_dummy_seg:
             seg = np.ones_like(data[:1])
         print("Shapes:")
         print(seg.shape)
         print(data.shape)
-        return ClassificationImageCropper.crop(data, properties, seg)
+        with stage("crop"):
+            return ClassificationImageCropper.crop(data, properties, seg)
+
+    @staticmethod
+    def crop_from_arrays(data, spacing, seg=None):
+        """
+        Same as crop_from_list_of_files, for a case that is already in memory
+        :param data: array of shape (c, z, y, x), in the same axis order as sitk.GetArrayFromImage
+        :param spacing: spacing of data in (z, y, x) order
+        :param seg: optional roi segmentation of shape (z, y, x) or (1, z, y, x)
+        :return:
+        """
+        data = np.asarray(data, dtype=np.float32)
+        assert data.ndim == 4, "data must have shape (c, z, y, x), got %s" % str(data.shape)
+        properties = OrderedDict()
+        properties["original_size_of_raw_data"] = np.array(data.shape[1:])
+        properties["original_spacing"] = np.array(spacing, dtype=float)
+        properties["list_of_data_files"] = None
+        properties["seg_file"] = None
+        properties["itk_origin"] = (0., 0., 0.)
+        properties["itk_spacing"] = tuple(float(i) for i in properties["original_spacing"][[2, 1, 0]])
+        properties["itk_direction"] = (1., 0., 0., 0., 1., 0., 0., 0., 1.)
+        if seg is None:
+            seg = np.ones_like(data[:1])
+        else:
+            seg = np.asarray(seg, dtype=np.float32)
+            if seg.ndim == 3:
+                seg = seg[None]
+            assert seg.shape[1:] == data.shape[1:], "seg shape %s does not match data shape %s" % \
+                                                    (str(seg.shape), str(data.shape))
+        with stage("crop"):
+            return ClassificationImageCropper.crop(data, properties, seg)
 
     @staticmethod
     def crop(data, properties, seg=None):
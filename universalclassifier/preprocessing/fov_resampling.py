@@ -0,0 +1,190 @@
+import inspect
+
+import numpy as np
+from batchgenerators.augmentations.utils import resize_segmentation
+from scipy.ndimage import affine_transform, map_coordinates, spline_filter
+from nnunet.configuration import RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD
+from nnunet.preprocessing.preprocessing import get_do_separate_z, get_lowres_axis
+
+# scipy pads by this many edge voxels before the spline prefilter for mode 'nearest' (skimage's 'edge')
+_spline_padding = 12
+
+# batchgenerators releases differ in how resize_segmentation, which nnunet uses for the roi segmentation, settles the
+# label of a voxel: releases with the seg_tiebreak argument take the argmax over the interpolated label indicators,
+# older ones assign every label whose indicator is at least 0.5, in ascending order
+_seg_argmax = "seg_tiebreak" in inspect.signature(resize_segmentation).parameters
+
+
+def get_resampled_shape(shape, original_spacing, target_spacing):
+    """
+    :return: shape after resampling to target_spacing, as computed by nnunet's resample_patient
+    """
+    return np.round(((np.array(original_spacing) / np.array(target_spacing)).astype(float) *
+                     np.array(shape))).astype(int)
+
+
+def get_separate_z_axis(original_spacing, target_spacing, force_separate_z=None,
+                        separate_z_anisotropy_threshold=RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD):
+    """
+    :return: the low resolution axis that is resampled separately (with order 0), or None. Same decision as nnunet's
+    resample_patient
+    """
+    if force_separate_z is not None:
+        axis = get_lowres_axis(original_spacing) if force_separate_z else None
+    elif get_do_separate_z(original_spacing, separate_z_anisotropy_threshold):
+        axis = get_lowres_axis(original_spacing)
+    elif get_do_separate_z(target_spacing, separate_z_anisotropy_threshold):
+        axis = get_lowres_axis(target_spacing)
+    else:
+        axis = None
+    if axis is None or len(axis) != 1:
+        return None
+    return int(axis[0])
+
+
+def get_central_crop_window(resampled_shape, target_size):
+    """
+    :return: (start, stop) per axis of the voxels of the resampled image that are kept by central_pad
+    """
+    window = []
+    for current_size, target_dim in zip(resampled_shape, target_size):
+        start = (current_size - target_dim) // 2 if current_size > target_dim else 0
+        window.append((int(start), int(start + min(current_size, target_dim))))
+    return window
+
+
+class FOVResampler(object):
+    """
+    Resamples any regular part of the image (a field of view, or every n-th voxel) on the grid of nnunet's
+    resample_patient (order 3 for data, linear for seg, order 0 along a separate z axis), without resampling the rest
+    of the image. The voxels are the same as those of resample_patient up to floating point rounding: the spline
+    prefilter is computed on the whole image (or slice), exactly as scipy does it for skimage's resize, and only the
+    interpolation, which is most of the work, is restricted to the requested voxels.
+    """
+
+    def __init__(self, data, seg, original_spacing, target_spacing, force_separate_z=None,
+                 separate_z_anisotropy_threshold=RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD):
+        """
+        :param data: transposed image of shape (c, x, y, z) or None
+        :param seg: transposed roi segmentation of shape (c, x, y, z) or None
+        """
+        assert not ((data is None) and (seg is None))
+        self.data = data
+        self.seg = seg
+        self.shape = np.array(data[0].shape) if data is not None else np.array(seg[0].shape)
+        self.resampled_shape = get_resampled_shape(self.shape, original_spacing, target_spacing)
+        self.axis = get_separate_z_axis(original_spacing, target_spacing, force_separate_z,
+                                        separate_z_anisotropy_threshold)
+        self._filtered = {}  # (channel, slice or None): prefiltered image, reused by every window
+
+    def _get_grid(self, window, step):
+        """
+        :return: per axis (coordinate of the first voxel, distance between voxels, number of voxels) in the original
+        voxels, for the resampled voxels start, start + step, ... < stop (skimage's resize convention)
+        """
+        grid = []
+        for size, resampled_size, (start, stop) in zip(self.shape, self.resampled_shape, window):
+            scale = float(size) / resampled_size
+            grid.append(((start + 0.5) * scale - 0.5, scale * step, len(range(start, stop, step))))
+        return grid
+
+    def _select_slices(self, start, stop, step):
+        """
+        :return: for the resampled slices start, start + step, ... < stop along the separate z axis, the original
+        slice that nnunet's resample_data_or_seg picks (order 0). The coordinates are computed with the same floating
+        point expression, so that coordinates that are exactly halfway between two slices round the same way
+        """
+        scale = float(self.shape[self.axis]) / self.resampled_shape[self.axis]
+        coordinates = scale * (np.arange(start, stop, step) + 0.5) - 0.5
+        indices = np.arange(self.shape[self.axis], dtype=float)
+        return map_coordinates(indices, coordinates[None], order=0, mode='nearest').astype(int)
+
+    def _get_filtered(self, c, z=None):
+        key = (c, z)
+        if key not in self._filtered:
+            image = self.data[c] if z is None else np.take(self.data[c], z, axis=self.axis)
+            padded = np.pad(image.astype(float), _spline_padding, mode='edge')
+            self._filtered[key] = (spline_filter(padded, 3, mode='mirror'), image.min(), image.max())
+        return self._filtered[key]
+
+    @staticmethod
+    def _interpolate(filtered, grid, order, padding=0):
+        return affine_transform(filtered, [g[1] for g in grid], offset=[g[0] + padding for g in grid],
+                                output_shape=[g[2] for g in grid], order=order, mode='nearest', prefilter=False)
+
+    def _resample_data_channel(self, c, grid, selected=None):
+        if self.axis is None:
+            filtered, lower, upper = self._get_filtered(c)
+            return np.clip(self._interpolate(filtered, grid, 3, _spline_padding), lower, upper)
+        # every selected slice is resized in plane and clipped to its own value range, as nnunet does
+        inplane_grid = [g for d, g in enumerate(grid) if d != self.axis]
+        resampled = {}
+        for z in np.unique(selected):
+            filtered, lower, upper = self._get_filtered(c, z)
+            resampled[z] = np.clip(self._interpolate(filtered, inplane_grid, 3, _spline_padding), lower, upper)
+        return np.stack([resampled[z] for z in selected], self.axis)
+
+    def _resample_labels(self, seg, grid):
+        """
+        Linear resampling of every label's indicator, combined as the installed batchgenerators' resize_segmentation
+        does (see _seg_argmax): either the per voxel argmax over the labels, exact ties going to the nearest neighbour
+        label if it is one of the tied labels (its default seg_tiebreak), or in ascending label order every voxel
+        whose indicator is at least 0.5 gets the label and voxels where none reaches 0.5 are 0
+        """
+        # only the part of seg around the grid is needed for linear interpolation
+        crop = []
+        shifted_grid = []
+        for size, (first, distance, count) in zip(seg.shape, grid):
+            lower = max(0, int(np.floor(first)) - 1)
+            upper = min(size, int(np.ceil(first + distance * (count - 1))) + 2)
+            crop.append(slice(lower, upper))
+            shifted_grid.append((first - lower, distance, count))
+        seg = seg[tuple(crop)]
+
+        labels = np.unique(seg)
+        if len(labels) == 1:
+            return np.full([g[2] for g in grid], labels[0], dtype=seg.dtype)
+        if not _seg_argmax:
+            resampled = np.zeros([g[2] for g in grid], dtype=seg.dtype)
+            for l in labels:
+                resampled[self._interpolate((seg == l).astype(float), shifted_grid, 1) >= 0.5] = l
+            return resampled
+        scores = np.stack([self._interpolate((seg == l).astype(float), shifted_grid, 1) for l in labels])
+        best = scores.max(0)
+        winner = np.argmax(scores, 0)  # lowest of the tied labels
+        nearest = np.searchsorted(labels, self._interpolate(seg.astype(float), shifted_grid, 0))
+        nearest_is_tied = np.take_along_axis(scores, nearest[None], 0)[0] == best
+        winner[nearest_is_tied] = nearest[nearest_is_tied]
+        return labels[winner].astype(seg.dtype)
+
+    def _resample_seg_channel(self, c, grid, selected=None):
+        if self.axis is None:
+            return self._resample_labels(self.seg[c], grid)
+        inplane_grid = [g for d, g in enumerate(grid) if d != self.axis]
+        resampled = {}
+        for z in np.unique(selected):
+            resampled[z] = self._resample_labels(np.take(self.seg[c], z, axis=self.axis), inplane_grid)
+        return np.stack([resampled[z] for z in selected], self.axis)
+
+    def resample(self, window=None, step=1, with_seg=True):
+        """
+        :param window: (start, stop) per axis of the resampled image, e.g. get_central_crop_window. Default: all
+        :param step: only resample every step-th voxel of window along every axis
+        :param with_seg: set to False to only resample data
+        :return: resampled data, seg (None if not given or not with_seg)
+        """
+        if window is None:
+            window = [(0, int(s)) for s in self.resampled_shape]
+        if np.all(self.shape == self.resampled_shape):
+            crop = (slice(None),) + tuple(slice(start, stop, step) for start, stop in window)
+            return (self.data[crop] if self.data is not None else None), \
+                   (self.seg[crop] if self.seg is not None and with_seg else None)
+        grid = self._get_grid(window, step)
+        selected = self._select_slices(*window[self.axis], step) if self.axis is not None else None
+        data = seg = None
+        if self.data is not None:
+            data = np.stack([self._resample_data_channel(c, grid, selected)
+                             for c in range(self.data.shape[0])]).astype(self.data.dtype)
+        if self.seg is not None and with_seg:
+            seg = np.stack([self._resample_seg_channel(c, grid, selected) for c in range(self.seg.shape[0])])
+        return data, seg
@@ -0,0 +1,110 @@
+import hashlib
+import json
+
+from batchgenerators.utilities.file_and_folder_operations import *
+
+manifest_file = "preprocessing_manifest.json"
+
+
+def hash_files(filenames, hasher=None, chunk_size=1 << 20):
+    """
+    :param filenames: files to hash in this order. None entries are hashed as a marker, so that a missing roi
+    segmentation gives a different key than an empty file
+    :return: hex digest of the contents of all files
+    """
+    hasher = hashlib.blake2b(digest_size=20) if hasher is None else hasher
+    for f in filenames:
+        if f is None:
+            hasher.update(b"<none>")
+            continue
+        with open(f, "rb") as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b""):
+                hasher.update(chunk)
+        hasher.update(b"<end of file>")
+    return hasher.hexdigest()
+
+
+def hash_settings(settings):
+    """
+    :param settings: dict with everything besides the input files that changes the output of a case, e.g. the target
+    spacing and normalization schemes. numpy arrays are hashed as lists
+    """
+    encoded = json.dumps(settings, sort_keys=True, default=lambda o: o.tolist() if hasattr(o, "tolist") else str(o))
+    return hashlib.blake2b(encoded.encode(), digest_size=20).hexdigest()
+
+
+def _get_file_stats(filenames):
+    stats = []
+    for f in filenames:
+        if f is None:
+            stats.append(None)
+        else:
+            st = os.stat(f)
+            stats.append([os.path.basename(f), st.st_size, st.st_mtime_ns])
+    return stats
+
+
+class PreprocessingManifest(object):
+    """
+    Records per case of an output folder (cropped data or a preprocessed stage folder) a fingerprint of the files the
+    case was made from and of the settings it was made with, so that a rerun only processes new and changed cases and
+    knows which outputs belong to cases that were removed from the dataset.
+
+    Input files are fingerprinted by content. The size and modification time of every file are recorded as well, so
+    that files that were not touched since the last run are not read again.
+
+    Usage: plan the run with find_changes, process the returned cases, remove the outputs of the removed ones and call
+    save. Until save, the manifest on disk describes the previous run, so an interrupted run is simply repeated for the
+    cases that were not finished.
+    """
+
+    def __init__(self, folder):
+        self.filename = join(folder, manifest_file)
+        self.cases = load_json(self.filename)["cases"] if isfile(self.filename) else {}
+        self._planned = None
+
+    def _get_content_hash(self, case_id, files, stats):
+        record = self.cases.get(case_id)
+        if record is not None and record["files"] == stats:
+            return record["content"]
+        return hash_files(files)
+
+    def find_changes(self, case_files, settings, is_complete=None, overwrite_existing=False):
+        """
+        :param case_files: dict case_id: input files of the case (None for a missing roi segmentation)
+        :param settings: see hash_settings
+        :param is_complete: function case_id -> whether all outputs of the case exist. Cases for which it returns
+        False are processed again
+        :param overwrite_existing: process all cases
+        :return: case ids that need to be processed (new, changed input files or settings, or incomplete outputs),
+        case ids in the manifest that are no longer in case_files
+        """
+        settings_hash = hash_settings(settings)
+        to_process = []
+        self._planned = {}
+        for case_id, files in case_files.items():
+            stats = _get_file_stats(files)
+            content = self._get_content_hash(case_id, files, stats)
+            record = self.cases.get(case_id)
+            if overwrite_existing or record is None or record["content"] != content or \
+                    record["settings"] != settings_hash or (is_complete is not None and not is_complete(case_id)):
+                to_process.append(case_id)
+            self._planned[case_id] = {"files": stats, "content": content, "settings": settings_hash}
+        removed = [case_id for case_id in self.cases if case_id not in case_files]
+        return to_process, removed
+
+    def save(self):
+        """
+        Records the cases of the last find_changes as up to date, call after they have been processed
+        """
+        assert self._planned is not None, "call find_changes first"
+        self.cases = self._planned
+        save_json({"cases": self.cases}, self.filename + ".tmp")
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def remove_case_outputs(folder, case_id, extensions=(".npz", ".pkl", ".npy")):
+    for ext in extensions:
+        f = join(folder, case_id + ext)
+        if isfile(f):
+            os.remove(f)
@@ -7,14 +7,20 @@ from batchgenerators.utilities.file_and_folder_operations import *
 from multiprocessing.pool import Pool
 from nnunet.preprocessing.preprocessing import GenericPreprocessor
 from universalclassifier.preprocessing.cropping import ClassificationImageCropper
+from universalclassifier.preprocessing.fov_resampling import FOVResampler, get_central_crop_window
 from universalclassifier.preprocessing.padding import central_pad  # Import padding function
+from universalclassifier.preprocessing.preprocessing_manifest import PreprocessingManifest, remove_case_outputs
+from universalclassifier.profiling import stage
 
 class UniversalClassifierPreprocessor(GenericPreprocessor):
 
     def run(self, target_spacings, target_sizes, input_folder_with_cropped_npz, output_folder, data_identifier,
-            num_threads=default_num_threads, force_separate_z=None):
+            num_threads=default_num_threads, force_separate_z=None, restrict_to_fov=False, overwrite_existing=False):
         """
-        Runs the preprocessing pipeline for a single stage with fixed spacing and size.
+        Runs the preprocessing pipeline for a single stage with fixed spacing and size. Only cases that are new, whose
+        cropped data changed or that were preprocessed with other settings (see get_manifest_settings) are processed,
+        and the outputs of cases that are no longer in input_folder_with_cropped_npz are removed. This is tracked in a
+        PreprocessingManifest in the stage folder.
 
         Args:
             target_spacings (list of lists): Desired voxel spacings for the single stage, e.g., [[0.5, 0.5, 3]].
@@ -24,6 +30,9 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
             data_identifier (str): Identifier for the dataset.
             num_threads (int, optional): Number of threads for multiprocessing. Defaults to default_num_threads.
             force_separate_z (bool, optional): Parameter for handling separate z-axis if needed. Defaults to None.
+            restrict_to_fov (bool, optional): Only resample the field of view that is kept by central_pad, see
+                resample_and_normalize_fov. Defaults to False.
+            overwrite_existing (bool, optional): Preprocess all cases again. Defaults to False.
         """
         print("Initializing to run preprocessing")
         print("npz folder:", input_folder_with_cropped_npz)
@@ -39,20 +48,56 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
         output_folder_stage = os.path.join(output_folder, f"{data_identifier}_stage0")
         maybe_mkdir_p(output_folder_stage)
 
+        # Find the cases that need to be preprocessed. The cropped npz and pkl are derived from the source images and roi
+        # segmentation only, so their fingerprint covers those
+        case_files = {get_case_identifier_from_npz(case): [case, case[:-len(".npz")] + ".pkl"]
+                      for case in list_of_cropped_npz_files}
+        manifest = PreprocessingManifest(output_folder_stage)
+        to_process, removed = manifest.find_changes(
+            case_files, self.get_manifest_settings(spacing, target_size, force_separate_z, restrict_to_fov),
+            is_complete=lambda c: isfile(join(output_folder_stage, c + ".npz")) and
+                                  isfile(join(output_folder_stage, c + ".pkl")),
+            overwrite_existing=overwrite_existing)
+        print("preprocessing %d new or changed cases, removing %d cases, %d cases are up to date" %
+              (len(to_process), len(removed), len(case_files) - len(to_process)))
+        for case_identifier in removed:
+            remove_case_outputs(output_folder_stage, case_identifier)
+        for case_identifier in to_process:
+            # an unpacked .npy of the old version would be used for training instead of the new npz
+            remove_case_outputs(output_folder_stage, case_identifier, extensions=(".npy",))
+
         # Prepare arguments for multiprocessing
         all_args = []
-        for case in list_of_cropped_npz_files:
-            case_identifier = get_case_identifier_from_npz(case)
+        for case_identifier in to_process:
             args = (
-            spacing, target_size, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z)
+            spacing, target_size, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z,
+            restrict_to_fov)
             all_args.append(args)
 
         # Run preprocessing in parallel with the specified number of threads
         with Pool(num_threads) as p:
             p.starmap(self._run_internal, all_args)
+        manifest.save()
+
+    def get_manifest_settings(self, target_spacing, target_size, force_separate_z=None, restrict_to_fov=False):
+        """
+        Everything besides the cropped data of a case that changes its preprocessed output. The intensity properties
+        are only used for CT normalization, so for other modalities new cases in the dataset do not invalidate the
+        existing ones.
+        """
+        uses_intensityproperties = any(s in ("CT", "CT2") for s in self.normalization_scheme_per_modality.values())
+        return {"preprocessor": self.__class__.__name__,
+                "target_spacing": target_spacing,
+                "target_size": target_size,
+                "normalization_schemes": self.normalization_scheme_per_modality,
+                "use_nonzero_mask": self.use_nonzero_mask,
+                "transpose_forward": self.transpose_forward,
+                "intensityproperties": self.intensityproperties if uses_intensityproperties else None,
+                "force_separate_z": force_separate_z,
+                "restrict_to_fov": restrict_to_fov}
 
     def _run_internal(self, target_spacing, target_size, case_identifier, output_folder_stage, cropped_output_dir,
-                      force_separate_z):
+                      force_separate_z, restrict_to_fov=False):
         """
         Internal method to handle preprocessing of a single case, including resampling and padding.
 
@@ -63,6 +108,7 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
             output_folder_stage (str): Path to the output folder for the current stage.
             cropped_output_dir (str): Path to the cropped data directory.
             force_separate_z (bool, optional): Parameter for handling separate z-axis if needed.
+            restrict_to_fov (bool, optional): Only resample the field of view that is kept by central_pad.
         """
         # Load the data from the cropped directory
         data, seg, properties = self.load_cropped(cropped_output_dir, case_identifier)
@@ -71,8 +117,12 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
         data = data.transpose((0, *[i + 1 for i in self.transpose_forward]))
         seg = seg.transpose((0, *[i + 1 for i in self.transpose_forward]))
 
-        data, seg, properties = self.resample_and_normalize(data, target_spacing,
-                                                            properties, seg, force_separate_z)
+        if restrict_to_fov:
+            data, seg, properties = self.resample_and_normalize_fov(data, target_spacing, target_size,
+                                                                    properties, seg, force_separate_z)
+        else:
+            data, seg, properties = self.resample_and_normalize(data, target_spacing,
+                                                                properties, seg, force_separate_z)
 
         data, seg, properties = central_pad(data, target_size, properties, seg)
 
@@ -85,7 +135,8 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
         with open(os.path.join(output_folder_stage, f"{case_identifier}.pkl"), 'wb') as f:
             pickle.dump(properties, f)
 
-    def preprocess_test_case(self, data_files, target_spacing, target_size, seg_file=None, force_separate_z=None):
+    def preprocess_test_case(self, data_files, target_spacing, target_size, seg_file=None, force_separate_z=None,
+                             restrict_to_fov=False):
         """
         Preprocesses a single test case with fixed spacing and size.
 
@@ -93,6 +144,8 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
             data_files (list): List of paths to image files.
             seg_file (str, optional): Path to the segmentation file. Defaults to None.
             force_separate_z (bool, optional): Parameter for handling separate z-axis if needed. Defaults to None.
+            restrict_to_fov (bool, optional): Only resample the field of view that is kept by central_pad, see
+                resample_and_normalize_fov. Defaults to False.
 
         Returns:
             tuple: Preprocessed data, segmentation, and updated properties.
@@ -101,17 +154,146 @@ class UniversalClassifierPreprocessor(GenericPreprocessor):
         data, seg, properties = ClassificationImageCropper.crop_from_list_of_files(
             data_files, seg_file, create_dummy_seg=(seg_file is None)
         )
+        return self._preprocess_cropped_test_case(data, seg, properties, target_spacing, target_size,
+                                                  force_separate_z, restrict_to_fov)
+
+    def preprocess_test_case_from_arrays(self, data, spacing, target_spacing, target_size, seg=None,
+                                         force_separate_z=None, restrict_to_fov=False):
+        """
+        Same as preprocess_test_case, for a case that is already in memory.
+
+        Args:
+            data (np.ndarray): Image of shape (c, z, y, x), in the axis order of sitk.GetArrayFromImage.
+            spacing (list): Spacing of data in (z, y, x) order.
+            seg (np.ndarray, optional): ROI segmentation of shape (z, y, x). Defaults to None.
 
+        Returns:
+            tuple: Preprocessed data, segmentation, and updated properties.
+        """
+        data, seg, properties = ClassificationImageCropper.crop_from_arrays(data, spacing, seg)
+        return self._preprocess_cropped_test_case(data, seg, properties, target_spacing, target_size,
+                                                  force_separate_z, restrict_to_fov)
+
+    def _preprocess_cropped_test_case(self, data, seg, properties, target_spacing, target_size,
+                                      force_separate_z=None, restrict_to_fov=False):
         # Apply transpose for consistent orientation
-        data = data.transpose((0, *[i + 1 for i in self.transpose_forward]))
-        seg = seg.transpose((0, *[i + 1 for i in self.transpose_forward]))
+        with stage("transpose"):
+            data = data.transpose((0, *[i + 1 for i in self.transpose_forward]))
+            seg = seg.transpose((0, *[i + 1 for i in self.transpose_forward]))
 
         # Resample and normalize the data to the fixed target spacing
-        data, seg, properties = self.resample_and_normalize(
-            data, target_spacing, properties, seg, force_separate_z
-        )
+        with stage("resample_normalize"):
+            if restrict_to_fov:
+                data, seg, properties = self.resample_and_normalize_fov(
+                    data, target_spacing, target_size, properties, seg, force_separate_z
+                )
+            else:
+                data, seg, properties = self.resample_and_normalize(
+                    data, target_spacing, properties, seg, force_separate_z
+                )
 
         # Apply central padding to match the fixed target size
-        data, seg, properties = central_pad(data, target_size, properties, seg)
+        with stage("central_pad"):
+            data, seg, properties = central_pad(data, target_size, properties, seg)
 
         return data.astype(np.float32), seg, properties
+
+    def resample_and_normalize_fov(self, data, target_spacing, target_size, properties, seg=None,
+                                   force_separate_z=None, statistics_stride=1):
+        """
+        Same as resample_and_normalize followed by the crop of central_pad, but only resamples the field of view that
+        is kept by the crop (see FOVResampler). For large images, most of the resampled voxels are thrown away by the
+        crop. The voxels in the field of view are the same as those of resample_and_normalize. The per case
+        normalization statistics of the nonCT and CT2 schemes need the whole resampled image though, so by default
+        the whole image is still resampled if a modality uses one of these, and the result is the same as that of
+        resample_and_normalize. Only CT and noNorm modalities are sped up then.
+
+        Args:
+            data (np.ndarray): Transposed image of shape (c, x, y, z).
+            target_spacing (list): Target spacing, in transposed order.
+            target_size (list): Size that central_pad crops or pads to, in transposed order.
+            properties (dict): Un-transposed properties of the case.
+            seg (np.ndarray, optional): Transposed roi segmentation of shape (1, x, y, z).
+            force_separate_z (bool, optional): Parameter for handling separate z-axis if needed. Defaults to None.
+            statistics_stride (int, optional): Estimate the per case statistics from every statistics_stride-th
+                resampled voxel along every axis instead of resampling the whole image. Faster, but the normalized
+                intensities differ from those of resample_and_normalize (by up to about 0.14 for 2). Defaults to 1.
+
+        Returns:
+            tuple: Resampled and normalized data of at most target_size, segmentation, and updated properties.
+        """
+        original_spacing_transposed = np.array(properties["original_spacing"])[self.transpose_forward]
+
+        # remove nans
+        data[np.isnan(data)] = 0
+
+        resampler = FOVResampler(data, seg, original_spacing_transposed, target_spacing, force_separate_z,
+                                 self.resample_separate_z_anisotropy_threshold)
+        window = get_central_crop_window(resampler.resampled_shape, target_size)
+        print("resampling field of view", window, "of", resampler.resampled_shape)
+        needs_statistics = any(self.normalization_scheme_per_modality[c] not in ("CT", "noNorm")
+                               for c in range(len(data)))
+        if not needs_statistics:
+            data, seg = resampler.resample(window)
+            sampled_data, sampled_seg = data, seg  # not used by CT and noNorm
+        elif statistics_stride == 1 or np.all(resampler.shape == resampler.resampled_shape):
+            data, seg = resampler.resample()
+            sampled_data, sampled_seg = data, seg
+            crop = (slice(None),) + tuple(slice(start, stop) for start, stop in window)
+            data, seg = data[crop], (seg[crop] if seg is not None else None)
+        else:
+            # the resampled roi segmentation is only needed for the statistics within the nonzero mask
+            with_seg = any(self.use_nonzero_mask[c] for c in range(len(data)))
+            sampled_data, sampled_seg = resampler.resample(step=statistics_stride, with_seg=with_seg)
+            data, seg = resampler.resample(window)
+
+        if seg is not None:
+            seg[seg < -1] = 0
+        if sampled_seg is not None:
+            sampled_seg[sampled_seg < -1] = 0
+
+        properties["size_after_resampling"] = tuple(resampler.resampled_shape)
+        properties["spacing_after_resampling"] = target_spacing
+
+        for c, (lower_bound, upper_bound, mean, std) in enumerate(
+                self._get_normalization_parameters(sampled_data, sampled_seg)):
+            if lower_bound is not None:
+                data[c] = np.clip(data[c], lower_bound, upper_bound)
+            if mean is not None:
+                data[c] = (data[c] - mean) / std
+            if self.use_nonzero_mask[c] and self.normalization_scheme_per_modality[c] != 'noNorm':
+                data[c][seg[-1] < 0] = 0
+        return data, seg, properties
+
+    def _get_normalization_parameters(self, data, seg):
+        """
+        :param data: resampled image (or a sample of its voxels)
+        :param seg: resampled roi segmentation (or the same sample), for the nonzero mask
+        :return: per channel (lower_bound, upper_bound, mean, std) of the normalization that resample_and_normalize
+        applies (None entries are not applied), with the per case statistics computed on data
+        """
+        assert len(self.normalization_scheme_per_modality) == len(data), "self.normalization_scheme_per_modality " \
+                                                                         "must have as many entries as data has " \
+                                                                         "modalities"
+        assert len(self.use_nonzero_mask) == len(data), "self.use_nonzero_mask must have as many entries as data" \
+                                                        " has modalities"
+        parameters = []
+        for c in range(len(data)):
+            scheme = self.normalization_scheme_per_modality[c]
+            if scheme == "CT":
+                assert self.intensityproperties is not None, "ERROR: if there is a CT then we need intensity properties"
+                parameters.append((self.intensityproperties[c]['percentile_00_5'],
+                                   self.intensityproperties[c]['percentile_99_5'],
+                                   self.intensityproperties[c]['mean'], self.intensityproperties[c]['sd']))
+            elif scheme == "CT2":
+                assert self.intensityproperties is not None, "ERROR: if there is a CT then we need intensity properties"
+                lower_bound = self.intensityproperties[c]['percentile_00_5']
+                upper_bound = self.intensityproperties[c]['percentile_99_5']
+                voxels = data[c][(data[c] > lower_bound) & (data[c] < upper_bound)]
+                parameters.append((lower_bound, upper_bound, voxels.mean(), voxels.std()))
+            elif scheme == 'noNorm':
+                parameters.append((None, None, None, None))
+            else:
+                voxels = data[c][seg[-1] >= 0] if self.use_nonzero_mask[c] else data[c]
+                parameters.append((None, None, voxels.mean(), voxels.std() + 1e-8))
+        return parameters
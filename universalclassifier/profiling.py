@@ -0,0 +1,181 @@
+"""
+Opt-in timing and memory instrumentation of the prediction path.
+
+Profiling is enabled with enable_profiling(filename), which sets the environment variable UC_PROFILE_FILE, so that the
+preprocessing worker processes record as well. `with profiling(filename):` enables it for a block only. Every
+`with stage(name):` block then appends one json line with the stage, the case, the wall time and the peak resident set
+size of the process during the block to that file. print_summary aggregates the file per stage. When profiling is
+disabled, stage only costs an environment lookup.
+
+Peak RSS is measured with the VmHWM high water mark of /proc/self/status, which is reset at the start of every stage
+(Linux). The high water mark is folded into the running peak of every stage that is still open before it is reset, so
+that an outer stage (e.g. preprocess around read, crop and resample) reports the peak over its whole block. Elsewhere
+the peak RSS of the whole process so far is reported. Memory is process wide: stages that run at the same time in
+threads of the same process (export) share it.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+profile_file_env = "UC_PROFILE_FILE"
+
+_current_case = None
+
+# running peak RSS (one element list) of every stage of this process that is open, see stage
+_open_stages = []
+_open_stages_lock = threading.Lock()
+
+
+def enable_profiling(filename):
+    """
+    Starts recording stages to filename (json lines). An existing file is overwritten
+    """
+    open(filename, "w").close()
+    os.environ[profile_file_env] = os.path.abspath(filename)
+
+
+def disable_profiling():
+    os.environ.pop(profile_file_env, None)
+
+
+@contextmanager
+def profiling(filename):
+    """
+    Records stages to filename within the block, see enable_profiling. Afterwards the previous profile file is restored,
+    or profiling is disabled if there was none. Does nothing if filename is None
+    """
+    if filename is None:
+        yield
+        return
+    previous = os.environ.get(profile_file_env)
+    enable_profiling(filename)
+    try:
+        yield
+    finally:
+        if previous is None:
+            disable_profiling()
+        else:
+            os.environ[profile_file_env] = previous
+
+
+def profiling_enabled():
+    return os.environ.get(profile_file_env) is not None
+
+
+def set_case(case):
+    """
+    Case that the stages of this process are recorded for, unless stage gets a case explicitly
+    """
+    global _current_case
+    _current_case = case
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, kilobytes on Linux
+
+
+def _write_record(filename, record):
+    # a single write to a file opened with O_APPEND, so that the lines of several processes do not interleave
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def stage(name, case=None, **info):
+    """
+    Records the wall time and peak RSS of the block, if profiling is enabled
+    :param name: e.g. 'read', 'crop', 'forward_fold_0'
+    :param case: case id or list of case ids (for batched stages). Default: the case set with set_case
+    :param info: json serializable extra fields of the record, e.g. batch_size
+    """
+    filename = os.environ.get(profile_file_env)
+    if filename is None:
+        yield
+        return
+    peak = [None]
+    with _open_stages_lock:
+        current = _peak_rss_mb()
+        for p in _open_stages:  # the reset below would lose the peak of the enclosing stages
+            p[0] = current if p[0] is None else max(p[0], current)
+        _reset_peak_rss()
+        _open_stages.append(peak)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _open_stages_lock:
+            del _open_stages[next(i for i, p in enumerate(_open_stages) if p is peak)]  # not remove, [x] == [x]
+            current = _peak_rss_mb()
+        peak_rss = current if peak[0] is None or current is None else max(peak[0], current)
+        record = {"stage": name, "case": case if case is not None else _current_case, "seconds": seconds,
+                  "peak_rss_mb": peak_rss, "pid": os.getpid(), **info}
+        _write_record(filename, record)
+
+
+def load_records(filename):
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if len(line.strip()) > 0]
+
+
+def summarize_records(records):
+    """
+    :return: dict stage: {count, total_s, mean_ms, median_ms, p95_ms, max_peak_rss_mb}, in order of first occurrence
+    """
+    by_stage = {}
+    for r in records:
+        by_stage.setdefault(r["stage"], []).append(r)
+    summary = {}
+    for name, rs in by_stage.items():
+        seconds = np.array([r["seconds"] for r in rs])
+        rss = [r["peak_rss_mb"] for r in rs if r.get("peak_rss_mb") is not None]
+        summary[name] = {"count": len(rs), "total_s": float(seconds.sum()), "mean_ms": float(seconds.mean() * 1000),
+                         "median_ms": float(np.median(seconds) * 1000),
+                         "p95_ms": float(np.percentile(seconds, 95) * 1000),
+                         "max_peak_rss_mb": float(max(rss)) if len(rss) > 0 else None}
+    return summary
+
+
+def print_summary(filename=None):
+    """
+    Prints a table with the time and memory per stage of the records in filename (default: the enabled profile file)
+    """
+    filename = os.environ.get(profile_file_env) if filename is None else filename
+    if filename is None or not os.path.isfile(filename):
+        return
+    summary = summarize_records(load_records(filename))
+    print("\n%-22s %7s %10s %10s %10s %10s %14s" % ("stage", "count", "total s", "mean ms", "median ms", "p95 ms",
+                                                    "peak rss MB"))
+    for name, s in summary.items():
+        rss = "%14.0f" % s["max_peak_rss_mb"] if s["max_peak_rss_mb"] is not None else "%14s" % "-"
+        print("%-22s %7d %10.2f %10.1f %10.1f %10.1f %s" % (name, s["count"], s["total_s"], s["mean_ms"],
+                                                              s["median_ms"], s["p95_ms"], rss))
+    print("records saved in", filename, "\n")
@@ -17,7 +17,7 @@ import universalclassifier
 from nnunet.paths import network_training_output_dir, preprocessing_output_dir
 from batchgenerators.utilities.file_and_folder_operations import *
 from universalclassifier.experiment_planning.summarize_plans import summarize_plans
-from nnunet.training.model_restore import recursive_find_python_class
+from universalclassifier.training.model_restore import recursive_find_python_class
 
 from nnunet import paths
 
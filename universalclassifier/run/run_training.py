@@ -118,7 +118,7 @@ def run_training(args):
 
         # predict validation TODO: finish implementation of trainer.validate
         trainer.validate(validation_folder_name=val_folder,
-                         overwrite=args.val_disable_overwrite)
+                         overwrite=args.val_disable_overwrite, result_store=args.val_result_store)
 
         if network == '3d_lowres' and not args.disable_next_stage_pred:
             print("predicting segmentations for the next stage of the cascade")
@@ -18,10 +18,38 @@
 # happens in NetworkTrainer. Not sure why this is in the training folder in the original nnunet codebase.
 
 
+import importlib
+import pkgutil
+
 import universalclassifier
 import torch
 from batchgenerators.utilities.file_and_folder_operations import *
-from nnunet.training.model_restore import recursive_find_python_class
+
+
+def recursive_find_python_class(folder, trainer_name, current_module):
+    """
+    Same as nnunet.training.model_restore.recursive_find_python_class. Importing that module loads nnUNetTrainer and,
+    through it, the nnunet evaluator with medpy and scipy.stats, which takes seconds and is not needed here
+    """
+    tr = None
+    for importer, modname, ispkg in pkgutil.iter_modules(folder):
+        if not ispkg:
+            m = importlib.import_module(current_module + "." + modname)
+            if hasattr(m, trainer_name):
+                tr = getattr(m, trainer_name)
+                break
+
+    if tr is None:
+        for importer, modname, ispkg in pkgutil.iter_modules(folder):
+            if ispkg:
+                next_current_module = current_module + "." + modname
+                tr = recursive_find_python_class([join(folder[0], modname)], trainer_name,
+                                                 current_module=next_current_module)
+            if tr is not None:
+                break
+
+    return tr
+
 
 def restore_model(pkl_file, checkpoint=None, train=False, fp16=None):
     """
@@ -81,19 +109,19 @@ def restore_model(pkl_file, checkpoint=None, train=False, fp16=None):
     return trainer
 
 
-def load_model_and_checkpoint_files(folder, folds=None, mixed_precision=None, checkpoint_name="model_best"):
+def get_fold_folders(folder, folds=None):
     """
-    used for if you need to ensemble the five models of a cross-validation. This will restore the model from the
-    checkpoint in fold 0, load all parameters of the five folds in ram and return both. This will allow for fast
-    switching between parameters (as opposed to loading them form disk each time).
-
-    This is best used for inference and test prediction
-    :param folder:
-    :param folds:
-    :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
-    :return:
+    :param folder: trained model folder
+    :param folds: see load_model_and_checkpoint_files
+    :return: list of the output folders of the requested folds
     """
-    if isinstance(folds, str):
+    if isinstance(folds, (list, tuple)) and len(folds) == 1 and folds[0] == "soup":
+        folds = folds[0]
+    if folds == "soup":
+        # weight averaged model of the folds, see universalclassifier.inference.soup
+        folds = [join(folder, "soup")]
+        assert isdir(folds[0]), "no soup found in %s. Run uc_soup.py first" % folder
+    elif isinstance(folds, str):
         folds = [join(folder, "all")]
         assert isdir(folds[0]), "no output folder for fold %s found" % folds
     elif isinstance(folds, (list, tuple)):
@@ -111,6 +139,22 @@ def load_model_and_checkpoint_files(folder, folds=None, mixed_precision=None, ch
         print("found the following folds: ", folds)
     else:
         raise ValueError("Unknown value for folds. Type: %s. Expected: list of int, int, str or None", str(type(folds)))
+    return folds
+
+
+def load_model_and_checkpoint_files(folder, folds=None, mixed_precision=None, checkpoint_name="model_best"):
+    """
+    used for if you need to ensemble the five models of a cross-validation. This will restore the model from the
+    checkpoint in fold 0, load all parameters of the five folds in ram and return both. This will allow for fast
+    switching between parameters (as opposed to loading them form disk each time).
+
+    This is best used for inference and test prediction
+    :param folder:
+    :param folds:
+    :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
+    :return:
+    """
+    folds = get_fold_folders(folder, folds)
 
     trainer = restore_model(join(folds[0], "%s.model.pkl" % checkpoint_name), fp16=mixed_precision)
     trainer.output_folder = folder
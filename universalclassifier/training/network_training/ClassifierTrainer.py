@@ -13,14 +13,12 @@ from nnunet.training.data_augmentation.default_data_augmentation import default_
 from nnunet.utilities.nd_softmax import softmax_helper
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
 from scipy.special import softmax
-from sklearn.metrics import accuracy_score, roc_auc_score, roc_curve
 
 import numpy as np
 import torch
 from torch.nn import CrossEntropyLoss
 from torch.cuda.amp import autocast
 
-from sklearn.model_selection import KFold
 from nnunet.training.learning_rate.poly_lr import poly_lr
 
 from universalclassifier.network_architecture.i3d.i3dpt import I3D
@@ -34,6 +32,7 @@ from typing import Tuple, List
 from nnunet.utilities.random_stuff import no_op
 
 from universalclassifier.inference.export import save_output
+from universalclassifier.profiling import set_case, stage
 
 import universalclassifier
 
@@ -77,6 +76,10 @@ class ClassifierTrainer(NetworkTrainer):
 
         self.classes = self.do_dummy_2D_aug = self.use_mask_for_norm = None
 
+        # only resample the field of view that survives the central crop when preprocessing new cases, see
+        # UniversalClassifierPreprocessor.resample_and_normalize_fov
+        self.restrict_resampling_to_fov = False
+
         self.update_fold(fold)
 
         self.lr_scheduler_eps = 1e-3
@@ -258,7 +261,13 @@ class ClassifierTrainer(NetworkTrainer):
                                          momentum=0.99, nesterov=True)
         self.lr_scheduler = None
 
-    def validate(self, overwrite: bool = True, validation_folder_name: str = 'validation_raw'):
+    def validate(self, overwrite: bool = True, validation_folder_name: str = 'validation_raw',
+                 result_store: bool = False):
+        """
+        :param result_store: save the predictions in a single validation_folder_name/predictions.sqlite (see
+        universalclassifier.inference.result_store) instead of one npz per validation case
+        """
+        from sklearn.metrics import accuracy_score, roc_auc_score, roc_curve
         current_mode = self.network.training
         self.network.eval()
 
@@ -274,31 +283,35 @@ class ClassifierTrainer(NetworkTrainer):
         output_folder = join(self.output_folder, validation_folder_name)
         maybe_mkdir_p(output_folder)
         # this is for debug purposes
-        my_input_args = {'overwrite': overwrite, 'validation_folder_name': validation_folder_name}
+        my_input_args = {'overwrite': overwrite, 'validation_folder_name': validation_folder_name,
+                         'result_store': result_store}
         save_json(my_input_args, join(output_folder, "validation_args.json"))
 
-        # save predictions if needed
-        for k in self.dataset_val.keys():
-            save_fname = join(output_folder, k + ".npz")
-            if overwrite or not isfile(save_fname):
-                item = np.load(self.dataset[k]['data_file'])
-                data = item['data']
-
-                data = self.rescale_segmentation_channel(data)
-
-                result = {}
-                result['pred'], result['logits'] = self.predict_preprocessed_data_return_pred_and_logits(data[None],
-                                                                                                         self.fp16)
-                result['out'] = [softmax(x) for x in result['logits']]
-                result.update(self.dataset[k])
-                np.savez(save_fname, **result)
-
-        # load predictions
-        results = []
-        for k in self.dataset_val.keys():
-            save_fname = join(output_folder, k + ".npz")
-            result = np.load(save_fname, allow_pickle=True)
-            results += [result]
+        if result_store:
+            results = self._validate_with_result_store(join(output_folder, "predictions.sqlite"), overwrite)
+        else:
+            # save predictions if needed
+            for k in self.dataset_val.keys():
+                save_fname = join(output_folder, k + ".npz")
+                if overwrite or not isfile(save_fname):
+                    item = np.load(self.dataset[k]['data_file'])
+                    data = item['data']
+
+                    data = self.rescale_segmentation_channel(data)
+
+                    result = {}
+                    result['pred'], result['logits'] = \
+                        self.predict_preprocessed_data_return_pred_and_logits(data[None], self.fp16)
+                    result['out'] = [softmax(x) for x in result['logits']]
+                    result.update(self.dataset[k])
+                    np.savez(save_fname, **result)
+
+            # load predictions
+            results = []
+            for k in self.dataset_val.keys():
+                save_fname = join(output_folder, k + ".npz")
+                result = np.load(save_fname, allow_pickle=True)
+                results += [result]
         # convert from list of dicts to dict of np arrays:
         results = {k: np.asarray([dic[k] for dic in results]) for k in results[0]}
         results['classification_labels'] = results['classification_labels'][0]
@@ -331,6 +344,32 @@ class ClassifierTrainer(NetworkTrainer):
 
         self.network.train(current_mode)
 
+    def _validate_with_result_store(self, filename, overwrite):
+        """
+        Predicts the validation cases that are not in the result store yet (all of them if overwrite) and reads them
+        back in one query.
+        :return: list with one dict per validation case, with the same entries as the per case npz files of validate
+        """
+        from universalclassifier.inference.result_store import ResultStore, load_results
+        val_keys = list(self.dataset_val.keys())
+        with ResultStore(filename) as store:
+            done = set() if overwrite else store.case_ids()
+            for k in val_keys:
+                if k in done:
+                    continue
+                data = self.rescale_segmentation_channel(np.load(self.dataset[k]['data_file'])['data'])
+                pred, logits = self.predict_preprocessed_data_return_pred_and_logits(data[None], self.fp16)
+                store.add(k, pred, logits)
+
+        stored = load_results(filename, case_ids=val_keys)
+        results = []
+        for it, k in enumerate(val_keys):
+            result = {'pred': stored['categorical'][it], 'logits': [o[it:it + 1] for o in stored['outputs']]}
+            result['out'] = [softmax(x) for x in result['logits']]
+            result.update(self.dataset[k])
+            results.append(result)
+        return results
+
     def predict_preprocessed_data_return_pred_and_logits(self, data: np.ndarray,
                                                          mixed_precision: bool) -> Tuple[List, List]:
         valid = list((I3D,))
@@ -416,6 +455,7 @@ class ClassifierTrainer(NetworkTrainer):
         use a random 80:20 data split.
         :return:
         """
+        from sklearn.model_selection import KFold
         if self.fold == "all":
             # if fold==all then we use all images for training and validation
             tr_keys = val_keys = list(self.dataset.keys())
@@ -557,14 +597,8 @@ class ClassifierTrainer(NetworkTrainer):
     def finish_online_evaluation(self):
         pass  # TODO: implement this function (optional)
 
-    def preprocess_patient(self, input_files, seg_file):
-        """
-                Used to predict new unseen data. Not used for the preprocessing of the training/test data
-                :param input_files:
-                :param seg_file:
-                :return:
-                """
-        from nnunet.training.model_restore import recursive_find_python_class
+    def get_preprocessor(self):
+        from universalclassifier.training.model_restore import recursive_find_python_class
         preprocessor_name = self.plans.get('preprocessor_name')
         if preprocessor_name is None:
             if self.threeD:
@@ -579,20 +613,48 @@ class ClassifierTrainer(NetworkTrainer):
 
         assert preprocessor_class is not None, "Could not find preprocessor %s in nnunet.preprocessing" % \
                                                preprocessor_name
-        preprocessor = preprocessor_class(self.normalization_schemes, self.use_mask_for_norm,
-                                          self.transpose_forward, self.intensity_properties)
+        return preprocessor_class(self.normalization_schemes, self.use_mask_for_norm,
+                                  self.transpose_forward, self.intensity_properties)
 
+    def preprocess_patient(self, input_files, seg_file):
+        """
+                Used to predict new unseen data. Not used for the preprocessing of the training/test data
+                :param input_files:
+                :param seg_file:
+                :return:
+                """
+        preprocessor = self.get_preprocessor()
         d, s, properties = preprocessor.preprocess_test_case(input_files,
                                                              self.plans['plans_per_stage'][self.stage][
                                                                  'current_spacing'],
                                                              self.plans['plans_per_stage'][self.stage][
                                                                  'image_size'],
-                                                             seg_file)
+                                                             seg_file,
+                                                             restrict_to_fov=self.restrict_resampling_to_fov)
+        return d, s, properties
+
+    def preprocess_patient_from_arrays(self, data, spacing, seg=None):
+        """
+        Same as preprocess_patient, for a case that is already in memory
+        :param data: image of shape (c, z, y, x), in the axis order of sitk.GetArrayFromImage
+        :param spacing: spacing of data in (z, y, x) order
+        :param seg: optional roi segmentation of shape (z, y, x)
+        :return:
+        """
+        preprocessor = self.get_preprocessor()
+        d, s, properties = preprocessor.preprocess_test_case_from_arrays(data, spacing,
+                                                                         self.plans['plans_per_stage'][self.stage][
+                                                                             'current_spacing'],
+                                                                         self.plans['plans_per_stage'][self.stage][
+                                                                             'image_size'],
+                                                                         seg,
+                                                                         restrict_to_fov=self.restrict_resampling_to_fov)
         return d, s, properties
 
     def preprocess_predict_nifti(self, input_files: List[str], seg_file: str, output_file: str = None) -> None:
         """
-        Use this to predict new data
+        Use this to predict new data. The stages are recorded if profiling is enabled, see
+        universalclassifier.profiling.enable_profiling
         :param input_files:
         :param seg_file:
         :param output_file:
@@ -600,11 +662,14 @@ class ClassifierTrainer(NetworkTrainer):
         """
         self.print_to_log_file(f"Processing {input_files, seg_file}:")
         self.print_to_log_file("preprocessing...")
-        d, s, properties = self.preprocess_patient(input_files, seg_file)
-        data = self.combine_data_and_seg(d, s)
+        set_case(os.path.basename(input_files[0]))
+        with stage("preprocess"):
+            d, s, properties = self.preprocess_patient(input_files, seg_file)
+            data = self.combine_data_and_seg(d, s)
         self.print_to_log_file("predicting...")
-        categorical_output, pred = self.predict_preprocessed_data_return_pred_and_logits(data[None], self.fp16)[
-            1]  # generates logits output
+        with stage("forward"):
+            categorical_output, pred = self.predict_preprocessed_data_return_pred_and_logits(data[None], self.fp16)[
+                1]  # generates logits output
         self.print_to_log_file("exporting prediction...")
         save_output(categorical_output, pred, output_file, properties)
         self.print_to_log_file("done")
@@ -0,0 +1,190 @@
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
+from torch.cuda.amp import autocast
+
+from universalclassifier.network_architecture.i3d.i3dpt import I3D
+from universalclassifier.training.network_training.ClassifierTrainer import ClassifierTrainer
+
+
+class ClassifierTrainerDistillation(ClassifierTrainer):
+    """
+    Trains a single student network on the averaged (temperature scaled) softmax of an existing fold ensemble, the
+    teacher, in addition to the ground truth labels.
+
+    The teacher is the trained model folder of teacher_trainer_class_name with the same plans, next to the output
+    folder of this trainer (e.g. .../Task001_X/ClassifierTrainer__UniversalClassifierPlansv1.0), unless teacher_folder
+    is set. Its probabilities are computed once per preprocessed case (without data augmentation) and cached in
+    <output folder base>/teacher_probabilities_T<temperature>_<teacher fingerprint>/, so the teacher is not needed
+    during training. The fingerprint covers the plans and checkpoints of the teacher folds that are used, so another
+    teacher or a retrained one gets a new cache.
+
+    Note that the teacher ensemble has seen the validation cases of every fold, so the validation metrics of the
+    student are optimistic.
+    """
+
+    def __init__(self, plans_file, fold, output_folder=None, dataset_directory=None, stage=None, unpack_data=True,
+                 deterministic=True, fp16=False):
+        super().__init__(plans_file, fold, output_folder, dataset_directory, stage, unpack_data, deterministic, fp16)
+        self.teacher_trainer_class_name = "ClassifierTrainer"
+        self.teacher_folder = None
+        self.teacher_folds = None  # None: all folds found in the teacher folder
+        self.teacher_checkpoint_name = "model_final_checkpoint"
+        self.distillation_temperature = 2.
+        self.distillation_weight = 0.9  # weight of the soft target loss, the ground truth loss gets 1 - this
+        self.width_multiplier = 1.
+
+        self.teacher_probabilities = None
+
+    def initialize_network(self):
+        if not self.threeD:
+            raise RuntimeError("2D network not implemented")
+
+        self.network = I3D(self.num_input_channels, self.num_classification_classes,
+                           width_multiplier=self.width_multiplier)
+
+        if torch.cuda.is_available():
+            self.network.cuda()
+
+    def initialize(self, training=True, force_load_plans=False):
+        super().initialize(training, force_load_plans)
+        if training:
+            self.teacher_probabilities = self.load_teacher_probabilities()
+
+    def get_teacher_folder(self):
+        if self.teacher_folder is not None:
+            return self.teacher_folder
+        folder_name = os.path.basename(self.output_folder_base.rstrip(os.sep))
+        plans_identifier = folder_name.split("__", 1)[1]
+        return join(os.path.dirname(self.output_folder_base.rstrip(os.sep)),
+                    self.teacher_trainer_class_name + "__" + plans_identifier)
+
+    def get_teacher_cache_folder(self):
+        from universalclassifier.inference.prediction_cache import get_model_fingerprint
+
+        fingerprint = get_model_fingerprint(self.get_teacher_folder(), self.teacher_folds,
+                                            self.teacher_checkpoint_name, mixed_precision=self.fp16,
+                                            temperature=self.distillation_temperature)
+        return join(self.output_folder_base, "teacher_probabilities_T%s_%s" % (str(self.distillation_temperature),
+                                                                               fingerprint[:16]))
+
+    def load_teacher_probabilities(self):
+        """
+        :return: dict with, for every case in self.dataset, a list with one array of teacher probabilities of shape
+        (num_classes,) per classification head. Missing cases are predicted with the teacher and cached first
+        """
+        cache_folder = self.get_teacher_cache_folder()
+        maybe_mkdir_p(cache_folder)
+        missing = [k for k in self.dataset.keys() if not isfile(join(cache_folder, k + ".npz"))]
+        if len(missing) > 0:
+            self.cache_teacher_probabilities(missing, cache_folder)
+
+        teacher_probabilities = {}
+        for k in self.dataset.keys():
+            cached = np.load(join(cache_folder, k + ".npz"))
+            teacher_probabilities[k] = [cached["head_%d" % i] for i in range(len(cached.files))]
+        return teacher_probabilities
+
+    def cache_teacher_probabilities(self, keys, cache_folder):
+        from universalclassifier.inference.ensemble import load_fold_ensemble
+        from universalclassifier.inference.evaluation import load_preprocessed_case
+
+        teacher_folder = self.get_teacher_folder()
+        self.print_to_log_file("computing teacher probabilities of %d cases with %s" % (len(keys), teacher_folder))
+        _, teacher = load_fold_ensemble(teacher_folder, self.teacher_folds, mixed_precision=self.fp16,
+                                        checkpoint_name=self.teacher_checkpoint_name)
+        for k in keys:
+            data = load_preprocessed_case(self, k)
+            probabilities = self.teacher_predict(teacher, data)
+            np.savez(join(cache_folder, k + ".npz"), **{"head_%d" % i: p[0] for i, p in enumerate(probabilities)})
+        del teacher
+        torch.cuda.empty_cache()
+
+    def teacher_predict(self, teacher, data):
+        """
+        :return: averaged softmax of logits / temperature over the teacher folds, one (1, num_classes) array per head
+        """
+        summed = None
+        with torch.no_grad():
+            inp = maybe_to_torch(data)
+            if torch.cuda.is_available():
+                inp = to_cuda(inp)
+            for network in teacher.networks:
+                output = [torch.softmax(o.float() / self.distillation_temperature, 1) for o in network(inp)]
+                summed = output if summed is None else [s + o for s, o in zip(summed, output)]
+        return [(s / len(teacher.networks)).cpu().numpy() for s in summed]
+
+    def distillation_loss(self, output, soft_targets):
+        """
+        Kullback-Leibler divergence between the temperature scaled student and teacher distributions, summed over the
+        classification heads and scaled by temperature ** 2 so that its gradients are comparable to the hard loss
+        """
+        temperature = self.distillation_temperature
+        loss = 0
+        for o, t in zip(output, soft_targets):
+            log_p = torch.log_softmax(o.float() / temperature, 1)
+            loss = loss + torch.nn.functional.kl_div(log_p, t, reduction='batchmean') * temperature ** 2
+        return loss
+
+    def compute_loss(self, output, target, soft_targets):
+        return self.distillation_weight * self.distillation_loss(output, soft_targets) + \
+               (1 - self.distillation_weight) * self.loss(output, target)
+
+    def run_iteration(self, data_generator, do_backprop=True, run_online_evaluation=False):
+        data_dict = next(data_generator)
+        data = data_dict['data']
+        target = data_dict['target']
+        soft_targets = [np.stack([self.teacher_probabilities[k][i] for k in data_dict['keys']])
+                        for i in range(len(target))]
+
+        data = maybe_to_torch(data)
+        target = maybe_to_torch(target)
+        soft_targets = maybe_to_torch(soft_targets)
+
+        if torch.cuda.is_available():
+            data = to_cuda(data)
+            target = to_cuda(target)
+            soft_targets = to_cuda(soft_targets)
+
+        self.optimizer.zero_grad()
+
+        if self.fp16:
+            with autocast():
+                output = self.network(data)
+                del data
+                l = self.compute_loss(output, target, soft_targets)
+
+            if do_backprop:
+                self.amp_grad_scaler.scale(l).backward()
+                self.amp_grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.amp_grad_scaler.step(self.optimizer)
+                self.amp_grad_scaler.update()
+        else:
+            output = self.network(data)
+            del data
+            l = self.compute_loss(output, target, soft_targets)
+
+            if do_backprop:
+                l.backward()
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.optimizer.step()
+
+        if run_online_evaluation:
+            self.run_online_evaluation(output, target)
+
+        del target, soft_targets
+
+        return l.detach().cpu().numpy()
+
+
+class ClassifierTrainerDistillationHalfWidth(ClassifierTrainerDistillation):
+    """
+    Distillation into an I3D with half the channels in every layer (about a quarter of the parameters and compute)
+    """
+
+    def __init__(self, plans_file, fold, output_folder=None, dataset_directory=None, stage=None, unpack_data=True,
+                 deterministic=True, fp16=False):
+        super().__init__(plans_file, fold, output_folder, dataset_directory, stage, unpack_data, deterministic, fp16)
+        self.width_multiplier = 0.5